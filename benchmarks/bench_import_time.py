@@ -0,0 +1,74 @@
+"""Cold import cost of the services and of the common modules they are built on.
+
+Each module is imported in a fresh interpreter with `-X importtime`, and the best of
+`--repeats` runs is reported together with its most expensive direct imports.
+
+    uv run python benchmarks/bench_import_time.py --repeats 5 --json import_times.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+TARGETS = (
+    "common.log",
+    "common.prom",
+    "common.prefect_utils",
+    "receiver.server",
+    "poller.server",
+    "flows.a_flow",
+)
+
+
+def import_times(module: str) -> dict[str, int]:
+    # Maps `module` and each of its direct imports to their cumulative import time in microseconds
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    children: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative)
+        elif depth == 0:
+            # Children are listed before their parent, so this closes off a top level import
+            if name.strip() == module:
+                return {module: int(cumulative), **children}
+            children = {}
+    raise RuntimeError(f"{module} not found in -X importtime output")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=TARGETS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--top", type=int, default=3, help="heaviest direct imports to list per module")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.repeats)]
+        best = min(runs, key=lambda times: times[module])
+        heaviest = sorted((name for name in best if name != module), key=best.__getitem__, reverse=True)
+        results[module] = {
+            "total_ms": best[module] / 1000,
+            "heaviest": {name: best[name] / 1000 for name in heaviest[: args.top]},
+        }
+        slowest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in results[module]["heaviest"].items())
+        print(f"{module:<24} {results[module]['total_ms']:>8.0f}ms   {slowest}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
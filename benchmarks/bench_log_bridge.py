@@ -0,0 +1,87 @@
+"""Records/sec through InterceptHandler, the stdlib logging to loguru bridge.
+
+Stdlib records are logged the way libraries log them: through module loggers, with %-style
+arguments, a share from ignored loggers (uvicorn, httpx and their children) and a share below
+the handler's level. The loguru sink discards what it is given. The previous handler is timed
+alongside for comparison, as is logging to a NullHandler, which is the cost of the stdlib alone.
+
+    uv run python benchmarks/bench_log_bridge.py --records 50000
+"""
+
+import argparse
+import logging
+import time
+from types import FrameType
+from typing import cast
+
+from loguru import logger
+
+from common.log import LOGGERS_TO_IGNORE, InterceptHandler
+
+
+class LegacyInterceptHandler(logging.Handler):
+    # InterceptHandler before the ignore, level and caller depth caches
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.name in LOGGERS_TO_IGNORE:
+            return
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = str(record.levelno)
+
+        # Starts one frame further up, where the original loop skipped emit's own frame
+        frame, depth = cast(FrameType, logging.currentframe().f_back), 2
+        while frame.f_code.co_filename == logging.__file__:
+            frame = cast(FrameType, frame.f_back)
+            depth += 1
+        logger.opt(depth=depth, exception=record.exc_info).log(level, "{}", record.getMessage())
+
+
+def log_records(count: int) -> None:
+    app = logging.getLogger("bench.app")
+    client = logging.getLogger("httpx._client")
+    access = logging.getLogger("uvicorn.access.child")
+    for i in range(count):
+        if i % 5 == 0:
+            app.info("Processed item %d", i)
+        elif i % 5 == 1:
+            app.warning("Retrying request %d after %.2fs", i, 0.25)
+        elif i % 5 == 2:
+            app.debug("Heartbeat %d", i)
+        elif i % 5 == 3:
+            client.info("HTTP Request: GET %s", "http://bench")
+        else:
+            access.info("%s - %s", "127.0.0.1", "GET / HTTP/1.1")
+
+
+def rate(handler: logging.Handler, records: int, repeats: int) -> float:
+    root = logging.getLogger()
+    root.handlers = [handler]
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        log_records(records)
+        best = min(best, time.perf_counter() - start)
+    return records / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG)
+    logger.remove()
+    logger.add(lambda message: None, level="INFO")
+
+    # Creating the records and calling the handlers, with nothing behind them
+    floor = rate(logging.NullHandler(), args.records, args.repeats)
+    legacy = rate(LegacyInterceptHandler(), args.records, args.repeats)
+    current = rate(InterceptHandler(logging.INFO), args.records, args.repeats)
+    print(f"{'stdlib rec/s':>14} {'legacy rec/s':>14} {'bridge rec/s':>14} {'speedup':>8}")
+    print(f"{floor:>14,.0f} {legacy:>14,.0f} {current:>14,.0f} {current / legacy:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Records/sec of the structured log encoder against the previous dict + json.dumps path.
+
+uv run python benchmarks/bench_log_encoder.py --records 50000
+"""
+
+import argparse
+import json
+import time
+import traceback
+from datetime import timezone as tz
+from typing import Any
+
+from loguru import logger
+
+from common.log import LogEncoder
+
+
+def legacy_serialize(service: str, record: Any, json_format: bool = True) -> str:
+    # The serialization half of sink_serializer before LogEncoder was introduced
+    simplified = {
+        "service": service,
+        "time": record["time"].astimezone(tz.utc).isoformat(timespec="milliseconds"),
+        "level": record["level"].name,
+        "caller": f"{record['file'].name}:{record['line']}",
+        "message": record["message"],
+    }
+    if "exception" in record:
+        vals = record["exception"]
+        if vals is not None:
+            type, value, tb = record["exception"]
+            if type is not None:
+                simplified["error_type"] = type.__name__
+            if value is not None:
+                simplified["error_message"] = str(value)
+            if tb is not None:
+                simplified["error_traceback"] = "".join(traceback.format_tb(tb))
+    if "extra" in record:
+        simplified |= record["extra"]
+    for key, value in simplified.items():
+        if isinstance(value, Exception):
+            simplified[key] = str(value)
+    simplified["message"] = simplified.pop("message")
+    if json_format:
+        return json.dumps(simplified, skipkeys=True)
+    serialized = ""
+    for key, value in simplified.items():
+        serialized += f"{key}={value} "
+    return serialized
+
+
+def capture_records(count: int) -> list[Any]:
+    records: list[Any] = []
+    logger.remove()
+    handler = logger.add(lambda message: records.append(message.record), level="DEBUG")
+    for i in range(count):
+        if i % 3 == 0:
+            logger.bind(flow_run_id="8c1d6a4e", task_name="some_task").info(f"Processed item {i}")
+        elif i % 3 == 1:
+            logger.warning("Retrying request {} after {:.2f}s", i, 0.25)
+        else:
+            logger.debug("Heartbeat")
+    logger.remove(handler)
+    return records
+
+
+def rate(func: Any, records: list[Any], repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for record in records:
+            func(record)
+        best = min(best, time.perf_counter() - start)
+    return len(records) / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    records = capture_records(args.records)
+    print(f"{'mode':<10} {'legacy rec/s':>14} {'encoder rec/s':>14} {'speedup':>8}")
+    for json_format in (True, False):
+        encoder = LogEncoder("bench", json_format=json_format)
+        legacy = rate(lambda r: legacy_serialize("bench", r, json_format), records, args.repeats)
+        current = rate(lambda r: encoder.encode(encoder.fields(r)), records, args.repeats)
+        mode = "json" if json_format else "key=value"
+        print(f"{mode:<10} {legacy:>14,.0f} {current:>14,.0f} {current / legacy:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
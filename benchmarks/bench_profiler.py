@@ -0,0 +1,67 @@
+"""Slowdown of a CPU-bound workload under the sampling profiler, at several sample intervals.
+
+The workload (nested pure-Python calls, so stacks have some depth) is timed bare and with a
+SamplingProfiler sampling its thread. For each interval the measured slowdown is printed
+next to the overhead the profiler reports for itself and the number of samples it took.
+
+    uv run python benchmarks/bench_profiler.py --intervals 0.001 0.005 0.01 --rounds 200
+"""
+
+import argparse
+import threading
+import time
+
+from common.profiling import SamplingProfiler
+
+
+def leaf(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+def branch(depth: int, n: int) -> int:
+    if depth == 0:
+        return leaf(n)
+    return branch(depth - 1, n) + branch(depth - 1, n // 2)
+
+
+def workload(rounds: int) -> None:
+    for _ in range(rounds):
+        branch(6, 2_000)
+
+
+def best_time(rounds: int, repeats: int, profiler: SamplingProfiler | None = None) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        if profiler is None:
+            workload(rounds)
+        else:
+            with profiler:
+                workload(rounds)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0.001, 0.005, 0.01, 0.05])
+    parser.add_argument("--max-overhead", type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(f"{'interval s':>10} {'bare ms':>9} {'slowdown':>9} {'reported':>9} {'samples':>8}")
+    for interval in args.intervals:
+        # Bare and profiled runs alternate so that both see the same machine noise
+        bare = best = float("inf")
+        reported, samples = 0.0, 0
+        for _ in range(args.repeats):
+            profiler = SamplingProfiler([threading.get_ident()], interval=interval, max_overhead=args.max_overhead)
+            bare = min(bare, best_time(args.rounds, 1))
+            best = min(best, best_time(args.rounds, 1, profiler))
+            reported, samples = max(reported, profiler.overhead), max(samples, profiler.samples)
+        print(f"{interval:>10} {bare * 1000:>9.1f} {best / bare - 1:>+9.2%} {reported:>9.2%} {samples:>8}")
+
+
+if __name__ == "__main__":
+    main()
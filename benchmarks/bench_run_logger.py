@@ -0,0 +1,83 @@
+"""Messages/sec from get_logger() inside a Prefect task run, against the previous wrapper.
+
+Each message is logged the way tasks do it in loops, calling `get_logger()` and then one level
+method, so the setup cost of the logger is paid per message. The loguru sink discards what it
+is given. Prefect starts its temporary server for the one flow run, which takes a few seconds.
+
+    uv run --all-packages python benchmarks/bench_run_logger.py --messages 20000
+"""
+
+import argparse
+import time
+from collections.abc import Callable
+from functools import wraps
+from typing import Any
+
+from loguru import logger
+from prefect import flow, task
+
+from common.log import get_logger
+
+
+def legacy_get_logger() -> Any:
+    # get_logger before run loggers were cached
+    extra: dict[str, str] = {}
+    try:
+        from prefect import get_run_logger
+
+        prefect_logger = get_run_logger()
+        extra = getattr(prefect_logger, "extra")
+
+    except Exception:
+        return logger
+
+    def intercept_prefect_log(func: Callable, level: str):
+        @wraps(func)
+        def wrapper(msg, *args, **kwargs):
+            logger.bind(**extra).log(level.upper(), msg)
+
+        return wrapper
+
+    for level in ["debug", "info", "warning", "error", "exception"]:
+        fn = getattr(prefect_logger, level)
+        setattr(prefect_logger, level, intercept_prefect_log(fn, level))
+
+    return prefect_logger
+
+
+def rate(factory: Callable[[], Any], messages: int, repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for i in range(messages):
+            factory().info(f"Processed item {i}")
+        best = min(best, time.perf_counter() - start)
+    return messages / best
+
+
+@task
+def bench_task(messages: int, repeats: int) -> tuple[float, float]:
+    return rate(legacy_get_logger, messages, repeats), rate(get_logger, messages, repeats)
+
+
+@flow
+def bench_flow(messages: int, repeats: int) -> tuple[float, float]:
+    return bench_task(messages, repeats)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    logger.remove()
+    handler = logger.add(lambda message: None, level="DEBUG")
+    legacy, current = bench_flow(args.messages, args.repeats)
+    logger.remove(handler)
+    print(f"{'legacy msg/s':>14} {'cached msg/s':>14} {'speedup':>8}")
+    print(f"{legacy:>14,.0f} {current:>14,.0f} {current / legacy:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Per-request and per-run overhead of the instrumentation in the services.
+
+`receiver.server.app` is driven in-process through httpx's ASGI transport by `--concurrency`
+workers, with progressively more of the stack switched on:
+
+    bare       the receiver routes without PrometheusMiddleware and without a log sink
+    metrics    PrometheusMiddleware, no log sink
+    logging    PrometheusMiddleware and the JSON log sink (written to --log-file)
+    tracing    as logging, with spans batched to a stand-in exporter that discards them
+    prefect    data_flow / data_task wrappers called through `.fn`, pushing to a stand-in gateway
+
+Each mode runs in its own interpreter so that one mode's setup cannot leak into the next.
+The receiver's artificial handler delay is skipped unless `--handler-delay` is given.
+Results can be saved with `--output` and compared against an earlier run with `--compare`.
+
+    uv run --all-packages python benchmarks/bench_services.py --requests 5000 --concurrency 50
+    uv run --all-packages python benchmarks/bench_services.py --output before.json
+    uv run --all-packages python benchmarks/bench_services.py --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Sequence
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+MODES = ("bare", "metrics", "logging", "tracing", "prefect")
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    # Accepts pushes the way the Pushgateway does and throws them away
+    def _accept(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.end_headers()
+
+    do_PUT = do_POST = _accept
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def start_gateway() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _GatewayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def summarise(mode: str, latencies: list[float], elapsed: float, **extra: object) -> dict:
+    latencies.sort()
+    return {
+        "mode": mode,
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        **extra,
+    }
+
+
+async def drive(app: object, requests: int, concurrency: int) -> tuple[list[float], float]:
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)  # type: ignore[arg-type]
+    remaining = iter(range(requests))
+    latencies: list[float] = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def worker() -> None:
+            for _ in remaining:
+                start = time.perf_counter()
+                response = await client.get("/")
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, time.perf_counter() - start
+
+
+def run_receiver(mode: str, args: argparse.Namespace) -> dict:
+    from loguru import logger
+
+    from common.log import configure_logging
+    from common.prom import PrometheusMiddleware
+    from receiver import server
+
+    if not args.handler_delay:
+
+        async def sleep(delay: float) -> None:
+            await asyncio.sleep(0)
+
+        server.asyncio = SimpleNamespace(sleep=sleep)  # type: ignore[assignment]
+
+    app = server.app
+    if mode == "bare":
+        app.user_middleware = [m for m in app.user_middleware if m.cls is not PrometheusMiddleware]
+    if mode in ("bare", "metrics"):
+        logger.remove()
+    else:
+        configure_logging(server.service, file=open(args.log_file, "a"), force=True)
+    if mode == "tracing":
+        from opentelemetry import trace
+        from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+        from common.tracing import InstrumentedSpanExporter, MinimalSpanProcessor, get_tracer
+
+        class DiscardingExporter(SpanExporter):
+            def export(self, spans: Sequence) -> SpanExportResult:
+                return SpanExportResult.SUCCESS
+
+        get_tracer(server.service)
+        exporter = InstrumentedSpanExporter(DiscardingExporter(), server.service)
+        trace.get_tracer_provider().add_span_processor(MinimalSpanProcessor(exporter, service=server.service))  # type: ignore[attr-defined]
+
+    asyncio.run(drive(app, max(args.requests // 10, 1), args.concurrency))  # warm up
+    latencies, elapsed = asyncio.run(drive(app, args.requests, args.concurrency))
+    return summarise(mode, latencies, elapsed, concurrency=args.concurrency)
+
+
+def run_prefect(args: argparse.Namespace) -> dict:
+    # Read by common.settings on import, so it has to be set first
+    os.environ["PUSH_GATEWAY"] = start_gateway()
+
+    from common.log import configure_logging, flush_logging
+    from common.prefect_utils import data_flow, data_task
+    from common.push import get_publisher
+    from common.settings import settings
+
+    configure_logging(settings.service, file=open(args.log_file, "a"))
+
+    @data_task(name="bench_task")
+    def bench_task(value: int) -> int:
+        return value + 1
+
+    @data_flow(name="bench_flow")
+    def bench_flow(tasks: int) -> int:
+        return sum(bench_task.fn(i) for i in range(tasks))
+
+    for _ in range(max(args.runs // 10, 1)):  # warm up
+        bench_flow.fn(args.tasks)
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        run_start = time.perf_counter()
+        bench_flow.fn(args.tasks)
+        latencies.append(time.perf_counter() - run_start)
+    elapsed = time.perf_counter() - start
+    get_publisher(settings.push_gateway, settings.service).flush()
+    flush_logging()
+    return summarise("prefect", latencies, elapsed, tasks_per_run=args.tasks)
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> dict:
+    command = [sys.executable, __file__, "--child", mode]
+    command += ["--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+    command += ["--runs", str(args.runs), "--tasks", str(args.tasks), "--log-file", args.log_file]
+    if args.handler_delay:
+        command.append("--handler-delay")
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--requests", type=int, default=5_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=500, help="flow runs for the prefect mode")
+    parser.add_argument("--tasks", type=int, default=10, help="task calls per flow run for the prefect mode")
+    parser.add_argument("--handler-delay", action="store_true", help="keep the receiver's simulated work")
+    parser.add_argument("--log-file", default=os.devnull)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier --output to compare against")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_prefect(args) if args.child == "prefect" else run_receiver(args.child, args)
+        print(json.dumps(result))
+        return
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {result["mode"]: result for result in json.load(f)["results"]}
+
+    results = []
+    print(f"{'mode':<10} {'per s':>10} {'p50 ms':>9} {'p99 ms':>9} {'vs previous':>12}")
+    for mode in args.modes:
+        result = run_mode(mode, args)
+        results.append(result)
+        change = ""
+        if mode in previous:
+            change = f"{result['throughput'] / previous[mode]['throughput'] - 1:+.1%}"
+        print(
+            f"{mode:<10} {result['throughput']:>10,.0f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {change:>12}"
+        )
+
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "child")},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
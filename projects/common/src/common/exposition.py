@@ -0,0 +1,221 @@
+import math
+import struct
+from collections.abc import Callable, Iterable
+
+from prometheus_client import CollectorRegistry
+from prometheus_client import exposition as prometheus_exposition
+from prometheus_client.metrics_core import Metric
+from prometheus_client.samples import Sample
+
+from common.histogram import NativeBuckets
+
+# Prometheus' protobuf exposition format: length-delimited io.prometheus.client.MetricFamily
+# messages. This is the only format that carries native histograms.
+PROTOBUF_CONTENT_TYPE = "application/vnd.google.protobuf; proto=io.prometheus.client.MetricFamily; encoding=delimited"
+
+# io.prometheus.client.MetricType
+_COUNTER, _GAUGE, _SUMMARY, _UNTYPED, _HISTOGRAM, _GAUGE_HISTOGRAM = range(6)
+_TYPES = {
+    "counter": _COUNTER,
+    "gauge": _GAUGE,
+    "info": _GAUGE,
+    "stateset": _GAUGE,
+    "summary": _SUMMARY,
+    "histogram": _HISTOGRAM,
+    "gaugehistogram": _GAUGE_HISTOGRAM,
+}
+# Sample labels that become part of a message rather than identifying the series
+_STRUCTURAL_LABELS = {"histogram": "le", "gaugehistogram": "le", "summary": "quantile"}
+
+
+def _varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _uint(field: int, value: int) -> bytes:
+    return _varint(field << 3) + _varint(value)
+
+
+def _sint(field: int, value: int) -> bytes:
+    return _varint(field << 3) + _varint(_zigzag(value))
+
+
+def _double(field: int, value: float) -> bytes:
+    return _varint(field << 3 | 1) + struct.pack("<d", value)
+
+
+def _message(field: int, payload: bytes) -> bytes:
+    return _varint(field << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _string(field: int, value: str) -> bytes:
+    return _message(field, value.encode("utf-8"))
+
+
+def _timestamp(field: int, seconds: float) -> bytes:
+    whole = math.floor(seconds)
+    return _message(field, _uint(1, whole) + _uint(2, int((seconds - whole) * 1e9)))
+
+
+def _encode_spans(buckets: dict[int, int], span_field: int, delta_field: int) -> bytes:
+    spans = bytearray()
+    deltas = bytearray()
+    previous_key: int | None = None
+    previous_count = 0
+    offset = length = 0
+    for key in sorted(buckets):
+        if previous_key is not None and key == previous_key + 1:
+            length += 1
+        else:
+            if previous_key is not None:
+                spans += _message(span_field, _sint(1, offset) + _uint(2, length))
+            # The first span starts at its bucket key, later spans at the gap after the previous one
+            offset = key if previous_key is None else key - previous_key - 1
+            length = 1
+        deltas += _sint(delta_field, buckets[key] - previous_count)
+        previous_key, previous_count = key, buckets[key]
+    if previous_key is not None:
+        spans += _message(span_field, _sint(1, offset) + _uint(2, length))
+    return bytes(spans + deltas)
+
+
+def _native_fields(native: NativeBuckets) -> bytes:
+    out = _sint(5, native.schema) + _double(6, native.zero_threshold) + _uint(7, native.zero_count)
+    out += _encode_spans(native.negative, 9, 10)
+    out += _encode_spans(native.positive, 12, 13)
+    if not native.positive and not native.negative and not native.zero_threshold and not native.zero_count:
+        # An empty span marks the histogram as native even before anything was observed
+        out += _message(12, _sint(1, 0) + _uint(2, 0))
+    return out
+
+
+def _histogram(samples: list[Sample], native: NativeBuckets | None, count_suffix: str, sum_suffix: str) -> bytes:
+    out = bytearray()
+    buckets = bytearray()
+    for sample in samples:
+        if sample.name.endswith("_bucket"):
+            bound = float(sample.labels["le"])
+            # +Inf is implied by the sample count
+            if bound != math.inf:
+                buckets += _message(3, _uint(1, int(sample.value)) + _double(2, bound))
+        elif sample.name.endswith(count_suffix):
+            out += _uint(1, int(sample.value))
+        elif sample.name.endswith(sum_suffix):
+            out += _double(2, sample.value)
+        elif sample.name.endswith("_created"):
+            out += _timestamp(15, sample.value)
+    out += buckets
+    if native is not None:
+        out += _native_fields(native)
+    return bytes(out)
+
+
+def _metric(family: Metric, labels: dict[str, str], samples: list[Sample]) -> bytes:
+    out = bytearray()
+    for name, value in labels.items():
+        out += _message(1, _string(1, name) + _string(2, value))
+
+    if family.type == "counter":
+        value = created = None
+        for sample in samples:
+            if sample.name.endswith("_created"):
+                created = sample.value
+            else:
+                value = sample.value
+        counter = _double(1, value or 0.0)
+        if created is not None:
+            counter += _timestamp(3, created)
+        out += _message(3, counter)
+    elif family.type in ("histogram", "gaugehistogram"):
+        native = getattr(family, "native", {}).get(frozenset(labels.items()))
+        if family.type == "histogram":
+            out += _message(7, _histogram(samples, native, "_count", "_sum"))
+        else:
+            out += _message(7, _histogram(samples, native, "_gcount", "_gsum"))
+    elif family.type == "summary":
+        summary = bytearray()
+        for sample in samples:
+            if sample.name.endswith("_count"):
+                summary += _uint(1, int(sample.value))
+            elif sample.name.endswith("_sum"):
+                summary += _double(2, sample.value)
+            elif sample.name.endswith("_created"):
+                summary += _timestamp(4, sample.value)
+            elif "quantile" in sample.labels:
+                quantile = float(sample.labels["quantile"])
+                summary += _message(3, _double(1, quantile) + _double(2, sample.value))
+        out += _message(4, bytes(summary))
+    else:
+        field = 2 if _TYPES.get(family.type, _UNTYPED) == _GAUGE else 5
+        out += _message(field, _double(1, samples[-1].value))
+
+    if samples[0].timestamp is not None:
+        out += _uint(6, int(float(samples[0].timestamp) * 1000))
+    return bytes(out)
+
+
+def _family_name(family: Metric) -> str:
+    # The text formats add these suffixes when writing samples, the protobuf format names them
+    if family.type == "counter":
+        return family.name + "_total"
+    if family.type == "info":
+        return family.name + "_info"
+    return family.name
+
+
+def _encode_family(family: Metric) -> Iterable[bytes]:
+    structural = _STRUCTURAL_LABELS.get(family.type)
+    series: dict[frozenset[tuple[str, str]], tuple[dict[str, str], list[Sample]]] = {}
+    for sample in family.samples:
+        labels = {name: value for name, value in sample.labels.items() if name != structural}
+        if family.type == "stateset":
+            # Each state is its own series, named after the family
+            labels = dict(sample.labels)
+        key = frozenset(labels.items())
+        if key not in series:
+            series[key] = (labels, [])
+        series[key][1].append(sample)
+    if not series:
+        return
+
+    message = _string(1, _family_name(family)) + _string(2, family.documentation)
+    message += _uint(3, _TYPES.get(family.type, _UNTYPED))
+    message += b"".join(_message(4, _metric(family, labels, samples)) for labels, samples in series.values())
+    yield _varint(len(message)) + message
+
+
+def generate_protobuf(registry: CollectorRegistry) -> bytes:
+    return b"".join(chunk for family in registry.collect() for chunk in _encode_family(family))
+
+
+def accepts_protobuf(accept: str) -> bool:
+    for media_range in accept.split(","):
+        media, *params = (part.strip() for part in media_range.split(";"))
+        if media != "application/vnd.google.protobuf":
+            continue
+        options = dict(param.split("=", 1) for param in params if "=" in param)
+        if (
+            options.get("proto") == "io.prometheus.client.MetricFamily"
+            and options.get("encoding") == "delimited"
+            and options.get("q", "1") not in ("0", "0.0", "0.00", "0.000")
+        ):
+            return True
+    return False
+
+
+def choose_encoder(accept: str) -> tuple[Callable[[CollectorRegistry], bytes], str]:
+    # Scrapers that can read native histograms ask for protobuf, everything else gets text
+    if accepts_protobuf(accept):
+        return generate_protobuf, PROTOBUF_CONTENT_TYPE
+    return prometheus_exposition.choose_encoder(accept)
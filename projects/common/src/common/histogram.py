@@ -0,0 +1,180 @@
+import math
+import sys
+from bisect import bisect_left
+from collections.abc import Iterable, Sequence
+from threading import Lock
+
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram, values
+from prometheus_client.metrics_core import Metric
+from prometheus_client.samples import Sample
+
+# The Go client's default (2**-128), so in practice only exact zeros land in the zero bucket
+DEFAULT_ZERO_THRESHOLD = 2.938735877055719e-39
+MIN_SCHEMA = -4
+MAX_SCHEMA = 8
+
+# Upper bounds of the buckets within one power of two, as fractions from math.frexp
+_BOUNDS = {schema: [2 ** (i / 2**schema) / 2 for i in range(2**schema)] for schema in range(1, MAX_SCHEMA + 1)}
+
+
+def bucket_key(value: float, schema: int) -> int:
+    # Bucket `key` holds (base**(key - 1), base**key] where base = 2**(2**-schema)
+    frac, exp = math.frexp(value)
+    if schema > 0:
+        bounds = _BOUNDS[schema]
+        return bisect_left(bounds, frac) + (exp - 1) * len(bounds)
+    key = exp - 1 if frac == 0.5 else exp
+    offset = (1 << -schema) - 1
+    return (key + offset) >> -schema
+
+
+class NativeBuckets:
+    """Sparse exponential buckets for one histogram series.
+
+    Buckets are only stored once something lands in them. When more than `max_buckets` are
+    in use the schema is lowered, which halves the resolution by merging neighbouring buckets.
+    """
+
+    __slots__ = ("schema", "zero_threshold", "max_buckets", "zero_count", "positive", "negative")
+
+    def __init__(self, schema: int = 3, zero_threshold: float = DEFAULT_ZERO_THRESHOLD, max_buckets: int = 160):
+        if not MIN_SCHEMA <= schema <= MAX_SCHEMA:
+            raise ValueError(f"Native histogram schema must be between {MIN_SCHEMA} and {MAX_SCHEMA}")
+        self.schema = schema
+        self.zero_threshold = zero_threshold
+        self.max_buckets = max_buckets
+        self.zero_count = 0
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+
+    def observe(self, value: float) -> None:
+        magnitude = abs(value)
+        if magnitude != magnitude:
+            return
+        if magnitude <= self.zero_threshold:
+            self.zero_count += 1
+            return
+        buckets = self.positive if value > 0 else self.negative
+        key = bucket_key(min(magnitude, sys.float_info.max), self.schema)
+        buckets[key] = buckets.get(key, 0) + 1
+        if len(self.positive) + len(self.negative) > self.max_buckets:
+            self._reduce()
+
+    def _reduce(self) -> None:
+        while len(self.positive) + len(self.negative) > self.max_buckets and self.schema > MIN_SCHEMA:
+            self.schema -= 1
+            self.positive = self._merge(self.positive)
+            self.negative = self._merge(self.negative)
+
+    @staticmethod
+    def _merge(buckets: dict[int, int]) -> dict[int, int]:
+        merged: dict[int, int] = {}
+        for key, count in buckets.items():
+            key = (key + 1) >> 1
+            merged[key] = merged.get(key, 0) + count
+        return merged
+
+    def copy(self) -> "NativeBuckets":
+        copy = NativeBuckets.__new__(NativeBuckets)
+        copy.schema = self.schema
+        copy.zero_threshold = self.zero_threshold
+        copy.max_buckets = self.max_buckets
+        copy.zero_count = self.zero_count
+        copy.positive = dict(self.positive)
+        copy.negative = dict(self.negative)
+        return copy
+
+
+class NativeHistogramMetric(Metric):
+    """A histogram family that also carries the native buckets of each series, keyed by labels."""
+
+    def __init__(self, name: str, documentation: str, unit: str = "") -> None:
+        super().__init__(name, documentation, "histogram", unit)
+        self.native: dict[frozenset[tuple[str, str]], NativeBuckets] = {}
+
+
+class NativeHistogram(Histogram):
+    """A Histogram that keeps sparse exponential buckets next to its classic ones.
+
+    The classic buckets are still what the text formats and pushes carry; the native buckets
+    are only exposed through the protobuf format (see `common.exposition`). Native buckets
+    live in process memory, so in multi-process mode only the classic buckets are kept.
+    """
+
+    _native: NativeBuckets | None = None
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        namespace: str = "",
+        subsystem: str = "",
+        unit: str = "",
+        registry: CollectorRegistry | None = REGISTRY,
+        _labelvalues: Sequence[str] | None = None,
+        buckets: Sequence[float | str] = Histogram.DEFAULT_BUCKETS,
+        schema: int = 3,
+        zero_threshold: float = DEFAULT_ZERO_THRESHOLD,
+        max_buckets: int = 160,
+        native: bool = True,
+    ) -> None:
+        self._schema = schema
+        self._zero_threshold = zero_threshold
+        self._max_buckets = max_buckets
+        self._native_enabled = native and not getattr(values.ValueClass, "_multiprocess", False)
+        super().__init__(
+            name,
+            documentation,
+            labelnames=labelnames,
+            namespace=namespace,
+            subsystem=subsystem,
+            unit=unit,
+            registry=registry,
+            _labelvalues=_labelvalues,
+            buckets=buckets,
+        )
+        self._kwargs.update(schema=schema, zero_threshold=zero_threshold, max_buckets=max_buckets, native=native)
+
+    def _metric_init(self) -> None:
+        super()._metric_init()
+        if self._native_enabled:
+            self._native = NativeBuckets(self._schema, self._zero_threshold, self._max_buckets)
+            self._native_lock = Lock()
+
+    def observe(self, amount: float, exemplar: dict[str, str] | None = None) -> None:
+        if self._native is None:
+            return super().observe(amount, exemplar)
+        # Under one lock so that a scrape sees classic and native buckets that agree
+        with self._native_lock:
+            super().observe(amount, exemplar)
+            self._native.observe(amount)
+
+    def _snapshot(self) -> tuple[Iterable[Sample], NativeBuckets | None]:
+        if self._native is None:
+            return self._child_samples(), None
+        with self._native_lock:
+            return self._child_samples(), self._native.copy()
+
+    def collect(self) -> Iterable[Metric]:
+        metric = NativeHistogramMetric(self._name, self._documentation, self._unit)
+        if self._is_parent():
+            with self._lock:
+                children = list(self._metrics.items())
+        else:
+            children = [((), self)]
+        for labelvalues, child in children:
+            labels = dict(zip(self._labelnames, labelvalues))
+            samples, native = child._snapshot()
+            # Newer prometheus_client versions add fields to Sample, so they are read by name
+            for sample in samples:
+                metric.add_sample(
+                    self._name + sample.name,
+                    {**labels, **sample.labels},
+                    sample.value,
+                    sample.timestamp,
+                    sample.exemplar,
+                )
+            if native is not None:
+                metric.native[frozenset(labels.items())] = native
+        return [metric]
@@ -1,22 +1,34 @@
-from collections.abc import Callable
+import atexit
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from datetime import datetime
 import json
 import logging
+import os
 import sys
+import threading
+import time
 import traceback
-from functools import partial, wraps
+import weakref
+from functools import lru_cache, partial
 from sys import stderr
 from types import FrameType
-from typing import TYPE_CHECKING, TextIO, cast
+from typing import TYPE_CHECKING, Any, Literal, TextIO, cast
 
-from datetime import timezone as tz
 from loguru import logger
 from opentelemetry import trace
-from opentelemetry.trace import INVALID_SPAN, INVALID_SPAN_CONTEXT
+from opentelemetry.trace import INVALID_SPAN, INVALID_SPAN_CONTEXT, Span, SpanContext
 
-from common.prom import LOG_TOTAL
+from common.metrics import LOG_DROPPED, log_counter, suppressed_counter
+from common.settings import settings
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional extra, fall back to the stdlib encoder
+    orjson = None  # type: ignore[assignment]
 
 if TYPE_CHECKING:
-    from loguru import Message
+    from loguru import Message, Record
 
 LOGGERS_TO_IGNORE = [
     name
@@ -34,82 +46,509 @@ LOGGERS_TO_IGNORE += [
     "httpx._client",
 ]
 
+OverflowPolicy = Literal["block", "drop_oldest", "drop_newest"]
+
+
+class QueuedWriter:
+    """File-like log destination that hands lines to a background writer thread.
+
+    Lines are kept in a bounded queue and written to the underlying file in batches, so
+    the thread doing the logging never waits on stderr. When the queue is full, `overflow`
+    decides whether to block the caller, discard the oldest queued line or discard the
+    new line. Discarded lines are counted in `dropped` and in the `log_dropped` metric.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        file: TextIO = stderr,
+        maxsize: int = 10_000,
+        overflow: OverflowPolicy = "drop_oldest",
+        batch_size: int = 512,
+        flush_interval: float = 0.2,
+    ) -> None:
+        self.service = service
+        self.file = file
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.batch_size = min(batch_size, maxsize)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue: deque[str] = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._flush_requests = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"log-writer-{service}", daemon=True)
+        self._thread.start()
+
+    def write(self, line: str) -> None:
+        with self._lock:
+            if len(self._queue) >= self.maxsize and not self._closed:
+                if self.overflow == "block":
+                    while len(self._queue) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+                elif self.overflow == "drop_newest":
+                    self._record_drop()
+                    return
+                else:
+                    self._queue.popleft()
+                    self._record_drop()
+            if self._closed:
+                # Once closed, fall back to writing synchronously rather than losing lines
+                self.file.write(line)
+                return
+            self._queue.append(line)
+            if len(self._queue) >= self.batch_size:
+                self._not_empty.notify()
+
+    def flush(self, timeout: float | None = 5.0) -> bool:
+        with self._lock:
+            if not self._thread.is_alive():
+                return not self._queue
+            self._flush_requests += 1
+            self._not_empty.notify()
+            try:
+                return self._drained.wait_for(lambda: not self._queue and not self._in_flight, timeout=timeout)
+            finally:
+                self._flush_requests -= 1
+
+    def close(self, timeout: float | None = 5.0) -> None:
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        self._thread.join(timeout=timeout)
+
+    def _after_fork(self) -> None:
+        # The writer thread isn't copied into a forked child, and the queued lines are the parent's
+        self._queue.clear()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._flush_requests = 0
+        self._thread = threading.Thread(target=self._run, name=f"log-writer-{self.service}", daemon=True)
+        if not self._closed:
+            self._thread.start()
+
+    def _record_drop(self) -> None:
+        self.dropped += 1
+        LOG_DROPPED.labels(service=self.service, policy=self.overflow).inc()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while len(self._queue) < self.batch_size and not self._closed:
+                    if self._flush_requests and self._queue:
+                        break
+                    if not self._not_empty.wait(self.flush_interval):
+                        break
+                if not self._queue:
+                    self._drained.notify_all()
+                    if self._closed:
+                        return
+                    continue
+                batch = list(self._queue)
+                self._queue.clear()
+                self._in_flight = len(batch)
+                self._not_full.notify_all()
+            try:
+                self.file.write("".join(batch))
+                self.file.flush()
+            except Exception:
+                # Nowhere left to report a failing log destination, so just move on
+                pass
+            finally:
+                with self._lock:
+                    self._in_flight = 0
+                    self._drained.notify_all()
+
+
+_writer: QueuedWriter | None = None
+_configured: tuple[str, bool, TextIO] | None = None
+_output: TextIO = sys.stderr
+_rate_limiter: "LogRateLimiter | None" = None
+
+_json_encoder = json.JSONEncoder(skipkeys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _dumps(value: dict[str, Any]) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        except orjson.JSONEncodeError:
+            # orjson is stricter than the stdlib (eg integers above 64 bits), so retry there
+            pass
+    return _json_encoder.encode(value)
+
+
+class LogEncoder:
+    """Serializes loguru records for a single service.
+
+    The service field is encoded once up front, the timestamp prefix is reused for every
+    record within the same second and `file:line` caller strings are cached, so the only
+    per-record work left is building the variable fields and a single encode call.
+    """
+
+    def __init__(self, service: str, json_format: bool = True, max_callers: int = 4096) -> None:
+        self.service = service
+        self.json_format = json_format
+        self.max_callers = max_callers
+        if json_format:
+            # Everything after the opening brace of the variable fields is appended to this
+            self._prefix = _dumps({"service": service})[:-1] + ","
+        else:
+            self._prefix = f"service={service} "
+        self._callers: dict[tuple[str, int], str] = {}
+        self._second: tuple[int, str] = (0, "")
+
+    def fields(self, record: "Record", ctx: SpanContext = INVALID_SPAN_CONTEXT) -> dict[str, Any]:
+        fields: dict[str, Any] = {
+            "time": self._format_time(record["time"]),
+            "level": record["level"].name,
+            "caller": self._caller(record["file"].name, record["line"]),
+        }
+        exception = record["exception"]
+        if exception is not None:
+            type, value, tb = exception
+            if type is not None:
+                fields["error_type"] = type.__name__
+            if value is not None:
+                fields["error_message"] = str(value)
+            if tb is not None:
+                fields["error_traceback"] = "".join(traceback.format_tb(tb))
+        extra = record["extra"]
+        if extra:
+            # A "service" in extra overrides the encoder's, see `encode`
+            fields |= extra
+
+        # This logic is taken from opentelemetry-instrumentation-logging
+        # opentelemetry.instrumentation.logging.__init__.py:111
+        if ctx != INVALID_SPAN_CONTEXT:
+            fields["trace_id"] = format(ctx.trace_id, "016x")
+            fields["span_id"] = format(ctx.span_id, "032x")
+
+        # Ensure message is the last element
+        fields["message"] = fields.pop("message", record["message"])
+        return fields
+
+    def encode(self, fields: dict[str, Any]) -> str:
+        if "service" in fields:
+            # Overridden by the record, so the precomputed prefix doesn't apply
+            fields = {"service": fields["service"], **fields}
+            if self.json_format:
+                return _dumps(fields)
+            return "".join([f"{key}={value} " for key, value in fields.items()])
+        if self.json_format:
+            return self._prefix + _dumps(fields)[1:]
+        return self._prefix + "".join([f"{key}={value} " for key, value in fields.items()])
+
+    def _format_time(self, value: datetime) -> str:
+        # Matches value.astimezone(timezone.utc).isoformat(timespec="milliseconds")
+        microsecond = value.microsecond
+        second = round(value.timestamp() - microsecond / 1e6)
+        cached_second, prefix = self._second
+        if second != cached_second:
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+            self._second = (second, prefix)
+        return f"{prefix}.{microsecond // 1000:03d}+00:00"
+
+    def _caller(self, file: str, line: int) -> str:
+        key = (file, line)
+        caller = self._callers.get(key)
+        if caller is None:
+            if len(self._callers) >= self.max_callers:
+                self._callers.clear()
+            caller = self._callers[key] = f"{file}:{line}"
+        return caller
+
+
+@lru_cache
+def get_encoder(service: str, json_format: bool = True) -> LogEncoder:
+    return LogEncoder(service, json_format=json_format)
+
+
+class SpanEventPolicy:
+    """Decides which log records are copied onto the active span as "log" events.
+
+    Chatty flows would otherwise grow a span by one event per log line until it ends, so
+    records below `min_level` are skipped, each span receives at most `max_events` log
+    events (the rest are counted in its `log.events_dropped` attribute) and string values
+    can be trimmed to `max_value_length` characters.
+    """
+
+    def __init__(
+        self,
+        min_level: str = "TRACE",
+        max_events: int | None = 128,
+        max_value_length: int | None = None,
+    ) -> None:
+        self.min_level = logger.level(min_level).no
+        self.max_events = max_events
+        self.max_value_length = max_value_length
+        self._counts: weakref.WeakKeyDictionary[Span, int] = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "SpanEventPolicy":
+        return cls(
+            min_level=settings.log_span_event_level,
+            max_events=settings.log_span_event_limit,
+            max_value_length=settings.log_span_event_value_length,
+        )
+
+    def mirror(self, span: Span, service: str, record: "Record", fields: dict[str, Any]) -> None:
+        if record["level"].no < self.min_level or not span.is_recording():
+            return
+        if self.max_events is not None:
+            with self._lock:
+                count = self._counts.get(span, 0) + 1
+                self._counts[span] = count
+            if count > self.max_events:
+                span.set_attribute("log.events_dropped", count - self.max_events)
+                return
+        span.add_event("log", self.attributes(service, fields), timestamp=int(record["time"].timestamp() * 1e9))
+
+    def attributes(self, service: str, fields: dict[str, Any]) -> dict[str, Any]:
+        # Span attributes only accept primitives, so stringify anything else (eg exceptions in extra)
+        limit = self.max_value_length
+        attributes: dict[str, Any] = {"service": service}
+        for key, value in fields.items():
+            if not isinstance(value, (str, bool, int, float)):
+                value = str(value)
+            if limit is not None and isinstance(value, str) and len(value) > limit:
+                value = value[:limit] + "..."
+            attributes[key] = value
+        return attributes
+
+
+@lru_cache
+def get_span_event_policy() -> SpanEventPolicy:
+    return SpanEventPolicy.from_settings()
+
 
 def sink_serializer(
     service: str,
     message: "Message",
-    file: TextIO = stderr,
+    file: TextIO | QueuedWriter = stderr,
     json_format: bool = True,
+    encoder: LogEncoder | None = None,
+    span_events: SpanEventPolicy | None = None,
 ) -> None:
     record = message.record
-    level = record["level"].name
-    simplified = {
-        "service": service,
-        "time": record["time"].astimezone(tz.utc).isoformat(timespec="milliseconds"),
-        "level": level,
-        "caller": f"{record['file'].name}:{record['line']}",
-        "message": record["message"],
-        # "name": record["name"],
-        # "module": record["module"],
-    }
-    LOG_TOTAL.labels(service=service, level=level).inc()
-    if "exception" in record:
-        vals = record["exception"]
-        if vals is not None:
-            type, value, tb = record["exception"]  # type: ignore
-            if type is not None:
-                simplified["error_type"] = type.__name__  # type: ignore
-            if value is not None:
-                simplified["error_message"] = str(value)
-            if tb is not None:
-                simplified["error_traceback"] = "".join(traceback.format_tb(tb))
-    if "extra" in record:
-        simplified |= record["extra"]
-
-    # ensure exceptions that have been added are jsonable
-    for key, value in simplified.items():
-        if isinstance(value, Exception):
-            simplified[key] = str(value)
+    log_counter(service, record["level"].name).inc()
+    if encoder is None:
+        encoder = get_encoder(service, json_format)
+    if span_events is None:
+        span_events = get_span_event_policy()
 
-    # This logic is taken from opentelemetry-instrumentation-logging
-    # opentelemetry.instrumentation.logging.__init__.py:111
     span = trace.get_current_span()
+    ctx = span.get_span_context() if span != INVALID_SPAN else INVALID_SPAN_CONTEXT
+    fields = encoder.fields(record, ctx)
+    serialized = encoder.encode(fields)
+
     if span != INVALID_SPAN:
-        ctx = span.get_span_context()
-        if ctx != INVALID_SPAN_CONTEXT:
-            # simplified["otelServiceName"] = service
-            simplified["trace_id"] = format(ctx.trace_id, "016x")
-            simplified["span_id"] = format(ctx.span_id, "032x")
+        span_events.mirror(span, service, record, fields)
+    file.write(serialized + "\n")
 
-    # Ensure message is the last element
-    simplified["message"] = simplified.pop("message")
 
-    if json_format:
-        serialized = json.dumps(simplified, skipkeys=True)
-    else:
-        serialized = ""
-        for key, value in simplified.items():
-            serialized += f"{key}={value} "
+class _CallSite:
+    __slots__ = ("tokens", "updated", "suppressed", "last")
 
-    if span != INVALID_SPAN:
-        span.add_event("log", simplified, timestamp=int(record["time"].timestamp() * 1e9))
-    print(serialized, file=file)
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+        self.suppressed = 0
+        # (level, file, line, function, name, module, message) of the last suppressed record
+        self.last: tuple[str, Any, int, str, str | None, str, str] | None = None
 
 
-class InterceptHandler(logging.Handler):
-    def emit(self, record: logging.LogRecord) -> None:
-        if record.name in LOGGERS_TO_IGNORE:
-            return
+class LogRateLimiter:
+    """A loguru filter that stops any one call site from flooding the logs.
+
+    Each (file, line, level) gets a token bucket: `burst` lines straight away, then `rate`
+    lines per second. As messages are mostly f-strings, the call site is what identifies the
+    message template. Suppressed lines are counted in log_suppressed and reported as one
+    summary record per call site every `summary_interval` seconds (from a background thread,
+    so a process that went quiet still reports them), when the call site is pushed out of the
+    `max_keys` most recently used ones, or when `flush` is called. `close` stops the thread.
+    """
+
+    def __init__(
+        self, service: str, rate: float, burst: int, max_keys: int = 1024, summary_interval: float = 10.0
+    ) -> None:
+        self.service = service
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.summary_interval = summary_interval
+        self._sites: OrderedDict[tuple[str, int, int], _CallSite] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-rate-summaries", daemon=True)
+        self._thread.start()
+
+    def __call__(self, record: "Record") -> bool:
+        # Summary records are logged from inside this filter and must not be limited themselves
+        if getattr(self._local, "summarising", False):
+            return True
+        now = time.monotonic()
+        key = (record["file"].path, record["line"], record["level"].no)
+        summaries = []
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = _CallSite(self.burst, now)
+                if len(self._sites) > self.max_keys:
+                    _, evicted = self._sites.popitem(last=False)
+                    summaries += self._take(evicted)
+            else:
+                self._sites.move_to_end(key)
+                site.tokens = min(self.burst, site.tokens + (now - site.updated) * self.rate)
+                site.updated = now
+
+            allowed = site.tokens >= 1
+            if allowed:
+                site.tokens -= 1
+            else:
+                site.suppressed += 1
+                site.last = (
+                    record["level"].name,
+                    record["file"],
+                    record["line"],
+                    record["function"],
+                    record["name"],
+                    record["module"],
+                    record["message"],
+                )
+
+        if not allowed:
+            suppressed_counter(self.service, record["level"].name).inc()
+        if summaries:
+            self._summarise(summaries)
+        return allowed
+
+    def flush(self) -> None:
+        with self._lock:
+            summaries = [summary for site in self._sites.values() for summary in self._take(site)]
+        self._summarise(summaries)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.summary_interval):
+            self.flush()
+
+    def _after_fork(self) -> None:
+        # As for QueuedWriter, the summary thread and the suppressed counts stay with the parent
+        self._sites.clear()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="log-rate-summaries", daemon=True)
+        if not self._stop.is_set():
+            self._thread.start()
+
+    @staticmethod
+    def _take(site: _CallSite) -> list[tuple[int, tuple]]:
+        if not site.suppressed or site.last is None:
+            return []
+        summary = (site.suppressed, site.last)
+        site.suppressed = 0
+        site.last = None
+        return [summary]
+
+    def _summarise(self, summaries: list[tuple[int, tuple]]) -> None:
+        self._local.summarising = True
         try:
-            level = logger.level(record.levelname).name
-        except ValueError:
-            level = str(record.levelno)
+            for count, (level, file, line, function, name, module, message) in summaries:
+
+                def caller(record: "Record") -> None:
+                    record.update(file=file, line=line, function=function, name=name, module=module)  # noqa: B023
+
+                logger.patch(caller).bind(suppressed=count).log(
+                    level, "Suppressed {} similar log lines, the last was: {}", count, message
+                )
+        finally:
+            self._local.summarising = False
+
 
-        frame, depth = logging.currentframe(), 1
-        while frame.f_code.co_filename in (logging.__file__, __file__):  # noqa: WPS609
-            frame = cast(FrameType, frame.f_back)
+# LOGGERS_TO_IGNORE as of the last configure_logging, which also clears _is_ignored's cache
+_ignored_loggers = frozenset(LOGGERS_TO_IGNORE)
+_LOGGING_FILES = (logging.__file__, __file__)
+
+
+@lru_cache(maxsize=4096)
+def _is_ignored(name: str) -> bool:
+    # Child loggers of an ignored logger are ignored too, so "uvicorn" covers "uvicorn.access"
+    while name not in _ignored_loggers:
+        if "." not in name:
+            return False
+        name = name.rpartition(".")[0]
+    return True
+
+
+@lru_cache(maxsize=256)
+def _loguru_level(levelname: str, levelno: int) -> str | int:
+    try:
+        return logger.level(levelname).name
+    except ValueError:
+        return levelno
+
+
+class InterceptHandler(logging.Handler):
+    """Sends stdlib logging records to loguru, attributed to the code that logged them.
+
+    Everything that can be is cached: whether a logger is ignored, the loguru level of each
+    stdlib level and, by code location, how many frames up the caller is. Records below the
+    handler's level never reach `emit`, so set it to the lowest level the sinks accept.
+    """
+
+    def __init__(self, level: int = logging.NOTSET) -> None:
+        super().__init__(level)
+        self._depths: dict[tuple[str, int], int] = {}
+        self._loggers: dict[int, Any] = {}
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # loguru is thread safe, so this skips the handler lock that logging.Handler takes
+        if _is_ignored(record.name) or not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def _depth(self, record: logging.LogRecord) -> int:
+        # Number of frames from emit up to the caller, which is what opt(depth=...) expects
+        key = (record.pathname, record.lineno)
+        depth = self._depths.get(key)
+        if depth is not None:
+            try:
+                if sys._getframe(depth + 2).f_code.co_filename == record.pathname:
+                    return depth
+            except ValueError:
+                pass
+        frame, depth = cast(FrameType, sys._getframe(2)), 0
+        while frame.f_back is not None and frame.f_code.co_filename in _LOGGING_FILES:
+            frame = frame.f_back
             depth += 1
-        logger_with_opts = logger.opt(depth=depth, exception=record.exc_info)
+        self._depths[key] = depth
+        return depth
+
+    def emit(self, record: logging.LogRecord) -> None:
+        level = _loguru_level(record.levelname, record.levelno)
+        depth = self._depth(record) + 1
+        if record.exc_info:
+            logger_with_opts = logger.opt(depth=depth, exception=record.exc_info)
+        else:
+            logger_with_opts = self._loggers.get(depth)
+            if logger_with_opts is None:
+                logger_with_opts = self._loggers[depth] = logger.opt(depth=depth)
         try:
             logger_with_opts.log(level, "{}", record.getMessage())
         except Exception as e:
@@ -117,38 +556,170 @@ class InterceptHandler(logging.Handler):
             logger_with_opts.warning("Exception logging the following native logger message: {}, {!r}", safe_msg, e)
 
 
-def configure_logging(service: str) -> None:
+def configure_logging(
+    service: str, queued: bool | None = None, force: bool = False, file: TextIO | None = None
+) -> None:
+    # Flows call this on every run, so repeat calls with the same arguments are a no-op.
+    # Without a file, logs keep going wherever they were last sent (stderr by default).
+    global _writer, _configured, _output, _rate_limiter, _ignored_loggers
+    ignored = frozenset(LOGGERS_TO_IGNORE)
+    if ignored != _ignored_loggers:
+        _ignored_loggers = ignored
+        _is_ignored.cache_clear()
+    if queued is None:
+        queued = settings.log_queue
+    if file is None:
+        file = _output
+    if not force and _configured == (service, queued, file):
+        return
+
     for name in LOGGERS_TO_IGNORE:
         logga = logging.getLogger(name)
         logga.handlers = []
 
-    logging.basicConfig(handlers=[InterceptHandler()], level=logging.INFO)
+    level = logger.level(settings.log_level).no
+    logging.basicConfig(handlers=[InterceptHandler()])
+    # basicConfig does nothing once the root logger has handlers, so the level is set either way
+    logging.root.setLevel(logger.level(settings.stdlib_log_level).no)
+    for handler in logging.root.handlers:
+        if isinstance(handler, InterceptHandler):
+            handler.setLevel(level)
+    if _rate_limiter is not None:
+        _rate_limiter.close()
     logger.remove()
-    logger.add(sink=partial(sink_serializer, service, file=sys.stderr))
+    if _writer is not None:
+        _writer.close()
+        _writer = None
 
+    _output = file
+    output: TextIO | QueuedWriter = file
+    if queued:
+        _writer = output = QueuedWriter(
+            service,
+            file=file,
+            maxsize=settings.log_queue_size,
+            overflow=settings.log_queue_overflow,
+            batch_size=settings.log_queue_batch_size,
+            flush_interval=settings.log_flush_interval,
+        )
+    sink = partial(
+        sink_serializer,
+        service,
+        file=output,
+        encoder=get_encoder(service),
+        span_events=SpanEventPolicy.from_settings(),
+    )
+    _rate_limiter = None
+    if settings.log_rate_limit is not None:
+        _rate_limiter = LogRateLimiter(
+            service,
+            rate=settings.log_rate_limit,
+            burst=settings.log_rate_burst,
+            max_keys=settings.log_rate_max_keys,
+            summary_interval=settings.log_rate_summary_interval,
+        )
+    logger.add(sink=sink, level=level, filter=_rate_limiter)
+    _configured = (service, queued, file)
 
-def get_logger() -> logging.Logger:
-    extra: dict[str, str] = {}
-    try:
-        from prefect import get_run_logger
 
-        prefect_logger = get_run_logger()
-        extra = getattr(prefect_logger, "extra")
+def flush_logging(timeout: float | None = 5.0) -> None:
+    if _rate_limiter is not None:
+        _rate_limiter.flush()
+    if _writer is not None:
+        _writer.flush(timeout=timeout)
 
-    except Exception:
-        return logger  # type: ignore
 
-    def intercept_prefect_log(func: Callable, level: str):
-        @wraps(func)
-        def wrapper(msg, *args, **kwargs):
-            # record = func(msg, *args, **kwargs)
-            logger.bind(**extra).log(level.upper(), msg)
+atexit.register(flush_logging)
+
 
-        return wrapper
+def _after_fork() -> None:
+    # Forked children (eg batched_map's process pool) inherit the writer and the rate limiter,
+    # but not their threads
+    if _writer is not None:
+        _writer._after_fork()
+    if _rate_limiter is not None:
+        _rate_limiter._after_fork()
 
-    # Create an intercept for the warning, error, and exception functions
-    for level in ["debug", "info", "warning", "error", "exception"]:
-        fn = getattr(prefect_logger, level)
-        setattr(prefect_logger, level, intercept_prefect_log(fn, level))
 
-    return prefect_logger  # type: ignore
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class RunLogger(logging.LoggerAdapter):
+    """The logger `get_logger` hands out inside a Prefect run.
+
+    It keeps the stdlib logger interface, including %-style message arguments, `exc_info`,
+    `stacklevel` and `extra`, but writes to loguru through a logger bound once to the run's
+    details. Messages are formatted as LogRecord.getMessage does, and one that can't be is
+    logged as a warning with the error instead of raising in the caller, like InterceptHandler.
+    """
+
+    def __init__(self, run_logger: logging.Logger | logging.LoggerAdapter, extra: dict[str, Any]) -> None:
+        super().__init__(run_logger, extra)
+        self._bound = logger.bind(**extra)
+
+    def log(  # type: ignore[override]
+        self,
+        level: int | str,
+        msg: object,
+        *args: object,
+        exc_info: Any = None,
+        stacklevel: int = 1,
+        extra: Mapping[str, object] | None = None,
+        **kwargs: Any,
+    ) -> None:
+        # LoggerAdapter's level methods (debug, info, exception, ...) all come through here
+        if isinstance(level, int):
+            level = _loguru_level(logging.getLevelName(level), level)
+        bound = self._bound.bind(**extra) if extra else self._bound
+        # opt(depth=0) is this method, and the caller is above any LoggerAdapter method in between
+        frame, depth = cast(FrameType, sys._getframe(1)), 1
+        while frame.f_back is not None and frame.f_code.co_filename == logging.__file__:
+            frame, depth = frame.f_back, depth + 1
+        bound = bound.opt(depth=depth + stacklevel - 1, exception=exc_info or None)
+        # A single non-empty mapping is used for %(name)s style arguments, as in LogRecord
+        if len(args) == 1 and isinstance(args[0], Mapping) and args[0]:
+            args = args[0]  # type: ignore[assignment]
+        try:
+            message = str(msg) % args if args else str(msg)
+        except Exception as e:
+            bound.warning("Exception logging the following native logger message: {}, {!r}", msg, e)
+            return
+        bound.log(level, "{}", message)
+
+
+# Run loggers of the most recent runs, keyed by task run id, or flow run id outside of a task
+_run_loggers: OrderedDict[Any, RunLogger] = OrderedDict()
+_RUN_LOGGERS_SIZE = 1024
+_run_loggers_lock = threading.Lock()
+
+
+def get_logger() -> logging.Logger:
+    try:
+        from prefect.context import FlowRunContext, TaskRunContext
+    except ImportError:
+        return logger  # type: ignore
+
+    task_run_context = TaskRunContext.get()
+    if task_run_context is not None:
+        run_id = task_run_context.task_run.id
+    else:
+        flow_run_context = FlowRunContext.get()
+        if flow_run_context is None or flow_run_context.flow_run is None:
+            return logger  # type: ignore
+        run_id = flow_run_context.flow_run.id
+
+    run_logger = _run_loggers.get(run_id)
+    if run_logger is None:
+        try:
+            from prefect import get_run_logger
+
+            prefect_logger = get_run_logger()
+            run_logger = RunLogger(prefect_logger, getattr(prefect_logger, "extra"))
+        except Exception:
+            return logger  # type: ignore
+        with _run_loggers_lock:
+            _run_loggers[run_id] = run_logger
+            if len(_run_loggers) > _RUN_LOGGERS_SIZE:
+                _run_loggers.popitem(last=False)
+    return run_logger  # type: ignore
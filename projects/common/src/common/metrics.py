@@ -0,0 +1,375 @@
+import math
+import threading
+import time
+from collections.abc import Callable
+from threading import Lock
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.values import ValueClass
+
+from common.histogram import NativeHistogram
+from common.settings import settings
+
+_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    1.5,
+    2.0,
+    2.5,
+    3.0,
+    3.5,
+    4.0,
+    4.5,
+    5.0,
+    5.5,
+    6.0,
+    6.5,
+    7.0,
+    7.5,
+    10.0,
+    float("inf"),
+)
+
+INFO = Gauge("service", "App Name", labelnames=["service"], multiprocess_mode="max")
+INVOCATIONS = Counter(
+    "function_invocations",
+    "Counting the number of function invocations",
+    labelnames=["service", "function"],
+)
+INVOCATION_RESPONSES = Counter(
+    "function_invocation_responses",
+    "Counting the number of function invocations",
+    labelnames=["service", "function"],
+)
+
+INVOCATIONS_PROCESSING_TIME = NativeHistogram(
+    "function_invocation_time",
+    "Histogram of function invocation processing time by path (in seconds)",
+    labelnames=["service", "function"],
+    buckets=_BUCKETS,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=settings.native_histograms,
+)
+EXCEPTIONS = Counter(
+    "exceptions",
+    "Total count of exceptions raised by function and exception type",
+    labelnames=["service", "function"],
+)
+INVOCATIONS_IN_PROGRESS = Gauge(
+    "function_invocations_in_progress",
+    "Gauge of function invocations currently being processed",
+    labelnames=["service", "function"],
+    multiprocess_mode="livesum",
+)
+# In multi-process mode each worker only counts its own errors, so workers write plain counts,
+# livesum adds them up and LiveMultiProcessCollector subtracts the threshold from the total
+ACCUMULATED_EXCEPTIONS = Gauge(
+    "accumulated_exceptions",
+    "Number of route errors in the configured time period. Will be negative if no issue. Zero or greater for errors.",
+    labelnames=["service", "function"],
+    multiprocess_mode="livesum",
+)
+LOG_TOTAL = Counter(
+    "log_total",
+    "Total number of log messages",
+    labelnames=["service", "level"],
+)
+LOG_DROPPED = Counter(
+    "log_dropped",
+    "Total number of log messages dropped because the log queue was full",
+    labelnames=["service", "policy"],
+)
+SPAN_QUEUE_DEPTH = Gauge(
+    "span_export_queue_depth",
+    "Number of finished spans waiting in the batch span processor queue",
+    labelnames=["service"],
+    multiprocess_mode="livesum",
+)
+SPANS_EXPORTED = Counter(
+    "spans_exported",
+    "Total number of spans handed to the span exporter by export result",
+    labelnames=["service", "result"],
+)
+SPANS_DROPPED = Counter(
+    "spans_dropped",
+    "Total number of spans dropped because the span export queue was full",
+    labelnames=["service"],
+)
+SPAN_EXPORT_TIME = Histogram(
+    "span_export_time",
+    "Histogram of span export batch latency (in seconds)",
+    labelnames=["service"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")),
+)
+LOG_SUPPRESSED = Counter(
+    "log_suppressed",
+    "Total number of log messages suppressed by the per call site rate limit",
+    labelnames=["service", "level"],
+)
+LABEL_OVERFLOW = Counter(
+    "label_overflow",
+    "Total number of observations recorded under the overflow label value because of the label limit",
+    labelnames=["service", "label"],
+)
+SPOOL_BYTES = Gauge(
+    "spool_bytes",
+    "Size on disk of the telemetry spooled because it could not be sent (in bytes)",
+    labelnames=["service", "spool"],
+    multiprocess_mode="max",
+)
+SPOOL_REPLAY_LAG = Gauge(
+    "spool_replay_lag",
+    "Age of the oldest spooled record still waiting to be replayed (in seconds)",
+    labelnames=["service", "spool"],
+    multiprocess_mode="max",
+)
+SPOOL_RECORDS = Counter(
+    "spool_records",
+    "Total number of spooled records by action (spooled, replayed or evicted)",
+    labelnames=["service", "spool", "action"],
+)
+SAMPLED_TRACES = Counter(
+    "sampled_traces",
+    "Total number of traces seen by the tail sampler by decision (error, latency, ratio or dropped)",
+    labelnames=["service", "decision"],
+)
+SAMPLING_BUFFERED_SPANS = Gauge(
+    "sampling_buffered_spans",
+    "Number of spans held by the tail sampler waiting for a decision on their trace",
+    labelnames=["service"],
+    multiprocess_mode="livesum",
+)
+
+
+OVERFLOW_LABEL = "__overflow__"
+# Whether metric values live in the files under PROMETHEUS_MULTIPROC_DIR
+MULTIPROCESS: bool = getattr(ValueClass, "_multiprocess", False)
+
+
+class CardinalityLimiter:
+    """Caps how many distinct label sets a group of metrics creates series for.
+
+    `admit` refuses label sets beyond `limit`, and the caller records those observations under
+    OVERFLOW_LABEL instead (counting them in a label_overflow counter). Label sets that go unused
+    for `ttl` seconds are handed to `on_evict` so their series can be removed, which frees
+    their place under the limit. In multi-process mode (PROMETHEUS_MULTIPROC_DIR) removed series
+    would stay in the workers' files and keep being exported, so nothing is evicted there and
+    only the limit applies.
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        ttl: float | None,
+        on_evict: Callable[[tuple[str, ...]], None],
+    ) -> None:
+        self.limit = limit
+        self.ttl = None if MULTIPROCESS else ttl
+        self.on_evict = on_evict
+        self._last_used: dict[tuple[str, ...], float] = {}
+        self._lock = Lock()
+        self._sweeping = False
+        self._next_sweep = time.monotonic() + self.ttl / 4 if self.ttl else math.inf
+
+    def admit(self, labels: tuple[str, ...]) -> bool:
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        # Known label sets only refresh their timestamp, which needs no lock. A sweep that starts
+        # after the timestamp was refreshed sees it as recent, while one already running could
+        # have picked it to evict, so then it is checked again under the lock once the sweep is done.
+        if labels in self._last_used:
+            self._last_used[labels] = now
+            if not self._sweeping:
+                return True
+        with self._lock:
+            if labels not in self._last_used and len(self._last_used) >= self.limit:
+                return False
+            self._last_used[labels] = now
+            return True
+
+    def _sweep(self, now: float) -> None:
+        ttl = self.ttl or math.inf
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + ttl / 4
+            self._sweeping = True
+            try:
+                expired = [labels for labels, last_used in self._last_used.items() if now - last_used > ttl]
+                for labels in expired:
+                    del self._last_used[labels]
+                    self.on_evict(labels)
+            finally:
+                self._sweeping = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._last_used.clear()
+
+
+def remove_series(labels: tuple[str, ...], *metrics: Counter | Gauge | Histogram) -> None:
+    # Removes every child of `metrics` whose label values start with `labels`
+    for metric in metrics:
+        with metric._lock:
+            children = [values for values in metric._metrics if values[: len(labels)] == labels]
+        for values in children:
+            try:
+                metric.remove(*values)
+            except KeyError:
+                pass
+
+
+class ErrorWindow:
+    """Counts errors over the last `window` seconds and keeps `gauge` at that count minus `threshold`.
+
+    The window is a ring of `buckets` time buckets, so memory is fixed and recording an error
+    or moving the window forward touches at most `buckets` slots however many errors there are.
+    """
+
+    __slots__ = ("gauge", "threshold", "width", "counts", "epoch", "total", "_lock")
+
+    def __init__(self, gauge: Gauge, window: float = 300.0, buckets: int = 60, threshold: int = 1) -> None:
+        self.gauge = gauge
+        self.threshold = threshold
+        self.width = window / buckets
+        self.counts = [0] * buckets
+        self.epoch = int(time.monotonic() / self.width)
+        self.total = 0
+        self._lock = Lock()
+        gauge.set(-threshold)
+
+    def record(self, count: int = 1, now: float | None = None) -> None:
+        epoch = int((time.monotonic() if now is None else now) / self.width)
+        with self._lock:
+            self._advance(epoch)
+            self.counts[epoch % len(self.counts)] += count
+            self.total += count
+            self.gauge.set(self.total - self.threshold)
+
+    def refresh(self, now: float | None = None) -> None:
+        epoch = int((time.monotonic() if now is None else now) / self.width)
+        with self._lock:
+            if epoch > self.epoch:
+                self._advance(epoch)
+                self.gauge.set(self.total - self.threshold)
+
+    def _advance(self, epoch: int) -> None:
+        # Empties the buckets that fell out of the window since the last call
+        for expired in range(self.epoch + 1, min(epoch, self.epoch + len(self.counts)) + 1):
+            slot = expired % len(self.counts)
+            self.total -= self.counts[slot]
+            self.counts[slot] = 0
+        self.epoch = max(self.epoch, epoch)
+
+
+_error_windows: dict[tuple[str, ...], ErrorWindow] = {}
+_error_window_refresher: threading.Thread | None = None
+
+
+def _refresh_error_windows(interval: float) -> None:
+    # Without new errors nothing else would let the gauges fall back as errors age out
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        for window in list(_error_windows.values()):
+            window.refresh(now)
+
+
+def error_window(service: str, function: str) -> ErrorWindow:
+    global _error_window_refresher
+    window = _error_windows.get((service, function))
+    if window is None:
+        window = _error_windows[(service, function)] = ErrorWindow(
+            ACCUMULATED_EXCEPTIONS.labels(service=service, function=function),
+            window=settings.accumulated_exceptions_window,
+            buckets=settings.accumulated_exceptions_buckets,
+            threshold=0 if MULTIPROCESS else settings.accumulated_exceptions_threshold,
+        )
+        if _error_window_refresher is None:
+            _error_window_refresher = threading.Thread(
+                target=_refresh_error_windows, args=(window.width,), name="error-windows", daemon=True
+            )
+            _error_window_refresher.start()
+    return window
+
+
+class RouteMetrics:
+    """The metric children for one (service, function) pair, bound once and then reused.
+
+    Calling `.labels()` takes the parent metric's lock and builds a label tuple every time,
+    which adds up when the middleware touches five metrics on every request.
+    """
+
+    __slots__ = ("invocations", "responses", "processing_time", "exceptions", "in_progress", "errors")
+
+    def __init__(self, service: str, function: str) -> None:
+        self.invocations = INVOCATIONS.labels(service=service, function=function)
+        self.responses = INVOCATION_RESPONSES.labels(service=service, function=function)
+        self.processing_time = INVOCATIONS_PROCESSING_TIME.labels(service=service, function=function)
+        self.exceptions = EXCEPTIONS.labels(service=service, function=function)
+        self.in_progress = INVOCATIONS_IN_PROGRESS.labels(service=service, function=function)
+        self.errors = error_window(service, function)
+
+
+_route_metrics: dict[tuple[str, ...], RouteMetrics] = {}
+_log_counters: dict[tuple[str, str], Counter] = {}
+_suppressed_counters: dict[tuple[str, str], Counter] = {}
+
+
+def _evict_route(labels: tuple[str, ...]) -> None:
+    _route_metrics.pop(labels, None)
+    _error_windows.pop(labels, None)
+    remove_series(
+        labels,
+        INVOCATIONS,
+        INVOCATION_RESPONSES,
+        INVOCATIONS_PROCESSING_TIME,
+        EXCEPTIONS,
+        INVOCATIONS_IN_PROGRESS,
+        ACCUMULATED_EXCEPTIONS,
+    )
+
+
+route_limiter = CardinalityLimiter(settings.metric_label_limit, settings.metric_label_ttl, on_evict=_evict_route)
+
+
+def route_metrics(service: str, function: str) -> RouteMetrics:
+    if not route_limiter.admit((service, function)):
+        LABEL_OVERFLOW.labels(service=service, label="function").inc()
+        function = OVERFLOW_LABEL
+    metrics = _route_metrics.get((service, function))
+    if metrics is None:
+        metrics = _route_metrics[(service, function)] = RouteMetrics(service, function)
+    return metrics
+
+
+def log_counter(service: str, level: str) -> Counter:
+    counter = _log_counters.get((service, level))
+    if counter is None:
+        counter = _log_counters[(service, level)] = LOG_TOTAL.labels(service=service, level=level)
+    return counter
+
+
+def suppressed_counter(service: str, level: str) -> Counter:
+    counter = _suppressed_counters.get((service, level))
+    if counter is None:
+        counter = _suppressed_counters[(service, level)] = LOG_SUPPRESSED.labels(service=service, level=level)
+    return counter
+
+
+def clear_bound_metrics() -> None:
+    route_limiter.clear()
+    _route_metrics.clear()
+    _error_windows.clear()
+    _log_counters.clear()
+    _suppressed_counters.clear()
@@ -1,17 +1,44 @@
-from collections.abc import Callable
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager
+import contextvars
 from functools import wraps
+import importlib
+import inspect
+import itertools
+import os
+from random import random
+import threading
 import time
-from common.log import configure_logging
+from typing import TYPE_CHECKING, Any, Literal
+from loguru import logger
+from common.log import configure_logging, flush_logging
+from common.profiling import SamplingProfiler
+from common.resources import measure
 from common.tracing import get_tracer
-from opentelemetry.trace import SpanKind, StatusCode
+from opentelemetry import trace
+from opentelemetry.trace import Span, SpanKind, StatusCode, Tracer, format_trace_id
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
 from common.settings import settings
-from prefect import flow, task, Flow
-from prefect.runtime.flow_run import get_flow_name
 
-from prefect.client.schemas.objects import FlowRun, State, StateType
+# Prefect is slow to import, so it is only imported once a task or flow is decorated
+if TYPE_CHECKING:
+    from prefect import Flow
+    from prefect.client.schemas.objects import FlowRun, State
 
 
-from prometheus_client import CollectorRegistry, Counter, Histogram, push_to_gateway
+from common.histogram import NativeHistogram
+from common.metrics import OVERFLOW_LABEL, CardinalityLimiter, remove_series
+from common.push import get_publisher
+from prometheus_client import CollectorRegistry, Counter, Histogram
 
 initial_registry = CollectorRegistry()
 interim_registry = CollectorRegistry()
@@ -50,6 +77,12 @@ _BUCKETS = (
     float("inf"),
 )
 
+# Flow metrics are pushed, and only protobuf pushes carry native buckets (see settings.push_protobuf)
+_NATIVE = settings.native_histograms and settings.push_protobuf
+_CPU_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, float("inf"))
+_BYTES_BUCKETS = tuple(float(2**power) for power in range(20, 36, 2)) + (float("inf"),)
+_COUNT_BUCKETS = (0.0, 1.0, 2.0, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 1000.0, float("inf"))
+
 FLOW_INVOCATIONS = Counter(
     "flow_invocations",
     "Counting the number of function invocations",
@@ -57,12 +90,15 @@ FLOW_INVOCATIONS = Counter(
     registry=initial_registry,
 )
 
-FLOW_PROCESSING_TIME = Histogram(
+FLOW_PROCESSING_TIME = NativeHistogram(
     "flow_processing_time",
     "Histogram of function invocation processing time by path (in seconds)",
     labelnames=["flow", "status"],
     buckets=_BUCKETS,
     registry=interim_registry,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=_NATIVE,
 )
 FLOW_STATUS = Counter(
     "flow_status",
@@ -76,20 +112,201 @@ FLOWS_FINISHED = Counter(
     labelnames=["flow"],
     registry=final_registry,
 )
+# Resource accounting (see common.resources), by flow and by task within it. The task label is
+# empty for the flow as a whole.
+RUN_WALL_TIME = NativeHistogram(
+    "run_wall_time",
+    "Histogram of task and flow run wall time (in seconds)",
+    labelnames=["flow", "task"],
+    buckets=_CPU_BUCKETS,
+    registry=interim_registry,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=_NATIVE,
+)
+RUN_CPU_TIME = NativeHistogram(
+    "run_cpu_time",
+    "Histogram of task and flow run CPU time by mode, user or system (in seconds)",
+    labelnames=["flow", "task", "mode"],
+    buckets=_CPU_BUCKETS,
+    registry=interim_registry,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=_NATIVE,
+)
+RUN_GC_PAUSE_TIME = NativeHistogram(
+    "run_gc_pause_time",
+    "Histogram of garbage collection pauses during task and flow runs (in seconds)",
+    labelnames=["flow", "task"],
+    buckets=_CPU_BUCKETS,
+    registry=interim_registry,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=_NATIVE,
+)
+RUN_GC_COLLECTIONS = Histogram(
+    "run_gc_collections",
+    "Histogram of the number of garbage collections during task and flow runs",
+    labelnames=["flow", "task"],
+    buckets=_COUNT_BUCKETS,
+    registry=interim_registry,
+)
+RUN_MAX_RSS_INCREASE = Histogram(
+    "run_max_rss_increase",
+    "Histogram of how much task and flow runs raised the process' peak RSS (in bytes)",
+    labelnames=["flow", "task"],
+    buckets=_BYTES_BUCKETS,
+    registry=interim_registry,
+)
+RUN_TRACED_MEMORY_PEAK = Histogram(
+    "run_traced_memory_peak",
+    "Histogram of the tracemalloc peak during task and flow runs (in bytes)",
+    labelnames=["flow", "task"],
+    buckets=_BYTES_BUCKETS,
+    registry=interim_registry,
+)
+# Errors raised by flows and by the tasks in them (the task label is empty for the flow itself).
+# Unlike the HTTP routes, flows have no accumulated_exceptions window (see settings): flow runs
+# are separate, short lived processes, so the window is taken in Prometheus instead.
+RUN_ERRORS = Counter(
+    "run_errors",
+    "Total number of errors raised by task and flow runs",
+    labelnames=["flow", "task"],
+    registry=interim_registry,
+)
+# batched_map, by flow and by mapped function
+MAP_ITEMS = Counter(
+    "map_items",
+    "Total number of items processed by batched_map by result (success or failure)",
+    labelnames=["flow", "map", "result"],
+    registry=interim_registry,
+)
+MAP_ITEM_TIME = NativeHistogram(
+    "map_item_time",
+    "Histogram of the time batched_map spent on each item (in seconds)",
+    labelnames=["flow", "map"],
+    buckets=_CPU_BUCKETS,
+    registry=interim_registry,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=_NATIVE,
+)
+MAP_CHUNK_TIME = NativeHistogram(
+    "map_chunk_time",
+    "Histogram of the time batched_map spent on each chunk, from start to end in its worker (in seconds)",
+    labelnames=["flow", "map"],
+    buckets=_CPU_BUCKETS,
+    registry=interim_registry,
+    schema=settings.native_histogram_schema,
+    max_buckets=settings.native_histogram_max_buckets,
+    native=_NATIVE,
+)
+FLOW_LABEL_OVERFLOW = Counter(
+    "label_overflow",
+    "Total number of observations recorded under the overflow label value because of the label limit",
+    labelnames=["label"],
+    registry=final_registry,
+)
+
+
+_RUN_METRICS = (
+    RUN_WALL_TIME,
+    RUN_CPU_TIME,
+    RUN_GC_PAUSE_TIME,
+    RUN_GC_COLLECTIONS,
+    RUN_MAX_RSS_INCREASE,
+    RUN_TRACED_MEMORY_PEAK,
+    RUN_ERRORS,
+    MAP_ITEMS,
+    MAP_ITEM_TIME,
+    MAP_CHUNK_TIME,
+)
+
+
+def _evict_flow(labels: tuple[str, ...]) -> None:
+    remove_series(labels, FLOW_INVOCATIONS, FLOW_PROCESSING_TIME, FLOW_STATUS, FLOWS_FINISHED, *_RUN_METRICS)
+
+
+_flow_limiter = CardinalityLimiter(settings.metric_label_limit, settings.metric_label_ttl, on_evict=_evict_flow)
+
+
+def flow_label(name: str) -> str:
+    # Flow names can be generated at run time, so the number of flow series is capped, though
+    # only within this process (see settings.metric_label_limit)
+    if _flow_limiter.admit((name,)):
+        return name
+    FLOW_LABEL_OVERFLOW.labels("flow").inc()
+    return OVERFLOW_LABEL
 
 
 def push_metrics(registry: CollectorRegistry) -> None:
-    push_to_gateway(settings.push_gateway, job=settings.service, registry=registry)
+    # Queued for the background publisher, so flows never wait on the gateway
+    get_publisher(settings.push_gateway, settings.service).submit(registry)
 
 
 def record_ending(name: str, status: str) -> None:
+    name = flow_label(name)
     FLOW_STATUS.labels(name, status).inc()
     FLOWS_FINISHED.labels(name).inc()
     push_metrics(final_registry)
 
 
-def on_finish(flow: Flow, flow_run: FlowRun, state: State):
+@contextmanager
+def account_resources(span: Span, flow: str | None, task: str = "") -> Iterator[None]:
+    # Opt-in, see settings.resource_accounting. Tasks' histograms go out with their flow's push.
+    if not settings.resource_accounting:
+        yield
+        return
+    usage = None
+    try:
+        with measure(settings.resource_tracemalloc) as usage:
+            yield
+    finally:
+        if usage is not None:
+            span.set_attributes(usage.attributes())
+            flow = flow_label(flow or "")
+            RUN_WALL_TIME.labels(flow, task).observe(usage.wall)
+            RUN_CPU_TIME.labels(flow, task, "user").observe(usage.cpu_user)
+            RUN_CPU_TIME.labels(flow, task, "system").observe(usage.cpu_system)
+            RUN_GC_PAUSE_TIME.labels(flow, task).observe(usage.gc_pause)
+            RUN_GC_COLLECTIONS.labels(flow, task).observe(usage.gc_collections)
+            RUN_MAX_RSS_INCREASE.labels(flow, task).observe(usage.max_rss_increase)
+            if usage.traced_peak is not None:
+                RUN_TRACED_MEMORY_PEAK.labels(flow, task).observe(usage.traced_peak)
+
+
+@contextmanager
+def profile_run(span: Span, flow: str, enabled: bool | None = None) -> Iterator[None]:
+    # Runs are profiled when asked for with data_flow(profile=True), or sampled per the settings
+    if enabled is None:
+        enabled = settings.profile_flows and random() < settings.profile_sample_ratio
+    if not enabled:
+        yield
+        return
+    profiler = SamplingProfiler(
+        threads=None if settings.profile_all_threads else [threading.get_ident()],
+        interval=settings.profile_interval,
+        max_overhead=settings.profile_max_overhead,
+    )
+    try:
+        with profiler:
+            yield
+    finally:
+        trace_id = format_trace_id(span.get_span_context().trace_id)
+        try:
+            path = profiler.save(settings.profile_dir, f"{flow}-{trace_id}", settings.profile_format)
+        except OSError as e:
+            logger.warning(f"Failed to save the profile of {flow}: {e!r}")
+        else:
+            span.set_attributes(
+                {"profile.path": path, "profile.samples": profiler.samples, "profile.overhead": profiler.overhead}
+            )
+            logger.info(f"Saved a profile of {profiler.samples} samples to {path}, overhead {profiler.overhead:.2%}")
+
+
+def on_finish(flow: "Flow", flow_run: "FlowRun", state: "State"):
     record_ending(flow.name, state.type.value)
+    flush_logging()
 
 
 TASK_DEFAULT_KWARGS = {
@@ -112,75 +329,299 @@ FLOW_DEFAULT_KWARGS = {
 }
 
 
+@contextmanager
+def _task_run(tracer: Tracer, name: str) -> Iterator[Span]:
+    from prefect.runtime.flow_run import get_flow_name
+
+    with (
+        tracer.start_as_current_span(name, kind=SpanKind.SERVER) as span,
+        account_resources(span, get_flow_name() if settings.resource_accounting else None, name),
+    ):
+        try:
+            yield span
+            span.set_status(StatusCode.OK)
+        except Exception as e:
+            # Pushed with the flow's interim registry when the flow ends
+            RUN_ERRORS.labels(flow_label(get_flow_name() or ""), name).inc()
+            span.record_exception(e)
+            span.set_status(StatusCode.ERROR, description=f"{type(e).__name__}: {e}")
+            raise
+
+
 def data_task(**kwargs):
     def decorate(func: Callable) -> Callable:
+        from prefect import task
+
         tracer = get_tracer(settings.service)
         final_kwargs = {**TASK_DEFAULT_KWARGS, **kwargs}
         name = kwargs.get("name", func.__name__)
 
+        # Coroutine functions get a coroutine wrapper, so that the span covers the awaited work
+        if inspect.iscoroutinefunction(func):
+
+            @task(**final_kwargs)
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _task_run(tracer, name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
         @task(**final_kwargs)
         @wraps(func)
         def wrapper(*args, **kwargs):
-            with tracer.start_as_current_span(name, kind=SpanKind.SERVER) as span:
-                try:
-                    result = func(*args, **kwargs)
-                    span.set_status(StatusCode.OK)
-                    return result
-                except Exception as e:
-                    span.record_exception(e)
-                    span.set_status(StatusCode.ERROR, description=f"{type(e).__name__}: {e}")
-                    raise
+            with _task_run(tracer, name):
+                return func(*args, **kwargs)
 
         return wrapper
 
     return decorate
 
 
-def data_flow(**kwargs):
+class _FlowRun:
+    __slots__ = ("result",)
+
+    def __init__(self) -> None:
+        self.result: Any = None
+
+
+@contextmanager
+def _flow_run(tracer: Tracer, func: Callable, profile: bool | None) -> Iterator[_FlowRun]:
+    from prefect.client.schemas.objects import State, StateType
+    from prefect.runtime.flow_run import get_flow_name
+
+    configure_logging(settings.service)
+    name = get_flow_name()
+    if name is None:
+        name = func.__name__
+    label = flow_label(name)
+    with (
+        tracer.start_as_current_span(name, kind=SpanKind.SERVER) as span,
+        account_resources(span, name),
+        profile_run(span, name, profile),
+    ):
+        start = time.perf_counter()
+        observed_time = False
+        run = _FlowRun()
+        try:
+            FLOW_INVOCATIONS.labels(label).inc()
+            push_metrics(initial_registry)
+            yield run
+            elapsed = time.perf_counter() - start
+
+            # Note because flows can crash, we don't handle the post-execution
+            # prometheus here
+            result = run.result
+            if isinstance(result, State):
+                FLOW_PROCESSING_TIME.labels(label, result.type.value).observe(elapsed)
+                observed_time = True
+                if result.type == StateType.COMPLETED:
+                    span.set_status(StatusCode.OK)
+                else:
+                    span.set_status(StatusCode.ERROR, description=result.message)
+            else:
+                FLOW_PROCESSING_TIME.labels(label, "COMPLETED").observe(elapsed)
+                observed_time = True
+                span.set_status(StatusCode.OK)
+            push_metrics(interim_registry)
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+            RUN_ERRORS.labels(label, "").inc()
+            if not observed_time:
+                FLOW_PROCESSING_TIME.labels(label, "FAILED").observe(elapsed)
+                push_metrics(interim_registry)
+            span.record_exception(e)
+            span.set_status(StatusCode.ERROR, description=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            flush_logging()
+
+
+def data_flow(profile: bool | None = None, **kwargs):
     def decorate(func: Callable) -> Callable:
+        from prefect import flow
+
         tracer = get_tracer(settings.service)
         final_kwargs = {**FLOW_DEFAULT_KWARGS, **kwargs}
 
+        if inspect.iscoroutinefunction(func):
+
+            @flow(**final_kwargs)
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _flow_run(tracer, func, profile) as run:
+                    run.result = await func(*args, **kwargs)
+                    return run.result
+
+            return async_wrapper
+
         @flow(**final_kwargs)
         @wraps(func)
         def wrapper(*args, **kwargs):
-            configure_logging(settings.service)
-            name = get_flow_name()
-            if name is None:
-                name = func.__name__
-            with tracer.start_as_current_span(name, kind=SpanKind.SERVER) as span:
-                start = time.perf_counter()
-                observed_time = False
-                try:
-                    FLOW_INVOCATIONS.labels(name).inc()
-                    push_metrics(initial_registry)
-                    result = func(*args, **kwargs)
-                    elapsed = time.perf_counter() - start
-
-                    # Note because flows can crash, we don't handle the post-execution
-                    # prometheus here
-                    if isinstance(result, State):
-                        FLOW_PROCESSING_TIME.labels(name, result.type.value).observe(elapsed)
-                        observed_time = True
-                        if result.type != StateType.COMPLETED:
-                            span.set_status(StatusCode.OK)
-                        else:
-                            span.set_status(StatusCode.ERROR, description=result.message)
-                    else:
-                        FLOW_PROCESSING_TIME.labels(name, "COMPLETED").observe(elapsed)
-                        observed_time = True
-                        span.set_status(StatusCode.OK)
-                    push_metrics(interim_registry)
-                    return result
-                except Exception as e:
-                    elapsed = time.perf_counter() - start
-                    if not observed_time:
-                        FLOW_PROCESSING_TIME.labels(name, "FAILED").observe(elapsed)
-                        push_metrics(interim_registry)
-                    span.record_exception(e)
-                    span.set_status(StatusCode.ERROR, description=f"{type(e).__name__}: {e}")
-                    raise
+            with _flow_run(tracer, func, profile) as run:
+                run.result = func(*args, **kwargs)
+                return run.result
 
         return wrapper
 
     return decorate
+
+
+# Failed items recorded as exception events on a chunk's span, the rest are only counted
+_MAX_RECORDED_ERRORS = 5
+
+
+class _TaskReference:
+    # Prefect tasks can't be pickled for process pools, so workers import them by name instead
+    def __init__(self, fn: Callable) -> None:
+        self.module = fn.__module__
+        self.qualname = fn.__qualname__
+
+    def resolve(self) -> Callable:
+        target: Any = importlib.import_module(self.module)
+        for part in self.qualname.split("."):
+            target = getattr(target, part)
+        return inspect.unwrap(target.fn)
+
+
+class MapResult:
+    """What batched_map returns: `results` in the order of the items, with None for the items
+    that failed, and `errors` holding the exception of each failed item by its index."""
+
+    __slots__ = ("results", "errors")
+
+    def __init__(self, results: list[Any], errors: dict[int, Exception]) -> None:
+        self.results = results
+        self.errors = errors
+
+    def __repr__(self) -> str:
+        return f"MapResult({len(self.results)} items, {len(self.errors)} failed)"
+
+
+def _run_chunk(
+    func: Callable | _TaskReference, items: tuple, name: str, index: int, carrier: dict[str, str] | None
+) -> tuple[list, dict[int, Exception], list[float], int, int]:
+    # Runs in the pool's worker, under the chunk's span, and only returns plain data for the
+    # caller to record. Threads run in a copy of the caller's context, processes get the
+    # caller's span through `carrier` instead.
+    start_ns = time.time_ns()
+    if isinstance(func, _TaskReference):
+        func = func.resolve()
+    context = TraceContextTextMapPropagator().extract(carrier) if carrier is not None else None
+    results: list[Any] = []
+    errors: dict[int, Exception] = {}
+    latencies = []
+    with get_tracer(settings.service).start_as_current_span(
+        f"{name} chunk", context=context, kind=SpanKind.INTERNAL, start_time=start_ns
+    ) as span:
+        for item in items:
+            start = time.perf_counter()
+            try:
+                results.append(func(item))
+            except Exception as e:
+                results.append(None)
+                errors[len(results) - 1] = e
+            latencies.append(time.perf_counter() - start)
+        _end_chunk_span(span, name, index, len(items), errors)
+    if carrier is not None:
+        # Pool processes exit without running atexit, which would otherwise export the spans
+        # and write out the queued log lines
+        trace.get_tracer_provider().force_flush()  # type: ignore[attr-defined]
+        flush_logging()
+    return results, errors, latencies, start_ns, time.time_ns()
+
+
+def _end_chunk_span(span: Span, name: str, index: int, size: int, errors: dict[int, Exception]) -> None:
+    span.set_attributes({"map.name": name, "map.chunk": index, "map.items": size, "map.failures": len(errors)})
+    for error in list(errors.values())[:_MAX_RECORDED_ERRORS]:
+        span.record_exception(error)
+    if errors:
+        span.set_status(StatusCode.ERROR, description=f"{len(errors)} of {size} items failed")
+        first = next(iter(errors.values()))
+        logger.warning(f"{len(errors)} of {size} items failed in chunk {index} of {name}, eg {first!r}")
+    else:
+        span.set_status(StatusCode.OK)
+
+
+def batched_map(
+    func: Callable,
+    items: Iterable,
+    chunk_size: int | None = None,
+    max_workers: int | None = None,
+    executor: Literal["thread", "process"] | None = None,
+    name: str | None = None,
+) -> MapResult:
+    """Calls `func` on every item, `chunk_size` items at a time in a thread or process pool.
+
+    Items run without a task run or span of their own: each chunk gets one span, a child of
+    the caller's, with its item and failure counts, and per item latencies go into
+    map_item_time. Spans and logs from inside the items belong to their chunk's span. Chunks
+    are not Prefect task runs either, so they have no retries or timeout of their own. A
+    data_task is called through its undecorated function. An item that raises is recorded as
+    failed and the rest of its chunk carries on. Chunks are submitted as workers free up, so
+    `items` can be a generator. Defaults come from the map_* settings.
+    """
+    from prefect import Task
+    from prefect.runtime.flow_run import get_flow_name
+
+    chunk_size = chunk_size or settings.map_chunk_size
+    executor = executor or settings.map_executor
+    max_workers = max_workers or settings.map_max_workers or os.cpu_count() or 1
+    target: Callable | _TaskReference = func
+    if isinstance(func, Task):
+        name = name or func.name
+        target = _TaskReference(func.fn) if executor == "process" else inspect.unwrap(func.fn)
+    name = name or getattr(func, "__name__", "map")
+    if inspect.iscoroutinefunction(target):
+        raise TypeError("batched_map does not support coroutine functions")
+
+    tracer = get_tracer(settings.service)
+    flow = flow_label(get_flow_name() or "")
+    item_time = MAP_ITEM_TIME.labels(flow, name)
+    chunk_time = MAP_CHUNK_TIME.labels(flow, name)
+    succeeded = MAP_ITEMS.labels(flow, name, "success")
+    failed = MAP_ITEMS.labels(flow, name, "failure")
+    chunks: dict[int, list[Any]] = {}
+    errors: dict[int, Exception] = {}
+
+    def record(index: int, size: int, future: Future) -> None:
+        try:
+            results, chunk_errors, latencies, start_ns, end_ns = future.result()
+        except Exception as e:
+            # The chunk itself failed (eg it couldn't be pickled or its worker died)
+            results, chunk_errors, latencies = [None] * size, dict.fromkeys(range(size), e), []
+            start_ns = end_ns = time.time_ns()
+            with tracer.start_as_current_span(f"{name} chunk", kind=SpanKind.INTERNAL) as span:
+                _end_chunk_span(span, name, index, size, chunk_errors)
+
+        for latency in latencies:
+            item_time.observe(latency)
+        chunk_time.observe((end_ns - start_ns) / 1e9)
+        succeeded.inc(size - len(chunk_errors))
+        failed.inc(len(chunk_errors))
+        chunks[index] = results
+        offset = index * chunk_size
+        errors.update((offset + position, error) for position, error in chunk_errors.items())
+
+    def submit(pool: Executor, index: int, chunk: tuple) -> Future:
+        if executor == "process":
+            carrier: dict[str, str] = {}
+            TraceContextTextMapPropagator().inject(carrier)
+            return pool.submit(_run_chunk, target, chunk, name, index, carrier)
+        # Each chunk gets its own copy, as one context can't be entered by two threads at once
+        return pool.submit(contextvars.copy_context().run, _run_chunk, target, chunk, name, index, None)
+
+    pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    with pool_class(max_workers=max_workers) as pool:
+        pending: dict[Future, tuple[int, int]] = {}
+        for index, chunk in enumerate(itertools.batched(items, chunk_size)):
+            # Keep every worker busy without queueing up the whole iterable
+            while len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(*pending.pop(future), future)
+            pending[submit(pool, index, chunk)] = (index, len(chunk))
+        for future in as_completed(pending):
+            record(*pending[future], future)
+
+    return MapResult([result for index in sorted(chunks) for result in chunks[index]], errors)
@@ -0,0 +1,155 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections.abc import Iterable
+from types import CodeType
+from typing import Any, Literal
+
+ProfileFormat = Literal["collapsed", "speedscope"]
+
+
+def _frame_name(code: CodeType) -> str:
+    return f"{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stacks of running threads from a background thread.
+
+    Every `interval` seconds the current frame of each profiled thread (`threads`, or every
+    thread but the sampler when None) is taken from sys._current_frames() and its stack counted.
+    The time spent sampling is measured, and the sampler waits longer between samples whenever
+    needed to keep that under `max_overhead` of the wall time, so deep stacks or many threads
+    lower the sample rate rather than slowing the program down. At most `max_stacks` distinct
+    stacks are kept, samples of further new stacks are only counted in `dropped`.
+    """
+
+    def __init__(
+        self,
+        threads: Iterable[int] | None = None,
+        interval: float = 0.01,
+        max_overhead: float = 0.02,
+        max_depth: int = 256,
+        max_stacks: int = 10_000,
+    ) -> None:
+        self.threads = set(threads) if threads is not None else None
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        # Stacks are stored root first, as code objects, and only named when written out
+        self.stacks: dict[tuple[CodeType, ...], int] = {}
+        self.samples = 0
+        self.dropped = 0
+        self.busy = 0.0
+        self.started = 0.0
+        self.stopped = 0.0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stopped = time.perf_counter()
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    @property
+    def overhead(self) -> float:
+        # Share of the wall time the sampler spent taking samples, during which it held the GIL
+        elapsed = (self.stopped or time.perf_counter()) - self.started
+        return self.busy / elapsed if elapsed > 0 else 0.0
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        delay = self.interval
+        while not self._stop.wait(delay):
+            start = time.perf_counter()
+            self._sample(own)
+            cost = time.perf_counter() - start
+            self.busy += cost
+            delay = max(self.interval, cost / self.max_overhead - cost)
+
+    def _sample(self, own: int) -> None:
+        for ident, frame in sys._current_frames().items():
+            if ident == own or (self.threads is not None and ident not in self.threads):
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(frame.f_code)
+                frame = frame.f_back  # type: ignore[assignment]
+            key = tuple(reversed(stack))
+            count = self.stacks.get(key)
+            if count is None and len(self.stacks) >= self.max_stacks:
+                self.dropped += 1
+                continue
+            self.stacks[key] = (count or 0) + 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        # One "root;...;leaf count" line per stack, as read by flamegraph.pl and most viewers
+        names: dict[CodeType, str] = {}
+        lines = []
+        for stack, count in self.stacks.items():
+            frames = [names.get(code) or names.setdefault(code, _frame_name(code)) for code in stack]
+            lines.append(f"{';'.join(frames)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str) -> dict[str, Any]:
+        frames: list[dict[str, Any]] = []
+        indices: dict[CodeType, int] = {}
+        samples = []
+        weights = []
+        for stack, count in self.stacks.items():
+            sample = []
+            for code in stack:
+                index = indices.get(code)
+                if index is None:
+                    index = indices[code] = len(frames)
+                    frames.append({"name": code.co_qualname, "file": code.co_filename, "line": code.co_firstlineno})
+                sample.append(index)
+            samples.append(sample)
+            weights.append(count)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "common.profiling",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "none",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            ],
+        }
+
+    def save(self, directory: str, name: str, format: ProfileFormat = "speedscope") -> str:
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, re.sub(r"[^\w.-]", "_", name))
+        if format == "collapsed":
+            path = stem + ".collapsed"
+            with open(path, "w") as f:
+                f.write(self.collapsed())
+        else:
+            path = stem + ".speedscope.json"
+            with open(path, "w") as f:
+                json.dump(self.speedscope(name), f)
+        return path
@@ -1,95 +1,47 @@
+import asyncio
+import glob
+import gzip
+import os
 import time
+from collections.abc import Callable, Sequence
+from functools import lru_cache
 
-from fastapi import HTTPException
-from fastapi.responses import JSONResponse
 from loguru import logger
 from opentelemetry.trace import SpanKind, StatusCode
 from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
-from prometheus_client import (
-    CONTENT_TYPE_LATEST,
-    REGISTRY,
-    Counter,
-    Gauge,
-    Histogram,
-    generate_latest,
-)
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.multiprocess import MultiProcessCollector, mark_process_dead
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import Response
-from starlette.routing import Match
-from starlette.types import ASGIApp
-
-from common.tracing import get_tracer
-
-_BUCKETS = (
-    0.005,
-    0.01,
-    0.025,
-    0.05,
-    0.075,
-    0.1,
-    0.25,
-    0.5,
-    0.75,
-    1.0,
-    1.5,
-    2.0,
-    2.5,
-    3.0,
-    3.5,
-    4.0,
-    4.5,
-    5.0,
-    5.5,
-    6.0,
-    6.5,
-    7.0,
-    7.5,
-    10.0,
-    float("inf"),
-)
-
-INFO = Gauge("service", "App Name", labelnames=["service"])
-INVOCATIONS = Counter(
-    "function_invocations",
-    "Counting the number of function invocations",
-    labelnames=["service", "function"],
-)
-INVOCATION_RESPONSES = Counter(
-    "function_invocation_responses",
-    "Counting the number of function invocations",
-    labelnames=["service", "function"],
-)
+from starlette.responses import JSONResponse, Response
+from starlette.routing import BaseRoute, Host, Match, Mount, Route
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-INVOCATIONS_PROCESSING_TIME = Histogram(
-    "function_invocation_time",
-    "Histogram of function invocation processing time by path (in seconds)",
-    labelnames=["service", "function"],
-    buckets=_BUCKETS,
-)
-EXCEPTIONS = Counter(
-    "exceptions",
-    "Total count of exceptions raised by function and exception type",
-    labelnames=["service", "function"],
-)
-INVOCATIONS_IN_PROGRESS = Gauge(
-    "function_invocations_in_progress",
-    "Gauge of function invocations currently being processed",
-    labelnames=["service", "function"],
-)
-ACCUMULATED_EXCEPTIONS = Gauge(
-    "accumulated_exceptions",
-    "Number of errors in the configured time period. Will be negative if no issue. Zero or greater for errors.",
-    labelnames=["service", "function"],
-)
-LOG_TOTAL = Counter(
-    "log_total",
-    "Total number of log messages",
-    labelnames=["service", "level"],
+from common.exposition import choose_encoder
+from common.metrics import (
+    ACCUMULATED_EXCEPTIONS,
+    EXCEPTIONS,
+    INFO,
+    INVOCATION_RESPONSES,
+    INVOCATIONS,
+    INVOCATIONS_IN_PROGRESS,
+    INVOCATIONS_PROCESSING_TIME,
+    LABEL_OVERFLOW,
+    LOG_DROPPED,
+    LOG_SUPPRESSED,
+    LOG_TOTAL,
+    clear_bound_metrics,
+    route_metrics,
 )
+from common.settings import settings
+from common.tracing import get_tracer
 
 
 def reset_metrics(service: str) -> None:
+    # The cached children would otherwise keep pointing at series that are no longer exported
+    clear_bound_metrics()
+    _metrics_cache.clear()
     INVOCATIONS._metrics.clear()
     INVOCATION_RESPONSES._metrics.clear()
     INVOCATIONS_PROCESSING_TIME._metrics.clear()
@@ -97,79 +49,317 @@ def reset_metrics(service: str) -> None:
     INVOCATIONS_IN_PROGRESS._metrics.clear()
     ACCUMULATED_EXCEPTIONS._metrics.clear()
     LOG_TOTAL._metrics.clear()
+    LOG_DROPPED._metrics.clear()
+    LOG_SUPPRESSED._metrics.clear()
+    LABEL_OVERFLOW._metrics.clear()
     EXCEPTIONS.labels(service=service, function="").inc(0)
 
 
-class PrometheusMiddleware(BaseHTTPMiddleware):
+def _route_path(scope: Scope) -> str:
+    # Mirrors starlette's get_route_path: the path relative to the app's root_path
+    path: str = scope["path"]
+    root_path = scope.get("root_path", "")
+    if not root_path or not path.startswith(root_path):
+        return path
+    if path == root_path:
+        return ""
+    if path[len(root_path)] == "/":
+        return path[len(root_path) :]
+    return path
+
+
+def _static_prefix(path: str) -> str:
+    # The part of a route path before its first parameter, cut back to the last "/"
+    head = path.split("{", 1)[0]
+    return head[: head.rfind("/") + 1]
+
+
+class RouteIndex:
+    """Resolves requests to their route template without testing every route in turn.
+
+    Routes without parameters are looked up by exact path, parameterised routes and mounts
+    are grouped by the static prefix before their first parameter, and anything else (host
+    routes, custom routes) is always checked. Candidates are still confirmed with
+    `route.matches`, in declaration order, so the result is the same as starlette's router.
+    Recent (method, path) lookups are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, routes: Sequence[BaseRoute], cache_size: int = 1024) -> None:
+        self.routes = routes
+        self.size = len(routes)
+        self._static: dict[str, list[tuple[int, BaseRoute]]] = {}
+        self._prefixed: dict[str, list[tuple[int, BaseRoute]]] = {}
+        self._always: list[tuple[int, BaseRoute]] = []
+        for order, route in enumerate(routes):
+            if isinstance(route, Route) and "{" not in route.path:
+                self._static.setdefault(route.path, []).append((order, route))
+            elif isinstance(route, Route):
+                self._prefixed.setdefault(_static_prefix(route.path), []).append((order, route))
+            elif isinstance(route, Mount) and route.path:
+                self._prefixed.setdefault(_static_prefix(route.path + "/"), []).append((order, route))
+            else:
+                self._always.append((order, route))
+        # Host routes match on headers, which are not part of the cache key
+        self._cacheable = not any(isinstance(route, Host) for _, route in self._always)
+        self._cached_resolve = lru_cache(maxsize=cache_size)(self._resolve_path)
+
+    def resolve(self, scope: Scope) -> tuple[str, bool]:
+        if self._cacheable:
+            return self._cached_resolve(scope["method"], scope["path"], scope.get("root_path", ""))
+        return self._resolve(scope)
+
+    def _resolve_path(self, method: str, path: str, root_path: str) -> tuple[str, bool]:
+        return self._resolve({"type": "http", "method": method, "path": path, "root_path": root_path})
+
+    def _resolve(self, scope: Scope) -> tuple[str, bool]:
+        template = self._match(scope)
+        if template is None:
+            return scope["path"], False
+        return template, True
+
+    def _match(self, scope: Scope) -> str | None:
+        return _match_routes(self._candidates(_route_path(scope)), scope)
+
+    def _candidates(self, path: str) -> list[BaseRoute]:
+        candidates = list(self._static.get(path, ()))
+        position = path.find("/")
+        while position != -1:
+            candidates.extend(self._prefixed.get(path[: position + 1], ()))
+            position = path.find("/", position + 1)
+        candidates.extend(self._always)
+        candidates.sort(key=lambda candidate: candidate[0])
+        return [route for _, route in candidates]
+
+
+def _match_routes(routes: Sequence[BaseRoute], scope: Scope) -> str | None:
+    for route in routes:
+        match, child_scope = route.matches(scope)
+        if match != Match.FULL:
+            continue
+        if isinstance(route, Mount):
+            # Resolve within mounted routers and sub-apps, falling back to the mount itself
+            child = _match_routes(route.routes, {**scope, **child_scope})
+            return route.path + child if child is not None else route.path
+        if isinstance(route, Host):
+            # Host routes have no path of their own, so the host pattern stands in for one
+            child = _match_routes(route.routes, {**scope, **child_scope})
+            return child if child is not None else route.host
+        return getattr(route, "path", scope["path"])
+    return None
+
+
+class PrometheusMiddleware:
+    # A plain ASGI middleware rather than a BaseHTTPMiddleware, which would wrap every
+    # response stream in an extra task and finish timing before a streamed body is sent
     def __init__(self, app: ASGIApp, service: str, intercept_exceptions: bool = True) -> None:
-        super().__init__(app)
+        self.app = app
         self.service = service
         INFO.labels(service=self.service).inc()
         self.propagator = TraceContextTextMapPropagator()
         self.tracer = get_tracer(service)
         self.intercept_exceptions = intercept_exceptions
+        self._route_index: RouteIndex | None = None
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        method = request.method
-        path, is_handled_path = self.get_path(request)
-        function = f"{method}_{path}"
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
+        path, is_handled_path = self.get_path(scope)
         if not is_handled_path:
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
+
+        function = f"{scope['method']}_{path}"
+        metrics = route_metrics(self.service, function)
+        response_started = False
+        response_finished: float | None = None
 
-        context = self.propagator.extract(request.headers)
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started, response_finished
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_finished = time.perf_counter()
+
+        context = self.propagator.extract(Headers(scope=scope))
         with self.tracer.start_as_current_span(function, context=context, kind=SpanKind.SERVER) as span:
-            INVOCATIONS_IN_PROGRESS.labels(function=function, service=self.service).inc()
-            INVOCATIONS.labels(function=function, service=self.service).inc()
-            EXCEPTIONS.labels(
-                function=function,
-                service=self.service,
-            )
+            metrics.in_progress.inc()
+            metrics.invocations.inc()
             before_time = time.perf_counter()
             try:
-                response = await call_next(request)
-                if span is not None:
-                    span.set_status(StatusCode.OK)
+                await self.app(scope, receive, send_wrapper)
+                span.set_status(StatusCode.OK)
             except Exception as e:
-                if span is not None:
-                    span.record_exception(e)
-                    span.set_status(StatusCode.ERROR, description=f"{type(e).__name__}: {e}")
-                EXCEPTIONS.labels(
-                    function=function,
-                    service=self.service,
-                ).inc()
+                span.record_exception(e)
+                span.set_status(StatusCode.ERROR, description=f"{type(e).__name__}: {e}")
+                metrics.exceptions.inc()
+                metrics.errors.record()
 
                 # If we let the ASGI server handle the exception, we won't get the trace id emitted
                 # So instead, we optionally intercept non-HTTP exceptions, log them, and then
-                # set the response to an appropriate JSONResponse
-                if self.intercept_exceptions and not isinstance(e, HTTPException):
+                # send an appropriate JSONResponse (as long as the response hasn't already started)
+                if self.intercept_exceptions and not isinstance(e, HTTPException) and not response_started:
                     logger.opt(exception=e).exception(f"Exception in {function}: {e}")
                     response = JSONResponse(status_code=500, content={"detail": str(e)})
+                    await response(scope, receive, send)
                 else:
                     raise
             else:
-                after_time = time.perf_counter()
-                INVOCATION_RESPONSES.labels(
-                    function=function,
-                    service=self.service,
-                ).inc()
-                INVOCATIONS_PROCESSING_TIME.labels(service=self.service, function=function).observe(
-                    after_time - before_time
-                )
+                # Time until the last body chunk went out, so slow streaming responses are measured
+                # fully and background tasks run after the response are not
+                after_time = response_finished or time.perf_counter()
+                metrics.responses.inc()
+                metrics.processing_time.observe(after_time - before_time)
             finally:
-                INVOCATIONS_IN_PROGRESS.labels(function=function, service=self.service).dec()
+                metrics.in_progress.dec()
+
+    def get_path(self, scope: Scope) -> tuple[str, bool]:
+        # Built on first use and rebuilt if routes are added afterwards
+        routes = scope["app"].routes
+        index = self._route_index
+        if index is None or index.routes is not routes or index.size != len(routes):
+            index = self._route_index = RouteIndex(routes, cache_size=settings.route_cache_size)
+        return index.resolve(scope)
+
+
+class MetricsCache:
+    """Renders a registry off the event loop and reuses the result for `ttl` seconds.
+
+    Concurrent scrapes asking for the same format share a single render, and payloads are
+    cached per content type (text or OpenMetrics) and per compression.
+    """
+
+    def __init__(self, registry: CollectorRegistry = REGISTRY, ttl: float = 1.0) -> None:
+        self.registry = registry
+        self.ttl = ttl
+        self._rendered: dict[tuple[str, bool], tuple[float, bytes]] = {}
+        self._pending: dict[tuple[str, bool], asyncio.Future[bytes]] = {}
+
+    async def render(self, accept: str = "", compress: bool = False) -> tuple[bytes, str]:
+        encoder, content_type = choose_encoder(accept)
+        key = (content_type, compress)
+        cached = self._rendered.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1], content_type
+
+        pending = self._pending.get(key)
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending[key] = asyncio.ensure_future(self._render(key, encoder, compress))
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shielded so a scrape that disconnects doesn't cancel the render other scrapes wait on
+        return await asyncio.shield(pending), content_type
+
+    def clear(self) -> None:
+        self._rendered.clear()
+
+    async def _render(
+        self, key: tuple[str, bool], encoder: Callable[[CollectorRegistry], bytes], compress: bool
+    ) -> bytes:
+        payload = await asyncio.to_thread(self._encode, encoder, compress)
+        self._rendered[key] = (time.monotonic(), payload)
+        return payload
+
+    def _encode(self, encoder: Callable[[CollectorRegistry], bytes], compress: bool) -> bytes:
+        payload = encoder(self.registry)
+        return gzip.compress(payload, compresslevel=6) if compress else payload
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def cleanup_dead_workers(path: str | None = None) -> list[int]:
+    # Live gauges (eg in-progress requests) must stop including workers that have exited.
+    # Their counter and histogram files are kept, so totals don't go backwards.
+    path = path or settings.prometheus_multiproc_dir
+    if not path:
+        return []
+    pids = set()
+    for file in glob.glob(os.path.join(path, "gauge_live*_*.db")):
+        pid = os.path.basename(file)[: -len(".db")].rsplit("_", 1)[-1]
+        if pid.isdigit():
+            pids.add(int(pid))
+    dead = [pid for pid in pids if not _pid_alive(pid)]
+    for pid in dead:
+        mark_process_dead(pid, path)
+    return dead
+
+
+def child_exit(server: object, worker: object) -> None:
+    # For gunicorn deployments: `from common.prom import child_exit` in gunicorn.conf.py
+    mark_process_dead(getattr(worker, "pid"), settings.prometheus_multiproc_dir)
+
+
+class LiveMultiProcessCollector(MultiProcessCollector):
+    """Aggregates the metric files of every worker, dropping exited workers from live gauges.
+
+    Workers' error windows hold plain error counts (see ACCUMULATED_EXCEPTIONS), so the
+    threshold is subtracted here, once, from their sum.
+    """
+
+    def __init__(self, registry: CollectorRegistry | None, path: str | None = None, cleanup_interval: float = 30.0):
+        super().__init__(registry, path)
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = 0.0
+
+    def collect(self):
+        now = time.monotonic()
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            cleanup_dead_workers(self._path)
+        metrics = super().collect()
+        threshold = settings.accumulated_exceptions_threshold
+        for metric in metrics:
+            if metric.name == ACCUMULATED_EXCEPTIONS._name:
+                metric.samples = [sample._replace(value=sample.value - threshold) for sample in metric.samples]
+        return metrics
+
+
+def exposition_registry() -> CollectorRegistry:
+    if not settings.prometheus_multiproc_dir:
+        return REGISTRY
+    os.makedirs(settings.prometheus_multiproc_dir, exist_ok=True)
+    registry = CollectorRegistry()
+    LiveMultiProcessCollector(
+        registry,
+        settings.prometheus_multiproc_dir,
+        cleanup_interval=settings.prometheus_multiproc_cleanup_interval,
+    )
+    return registry
+
 
-            return response
+_metrics_cache = MetricsCache(exposition_registry(), ttl=settings.metrics_cache_ttl)
 
-    @staticmethod
-    def get_path(request: Request) -> tuple[str, bool]:
-        for route in request.app.routes:
-            match, _ = route.matches(request.scope)
-            if match == Match.FULL:
-                return route.path, True
 
-        return request.url.path, False
+def accepts_gzip(accept_encoding: str) -> bool:
+    # gzip's own q value wins over the wildcard's, and q=0 refuses a coding
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, *params = (part.strip() for part in coding.split(";"))
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
 
 
-def metrics(request: Request) -> Response:
-    return Response(generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+async def metrics(request: Request) -> Response:
+    compress = accepts_gzip(request.headers.get("accept-encoding", ""))
+    payload, content_type = await _metrics_cache.render(request.headers.get("accept", ""), compress)
+    headers = {"Content-Type": content_type, "Vary": "Accept, Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return Response(payload, headers=headers)
@@ -0,0 +1,227 @@
+import atexit
+import json
+import threading
+import time
+from collections.abc import Callable, Iterable
+from functools import lru_cache, partial
+
+from loguru import logger
+from prometheus_client import CollectorRegistry, push_to_gateway
+from prometheus_client.exposition import default_handler
+from prometheus_client.metrics_core import CounterMetricFamily, Metric
+from prometheus_client.registry import Collector
+
+from common.exposition import PROTOBUF_CONTENT_TYPE, generate_protobuf
+from common.metrics import SPOOL_RECORDS
+from common.settings import settings
+from common.spool import Spool, get_spool
+
+
+class _MergedCollector(Collector):
+    def __init__(self, registries: Iterable[Collector]) -> None:
+        self.registries = list(registries)
+
+    def collect(self) -> Iterable[Metric]:
+        for registry in self.registries:
+            yield from registry.collect()
+
+
+class _Metrics(Collector):
+    def __init__(self, metrics: list[Metric]) -> None:
+        self.metrics = metrics
+
+    def collect(self) -> Iterable[Metric]:
+        return self.metrics
+
+
+class _SpoolDeltas:
+    # Processes that push (flows) serve no /metrics, so SPOOL_RECORDS goes out with their pushes.
+    # The aggregating gateway adds up what it is pushed, so each push only carries how much the
+    # counts grew since the previous one (and the spool gauges, which can't be summed, are left out)
+    def __init__(self) -> None:
+        self._pushed: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def take(self) -> Collector:
+        family = CounterMetricFamily(
+            SPOOL_RECORDS._name, SPOOL_RECORDS._documentation, labels=SPOOL_RECORDS._labelnames
+        )
+        with self._lock:
+            for metric in SPOOL_RECORDS.collect():
+                for sample in metric.samples:
+                    if not sample.name.endswith("_total"):
+                        continue
+                    labels = tuple(sample.labels[name] for name in SPOOL_RECORDS._labelnames)
+                    delta = sample.value - self._pushed.get(labels, 0.0)
+                    if delta > 0:
+                        family.add_metric(labels, delta)
+                        self._pushed[labels] = sample.value
+        # Taken once per push, so that its retries (and its replay from the spool) send the same deltas
+        return _Metrics([family] if family.samples else [])
+
+
+def _protobuf_handler(
+    registry: CollectorRegistry, url: str, method: str, timeout: float | None, headers: list, data: bytes
+) -> Callable[[], None]:
+    # push_to_gateway always renders text, so the payload and content type are swapped here
+    return default_handler(url, method, timeout, [("Content-Type", PROTOBUF_CONTENT_TYPE)], generate_protobuf(registry))
+
+
+def _spooling_handler(
+    handler: Callable, request: dict, url: str, method: str, timeout: float | None, headers: list, data: bytes
+) -> Callable[[], None]:
+    # Keeps the request that was made, so that it can be spooled if it fails
+    request.update(url=url, method=method, headers=headers, data=data)
+    return handler(url, method, timeout, headers, data)
+
+
+def _encode_request(request: dict) -> bytes:
+    head = {"url": request["url"], "method": request["method"], "headers": request["headers"]}
+    return json.dumps(head).encode() + b"\n" + request["data"]
+
+
+def _decode_request(payload: bytes) -> tuple[dict, bytes]:
+    head, _, data = payload.partition(b"\n")
+    return json.loads(head), data
+
+
+class PushPublisher:
+    """Pushes registries to a Pushgateway from a background thread.
+
+    `submit` only records that a registry needs pushing, so callers never wait on the
+    gateway. Registries submitted within `window` seconds of each other are sent together
+    in a single request, a registry submitted again before it was sent is only sent once
+    (with its latest values), and failed pushes are retried with exponential backoff. With
+    `protobuf`, pushes use the protobuf format so that native histogram buckets are kept.
+
+    Pushes that fail every retry are written to `spool`, if given, and replayed from there,
+    every one of them: the aggregating gateway adds pushes up rather than replacing what it
+    holds, so a later push does not make an earlier one redundant. With a spool, pushes also
+    carry how many records the process spooled, replayed and evicted since its previous push.
+    """
+
+    def __init__(
+        self,
+        gateway: str,
+        job: str,
+        window: float = 0.5,
+        timeout: float = 5.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        protobuf: bool = False,
+        spool: Spool | None = None,
+    ) -> None:
+        self.gateway = gateway
+        self.job = job
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.protobuf = protobuf
+        self.spool = spool
+        self._spool_deltas = _SpoolDeltas()
+        self._pending: dict[int, CollectorRegistry] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._pushing = False
+        self._flush_requests = 0
+        self._closed = False
+        self._thread: threading.Thread | None = None
+
+    def submit(self, registry: CollectorRegistry) -> None:
+        with self._lock:
+            self._pending[id(registry)] = registry
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="push-publisher", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                return not self._pending
+            self._flush_requests += 1
+            self._wakeup.notify()
+            try:
+                return self._idle.wait_for(lambda: not self._pending and not self._pushing, timeout=timeout)
+            finally:
+                self._flush_requests -= 1
+
+    def close(self, timeout: float | None = None) -> None:
+        self.flush(timeout=timeout)
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._wakeup.wait()
+                if not self._pending:
+                    return
+
+                # Give other registries a moment to arrive so they go out in the same request
+                deadline = time.monotonic() + self.window
+                while not (self._closed or self._flush_requests):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+
+                registries = list(self._pending.values())
+                self._pending.clear()
+                self._pushing = True
+            try:
+                self._push(registries)
+            finally:
+                with self._lock:
+                    self._pushing = False
+                    self._idle.notify_all()
+
+    def _push(self, registries: list[CollectorRegistry]) -> None:
+        registry = CollectorRegistry()
+        handler = partial(_protobuf_handler, registry) if self.protobuf else default_handler
+        request: dict = {}
+        if self.spool is not None:
+            registries = [*registries, self._spool_deltas.take()]
+            handler = partial(_spooling_handler, handler, request)
+        registry.register(_MergedCollector(registries))
+        for attempt in range(self.retries + 1):
+            try:
+                push_to_gateway(self.gateway, job=self.job, registry=registry, timeout=self.timeout, handler=handler)
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.warning(f"Failed to push metrics to {self.gateway} after {attempt + 1} attempts: {e!r}")
+                    if self.spool is not None and request:
+                        self.spool.append(_encode_request(request))
+                    return
+                time.sleep(self.backoff * 2**attempt)
+
+    def replay(self, payload: bytes, spooled: float) -> bool:
+        request, data = _decode_request(payload)
+        try:
+            default_handler(request["url"], request["method"], self.timeout, request["headers"], data)()
+        except Exception:
+            return False
+        return True
+
+
+@lru_cache
+def get_publisher(gateway: str, job: str) -> PushPublisher:
+    publisher = PushPublisher(
+        gateway,
+        job,
+        window=settings.push_coalesce_window,
+        timeout=settings.push_timeout,
+        retries=settings.push_retries,
+        backoff=settings.push_backoff,
+        protobuf=settings.push_protobuf,
+        spool=get_spool("push", job),
+    )
+    if publisher.spool is not None:
+        publisher.spool.start_replay(publisher.replay)
+    atexit.register(publisher.close, timeout=settings.push_flush_timeout)
+    return publisher
@@ -0,0 +1,132 @@
+import gc
+import sys
+import threading
+import time
+import tracemalloc
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, where only thread CPU time is measured
+    resource = None  # type: ignore[assignment]
+
+# Per-thread usage where the platform has it (Linux), otherwise the whole process
+_RUSAGE_WHO = getattr(resource, "RUSAGE_THREAD", getattr(resource, "RUSAGE_SELF", 0))
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+
+# Collections and total pause time of the garbage collector since _track_gc was first called
+_gc_collections = 0
+_gc_pause = 0.0
+_gc_started = 0.0
+
+
+# The running tracemalloc peak of every measure() block still open, in any thread. tracemalloc
+# has a single peak for the whole process, so before a block resets it the peak so far is kept
+# for the blocks around it (or running next to it).
+_traced_peaks: dict[int, int] = {}
+_traced_lock = threading.Lock()
+
+
+def _fold_traced_peak() -> None:
+    peak = tracemalloc.get_traced_memory()[1]
+    for key, running in _traced_peaks.items():
+        if peak > running:
+            _traced_peaks[key] = peak
+
+
+def _on_gc(phase: str, info: dict[str, int]) -> None:
+    global _gc_collections, _gc_pause, _gc_started
+    if phase == "start":
+        _gc_started = time.perf_counter()
+    else:
+        _gc_collections += 1
+        _gc_pause += time.perf_counter() - _gc_started
+
+
+def _track_gc() -> None:
+    if _on_gc not in gc.callbacks:
+        gc.callbacks.append(_on_gc)
+
+
+class ResourceUsage:
+    """What one block of code used, filled in by `measure` when the block exits.
+
+    CPU time is the calling thread's where the platform can tell threads apart (Linux). The
+    others are process-wide: the increase of the process' peak RSS, garbage collections (and
+    their pauses) that ran during the block, and the peak of memory traced by tracemalloc.
+    """
+
+    __slots__ = ("wall", "cpu_user", "cpu_system", "max_rss_increase", "gc_collections", "gc_pause", "traced_peak")
+
+    def __init__(self) -> None:
+        self.wall = 0.0
+        self.cpu_user = 0.0
+        self.cpu_system = 0.0
+        self.max_rss_increase = 0
+        self.gc_collections = 0
+        self.gc_pause = 0.0
+        self.traced_peak: int | None = None
+
+    def attributes(self) -> dict[str, Any]:
+        attributes = {
+            "resource.wall_time": self.wall,
+            "resource.cpu_user_time": self.cpu_user,
+            "resource.cpu_system_time": self.cpu_system,
+            "resource.max_rss_increase": self.max_rss_increase,
+            "resource.gc_collections": self.gc_collections,
+            "resource.gc_pause_time": self.gc_pause,
+        }
+        if self.traced_peak is not None:
+            attributes["resource.traced_memory_peak"] = self.traced_peak
+        return attributes
+
+
+def _cpu_times() -> tuple[float, float, int]:
+    if resource is None:
+        return time.thread_time(), 0.0, 0
+    usage = resource.getrusage(_RUSAGE_WHO)
+    # ru_maxrss is always the process' peak, even for RUSAGE_THREAD
+    return usage.ru_utime, usage.ru_stime, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_BYTES
+
+
+@contextmanager
+def measure(trace_memory: bool = False) -> Iterator[ResourceUsage]:
+    """Measures the resources used by the block, see `ResourceUsage`.
+
+    With `trace_memory`, tracemalloc is started (and left running) to also record the peak of
+    traced memory above what was traced when the block started. Blocks can be nested or run in
+    several threads at once: each one's peak covers all of it. Tracing slows every allocation
+    down, so it is best kept for investigations.
+    """
+    _track_gc()
+    usage = ResourceUsage()
+    traced = 0
+    if trace_memory:
+        with _traced_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            _fold_traced_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            _traced_peaks[id(usage)] = traced
+    collections, pause = _gc_collections, _gc_pause
+    user, system, max_rss = _cpu_times()
+    start = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        usage.wall = time.perf_counter() - start
+        end_user, end_system, end_max_rss = _cpu_times()
+        usage.cpu_user = end_user - user
+        usage.cpu_system = end_system - system
+        usage.max_rss_increase = end_max_rss - max_rss
+        usage.gc_collections = _gc_collections - collections
+        usage.gc_pause = _gc_pause - pause
+        if trace_memory:
+            with _traced_lock:
+                if tracemalloc.is_tracing():
+                    _fold_traced_peak()
+                usage.traced_peak = max(_traced_peaks.pop(id(usage)) - traced, 0)
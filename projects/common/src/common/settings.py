@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -5,6 +7,143 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     service: str = Field(default="flows")
     push_gateway: str = Field(default="http://pushgateway:9091")
+    # Pushes are sent from a background thread: registries pushed within the window share a
+    # request, each request times out after push_timeout seconds and is retried push_retries
+    # times with exponential backoff. At exit, pending pushes get push_flush_timeout seconds.
+    push_coalesce_window: float = Field(default=0.5)
+    push_timeout: float = Field(default=5.0)
+    push_retries: int = Field(default=3)
+    push_backoff: float = Field(default=0.5)
+    push_flush_timeout: float = Field(default=10.0)
+    # Push in the protobuf format (so native histograms are included) instead of text. Only for
+    # gateways that accept it, such as the Prometheus Pushgateway. Flow histograms only keep
+    # native buckets when this and native_histograms are both set.
+    push_protobuf: bool = Field(default=False)
+
+    # Number of recent (method, path) -> route template resolutions kept by PrometheusMiddleware
+    route_cache_size: int = Field(default=1024)
+    # Seconds a rendered /metrics payload is reused for before the registry is rendered again
+    metrics_cache_ttl: float = Field(default=1.0)
+    # Multi-process metrics (eg uvicorn/gunicorn with several workers). prometheus_client reads
+    # the same environment variable when it is first imported, so it must be set before start up.
+    prometheus_multiproc_dir: str | None = Field(default=None)
+    # Minimum seconds between sweeps for the metric files of workers that have exited
+    prometheus_multiproc_cleanup_interval: float = Field(default=30.0)
+    # accumulated_exceptions counts the errors of each function over the last window seconds,
+    # in `buckets` time buckets, minus the threshold: it turns zero or positive at `threshold` errors.
+    # Only the routes of the HTTP services (PrometheusMiddleware) have a window. Flow runs are short
+    # lived processes and the aggregation gateway adds up what they push, so a window kept in a run
+    # would never age out there: data_flow and data_task errors are only counted in run_errors_total.
+    accumulated_exceptions_window: float = Field(default=300.0)
+    accumulated_exceptions_buckets: int = Field(default=60)
+    accumulated_exceptions_threshold: int = Field(default=1)
+    # Each group of labelled metrics (eg the route metrics by function, the flow metrics by flow)
+    # creates series for at most metric_label_limit label sets, recording any others under the
+    # "__overflow__" value. Label sets unused for metric_label_ttl seconds are removed, except in
+    # multi-process mode, where series can't be removed and only the limit applies. Limits are
+    # per process: each flow run is a process of its own, so the flow limit only caps the flows
+    # of one run (eg flows called from a flow), not the flow series that build up in the
+    # aggregation gateway across runs.
+    metric_label_limit: int = Field(default=1000)
+    metric_label_ttl: float | None = Field(default=3600.0)
+    # Latency histograms also keep sparse exponential (native) buckets next to the classic ones,
+    # exposed to scrapers that negotiate the protobuf format. Bucket bounds grow by a factor of
+    # 2**(2**-schema) (schema 3 is ~9%), and the resolution is halved whenever a series would
+    # use more than max_buckets. Not available in multi-process mode, which keeps classic only.
+    # The pushed flow metrics only keep native buckets with push_protobuf, as text pushes (all the
+    # docker-compose aggregation gateway accepts) can't carry them.
+    native_histograms: bool = Field(default=True)
+    native_histogram_schema: int = Field(default=3)
+    native_histogram_max_buckets: int = Field(default=160)
+
+    # Queued log sink: records are handed to a background writer thread instead of
+    # being written to stderr on the caller's thread
+    log_queue: bool = Field(default=False)
+    log_queue_size: int = Field(default=10_000)
+    log_queue_overflow: Literal["block", "drop_oldest", "drop_newest"] = Field(default="drop_oldest")
+    log_queue_batch_size: int = Field(default=512)
+    log_flush_interval: float = Field(default=0.2)
+    # Lowest level written to the logs. Stdlib records below it are rejected before reaching loguru.
+    log_level: str = Field(default="DEBUG")
+    # Lowest level of the stdlib loggers (set on the root logger), on top of log_level. Libraries
+    # log chatty DEBUG records through the stdlib (eg httpcore on every request), so it is higher.
+    stdlib_log_level: str = Field(default="INFO")
+    # Flood protection per call site (file, line and level): after log_rate_burst lines, a call
+    # site may log log_rate_limit lines per second. Suppressed lines are counted and reported in
+    # one summary record per call site every log_rate_summary_interval seconds. Off while None.
+    log_rate_limit: float | None = Field(default=None)
+    log_rate_burst: int = Field(default=200)
+    log_rate_max_keys: int = Field(default=1024)
+    log_rate_summary_interval: float = Field(default=10.0)
+
+    # Mirroring of log records into events on the active span. Records below the level are
+    # not mirrored, and once a span holds `limit` log events further ones are only counted
+    # in its log.events_dropped attribute. None disables the limit / value trimming.
+    log_span_event_level: str = Field(default="TRACE")
+    log_span_event_limit: int | None = Field(default=128)
+    log_span_event_value_length: int | None = Field(default=None)
+
+    # Span export. Named after the standard OTEL_* environment variables so existing deployments
+    # keep working; spans are only exported when an endpoint is set. The otel_bsp_* values size
+    # the batch span processor (delay and timeout in milliseconds): spans ending while its queue
+    # is full are dropped.
+    otel_exporter_otlp_endpoint: str | None = Field(default=None)
+    otel_exporter_otlp_protocol: Literal["grpc", "http/protobuf"] = Field(default="grpc")
+    otel_exporter_otlp_compression: Literal["none", "gzip", "deflate"] = Field(default="none")
+    otel_bsp_max_queue_size: int = Field(default=2048)
+    otel_bsp_max_export_batch_size: int = Field(default=512)
+    otel_bsp_schedule_delay: float = Field(default=5000)
+    otel_bsp_export_timeout: float = Field(default=30000)
+
+    # Tail sampling: spans are held per trace until its local root span ends (or
+    # trace_sampling_decision_wait seconds pass, or trace_sampling_max_spans are buffered), then
+    # the whole trace is kept if any span errored or ran longer than the latency threshold
+    # (in seconds). Otherwise trace_sampling_ratio of traces are kept, chosen by trace id.
+    trace_sampling: bool = Field(default=False)
+    trace_sampling_ratio: float = Field(default=0.1)
+    trace_sampling_latency_threshold: float = Field(default=1.0)
+    trace_sampling_decision_wait: float = Field(default=10.0)
+    trace_sampling_max_spans: int = Field(default=20_000)
+
+    # Resource accounting for each data_task and data_flow run: CPU, wall and GC time, collections
+    # and the peak RSS increase, recorded on the run's span and in the run_* histograms. With
+    # resource_tracemalloc the peak of traced memory is added, which slows allocations down.
+    resource_accounting: bool = Field(default=False)
+    resource_tracemalloc: bool = Field(default=False)
+
+    # Sampling profiler for data_flow runs, also switched per flow with data_flow(profile=...).
+    # profile_sample_ratio of runs sample the flow's thread (every thread with
+    # profile_all_threads) each profile_interval seconds, backing off so that sampling takes at
+    # most profile_max_overhead of the run. Profiles are written to profile_dir, named after
+    # the flow and its trace id.
+    profile_flows: bool = Field(default=False)
+    profile_sample_ratio: float = Field(default=1.0)
+    profile_interval: float = Field(default=0.01)
+    profile_max_overhead: float = Field(default=0.02)
+    profile_all_threads: bool = Field(default=False)
+    profile_dir: str = Field(default="profiles")
+    profile_format: Literal["collapsed", "speedscope"] = Field(default="speedscope")
+
+    # Defaults for batched_map: items per chunk, and the pool that runs the chunks. Without
+    # map_max_workers the pool has one worker per CPU.
+    map_chunk_size: int = Field(default=500)
+    map_executor: Literal["thread", "process"] = Field(default="thread")
+    map_max_workers: int | None = Field(default=None)
+
+    # Disk spool for telemetry that could not be sent, off unless spool_dir is set. Span batches
+    # the collector did not take and pushes that failed every retry are appended to segment files
+    # (a new one every spool_segment_bytes, the oldest deleted past spool_max_bytes), then
+    # replayed oldest first at up to spool_replay_rate records per second, retrying every
+    # spool_replay_interval seconds while the endpoint is down. Processes can share spool_dir
+    # (eg a deployment's flow runs): each writes segments of its own and replays everyone's. With
+    # a spool, a span export is given up on (and its batch spooled) after spool_export_timeout
+    # seconds, and spans are only spooled after an export of this process failed.
+    spool_dir: str | None = Field(default=None)
+    spool_max_bytes: int = Field(default=256 * 1024**2)
+    spool_segment_bytes: int = Field(default=8 * 1024**2)
+    spool_replay_rate: float = Field(default=10.0)
+    spool_replay_interval: float = Field(default=5.0)
+    spool_export_timeout: float = Field(default=5.0)
 
 
 settings = Settings()
@@ -0,0 +1,381 @@
+import atexit
+import os
+import struct
+import threading
+import time
+import weakref
+import zlib
+from collections.abc import Callable
+from functools import lru_cache
+from typing import BinaryIO
+
+from loguru import logger
+
+from common.metrics import SPOOL_BYTES, SPOOL_RECORDS, SPOOL_REPLAY_LAG
+from common.settings import settings
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where segments are not locked
+    fcntl = None  # type: ignore[assignment]
+
+# Each record is its number in the segment, its payload's length, CRC32 and the time it was
+# spooled, then the payload
+_HEADER = struct.Struct("<QIId")
+_SUFFIX = ".spool"
+# Next to a segment, the number of the last record of it that was delivered
+_ACKED = ".acked"
+# A segment is created under this suffix, and only renamed once its writer holds its lock
+_NEW = ".new"
+
+# Called with a record's payload and the time it was spooled, returns whether it was delivered
+Sender = Callable[[bytes, float], bool]
+
+
+class _Record:
+    __slots__ = ("number", "payload", "spooled", "next")
+
+    def __init__(self, number: int, payload: bytes, spooled: float, next: int) -> None:
+        self.number = number
+        self.payload = payload
+        self.spooled = spooled
+        self.next = next
+
+
+def _read(f: BinaryIO, offset: int) -> _Record | None:
+    # The record at `offset`, or None at the end of the segment or at a record that was only
+    # partly written
+    f.seek(offset)
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    number, length, crc, spooled = _HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        return None
+    return _Record(number, payload, spooled, offset + _HEADER.size + length)
+
+
+def _lock(path: str) -> BinaryIO | None:
+    # The segment opened and locked for this caller, or None if another writer or replayer
+    # (in this process or another) holds it or it is gone
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    if fcntl is not None:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+    return f
+
+
+def _remove(path: str) -> None:
+    for file in (path, path + _ACKED):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+class Spool:
+    """An append-only store on disk for telemetry that could not be sent.
+
+    Several processes can share `directory` (eg the short lived flow runs of one deployment).
+    Each appends to segment files of its own, starting a new one once its current segment
+    reaches `segment_bytes`, and holds a lock on the segment it writes to. Replay, from any of
+    them, takes the segments no one else holds oldest first, locking each while it is sent, and
+    reads the segment its own process is writing to as far as it was written.
+    Once a record is delivered its number is written next to its segment, so a segment that
+    was partly replayed when its replayer stopped carries on from there: only a record whose
+    delivery was not yet acknowledged can be sent twice. Delivered segments are deleted once
+    no one writes to them. When a new segment is started while the directory is over
+    `max_bytes`, its oldest segments that no one holds are deleted (and their records counted
+    as evicted). The spool_bytes and spool_replay_lag gauges are updated as segments are
+    started and after each replay. Without fcntl (on Windows) segments can't be locked, so
+    only one process should use a directory there.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        service: str = "",
+        max_bytes: int = 256 * 1024**2,
+        segment_bytes: int = 8 * 1024**2,
+    ) -> None:
+        self.directory = directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._file: BinaryIO | None = None
+        self._path = ""
+        self._size = 0
+        self._records = 0
+        # While replay reads the segment being written to, a rotated writer's file is kept open
+        # (and locked) here until it is done, so that no one else replays it meanwhile
+        self._reading = False
+        self._retired: BinaryIO | None = None
+        # Record counts of the segments seen, by path and size, so they are only read once
+        self._counts: dict[str, tuple[int, int]] = {}
+        # Where replay stopped in a segment: the number of the last record sent and the
+        # offset of the next one
+        self._positions: dict[str, tuple[int, int]] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._bytes = SPOOL_BYTES.labels(service=service, spool=name)
+        self._lag = SPOOL_REPLAY_LAG.labels(service=service, spool=name)
+        self._spooled = SPOOL_RECORDS.labels(service=service, spool=name, action="spooled")
+        self._delivered = SPOOL_RECORDS.labels(service=service, spool=name, action="replayed")
+        self._evicted = SPOOL_RECORDS.labels(service=service, spool=name, action="evicted")
+
+        os.makedirs(directory, exist_ok=True)
+        self._update_metrics()
+        if hasattr(os, "register_at_fork"):
+            after_fork = weakref.WeakMethod(self._after_fork)
+            os.register_at_fork(after_in_child=lambda: (method := after_fork()) is not None and method())
+
+    def _after_fork(self) -> None:
+        # A forked child (eg in batched_map's process pool) shares the parent's open segment, so
+        # it starts segments of its own, and its replay thread isn't copied
+        for f in (self._file, self._retired):
+            if f is not None:
+                f.close()
+        self._lock = threading.Lock()
+        self._file, self._retired, self._reading = None, None, False
+        self._path, self._size, self._records = "", 0, 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _segments(self) -> list[str]:
+        # Segment names start with their creation time, so this is oldest first
+        files = sorted(f for f in os.listdir(self.directory) if f.endswith(_SUFFIX))
+        return [os.path.join(self.directory, file) for file in files]
+
+    @property
+    def size(self) -> int:
+        size = 0
+        for path in self._segments():
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def __len__(self) -> int:
+        # Records not delivered yet, in every segment of the directory
+        pending = 0
+        for path in self._segments():
+            pending += max(self._count(path) - self._acked(path), 0)
+        return pending
+
+    def _count(self, path: str) -> int:
+        if path == self._path:
+            return self._records
+        try:
+            size = os.path.getsize(path)
+            cached = self._counts.get(path)
+            if cached is not None and cached[0] == size:
+                return cached[1]
+            records = 0
+            with open(path, "rb") as f:
+                offset = 0
+                while (record := _read(f, offset)) is not None:
+                    records, offset = record.number, record.next
+        except FileNotFoundError:
+            return 0
+        self._counts[path] = (size, records)
+        return records
+
+    def _acked(self, path: str) -> int:
+        try:
+            with open(path + _ACKED) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _ack(self, path: str, number: int) -> None:
+        with open(path + _ACKED + _NEW, "w") as f:
+            f.write(str(number))
+        os.replace(path + _ACKED + _NEW, path + _ACKED)
+
+    def append(self, payload: bytes) -> None:
+        with self._lock:
+            rotate = self._file is None or self._size >= self.segment_bytes
+            if rotate:
+                self._rotate()
+            self._records += 1
+            record = _HEADER.pack(self._records, len(payload), zlib.crc32(payload), time.time()) + payload
+            self._file.write(record)  # type: ignore[union-attr]
+            self._file.flush()  # type: ignore[union-attr]
+            self._size += len(record)
+            self._spooled.inc()
+            # Only once per segment, as both go through every segment in the directory
+            if rotate:
+                self._evict()
+                self._update_metrics()
+
+    def _rotate(self) -> None:
+        self._close_segment()
+        path = os.path.join(self.directory, f"{time.time_ns():020d}-{os.getpid()}{_SUFFIX}")
+        f = open(path + _NEW, "ab")
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        # Only visible to replay once it is locked, so no one replays (and deletes) it meanwhile
+        os.rename(path + _NEW, path)
+        self._file, self._path, self._size, self._records = f, path, 0, 0
+
+    def _close_segment(self) -> None:
+        # New records go to a new segment from here, and this one can be replayed
+        if self._file is not None:
+            self._counts[self._path] = (self._size, self._records)
+            if self._reading:
+                self._retired = self._file
+            else:
+                self._file.close()
+        self._file, self._path, self._size, self._records = None, "", 0, 0
+
+    def _evict(self) -> None:
+        segments = self._segments()
+        sizes = {}
+        for path in segments:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        total = sum(sizes.values())
+        # Segments being written to or replayed are kept, even if they alone are over the cap
+        for path in segments:
+            if total <= self.max_bytes:
+                break
+            if path == self._path or path not in sizes:
+                continue
+            f = _lock(path)
+            if f is None:
+                continue
+            try:
+                self._evicted.inc(max(self._count(path) - self._acked(path), 0))
+                _remove(path)
+                self._forget(path)
+                total -= sizes[path]
+            finally:
+                f.close()
+
+    def _forget(self, path: str) -> None:
+        self._counts.pop(path, None)
+        self._positions.pop(path, None)
+
+    def _update_metrics(self) -> None:
+        self._bytes.set(self.size)
+        lag = 0.0
+        for path in self._segments():
+            try:
+                with open(path, "rb") as f:
+                    record = self._next_record(path, f)
+            except FileNotFoundError:
+                continue
+            if record is not None:
+                lag = time.time() - record.spooled
+                break
+        self._lag.set(lag)
+
+    def _next_record(self, path: str, f: BinaryIO) -> _Record | None:
+        # The first record of the segment that was not delivered yet
+        acked = self._acked(path)
+        number, offset = self._positions.get(path, (0, 0))
+        if number > acked:
+            number, offset = 0, 0
+        while (record := _read(f, offset)) is not None and record.number <= acked:
+            offset = record.next
+        self._positions[path] = (acked, offset)
+        return record
+
+    def replay(self, send: Sender, limit: int | None = None) -> int:
+        """Sends up to `limit` records, oldest first, stopping at the first one not delivered."""
+        replayed = 0
+        try:
+            for path in self._segments():
+                if limit is not None and replayed >= limit:
+                    break
+                with self._lock:
+                    own = path == self._path
+                    self._reading = own
+                # This process's writer already holds the lock on the segment it writes to
+                f = open(path, "rb") if own else _lock(path)
+                if f is None:
+                    continue  # being written to, or replayed, by someone else
+                try:
+                    while limit is None or replayed < limit:
+                        record = self._next_record(path, f)
+                        if record is None:
+                            # Delivered (or only partly written before a crash), so the segment is
+                            # done, unless more records are still to be written to it
+                            if not own:
+                                _remove(path)
+                                self._forget(path)
+                            break
+                        if not send(record.payload, record.spooled):
+                            return replayed
+                        self._ack(path, record.number)
+                        self._positions[path] = (record.number, record.next)
+                        self._delivered.inc()
+                        replayed += 1
+                finally:
+                    f.close()
+                    if own:
+                        with self._lock:
+                            self._reading = False
+                            if self._retired is not None:
+                                self._retired.close()
+                                self._retired = None
+        finally:
+            with self._lock:
+                self._update_metrics()
+        return replayed
+
+    def start_replay(self, send: Sender, rate: float | None = None, interval: float | None = None) -> None:
+        """Replays in a background thread at up to `rate` records per second. While nothing is
+        spooled or records are not being delivered, replay is retried every `interval` seconds."""
+        if self._thread is not None:
+            return
+        rate = rate or settings.spool_replay_rate
+        interval = interval or settings.spool_replay_interval
+
+        def run() -> None:
+            while True:
+                try:
+                    delivered = self.replay(send, limit=1)
+                except Exception as e:
+                    logger.warning(f"Failed to replay the {self.name} spool: {e!r}")
+                    delivered = 0
+                if self._stop.wait(1 / rate if delivered else interval):
+                    return
+
+        self._thread = threading.Thread(target=run, name=f"{self.name}-spool-replay", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self._close_segment()
+
+
+@lru_cache
+def get_spool(name: str, service: str) -> Spool | None:
+    # One spool per kind of telemetry under settings.spool_dir, or None when spooling is off
+    if settings.spool_dir is None:
+        return None
+    spool = Spool(
+        os.path.join(settings.spool_dir, name),
+        name,
+        service=service,
+        max_bytes=settings.spool_max_bytes,
+        segment_bytes=settings.spool_segment_bytes,
+    )
+    atexit.register(spool.close)
+    return spool
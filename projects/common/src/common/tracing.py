@@ -1,33 +1,521 @@
 import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
+from typing import TYPE_CHECKING
 
+from loguru import logger
 from opentelemetry import trace
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from opentelemetry.context import Context
 from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.trace import SpanKind, Tracer
+from opentelemetry.sdk.trace import Event, ReadableSpan, Span, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.sampling import TraceIdRatioBased
+from opentelemetry.sdk.util.instrumentation import InstrumentationScope
+from opentelemetry.trace import Link, SpanContext, SpanKind, Status, StatusCode, TraceFlags, TraceState, Tracer
+from opentelemetry.util.types import AttributeValue
+
+from common.metrics import (
+    SAMPLED_TRACES,
+    SAMPLING_BUFFERED_SPANS,
+    SPAN_EXPORT_TIME,
+    SPAN_QUEUE_DEPTH,
+    SPANS_DROPPED,
+    SPANS_EXPORTED,
+)
+from common.settings import settings
+from common.spool import Spool, get_spool
+
+if TYPE_CHECKING:
+    from opentelemetry.proto.common.v1.common_pb2 import AnyValue, KeyValue
+
+
+def _is_asgi_event(span: ReadableSpan) -> bool:
+    if span.kind == SpanKind.INTERNAL and span.attributes is not None:
+        span_type = span.attributes.get("type", None)
+        return span_type in (
+            "http.request",
+            "http.response.start",
+            "http.response.body",
+        )
+    return False
+
+
+class InstrumentedSpanExporter(SpanExporter):
+    """Wraps a span exporter to record export latency and how many spans were exported."""
+
+    def __init__(self, exporter: SpanExporter, service: str) -> None:
+        self.exporter = exporter
+        self._export_time = SPAN_EXPORT_TIME.labels(service=service)
+        self._success = SPANS_EXPORTED.labels(service=service, result="success")
+        self._failure = SPANS_EXPORTED.labels(service=service, result="failure")
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        start = time.perf_counter()
+        result = SpanExportResult.FAILURE
+        try:
+            result = self.exporter.export(spans)
+            return result
+        finally:
+            self._export_time.observe(time.perf_counter() - start)
+            (self._success if result == SpanExportResult.SUCCESS else self._failure).inc(len(spans))
+
+    def shutdown(self) -> None:
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
+
+
+class DeadlineSpanExporter(SpanExporter):
+    """Gives each export through `exporter` at most `timeout` seconds before failing it.
+
+    The OTLP exporters retry a failed batch with backoff (for up to a minute on older SDKs),
+    while the span queue fills up behind it. With a spool to fall back on, a short deadline is
+    enough. An export that ran out of time carries on in the background, so its batch may still
+    be delivered after it was spooled, and exports fail straight away until it is done.
+    """
+
+    def __init__(self, exporter: SpanExporter, timeout: float) -> None:
+        self.exporter = exporter
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="span-export")
+        self._future: Future[SpanExportResult] | None = None
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        with self._lock:
+            if self._future is not None and not self._future.done():
+                return SpanExportResult.FAILURE
+            future = self._future = self._executor.submit(self.exporter.export, spans)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            return SpanExportResult.FAILURE
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
+
+
+def _decode_value(value: "AnyValue") -> AttributeValue:
+    kind = value.WhichOneof("value")
+    if kind == "array_value":
+        return tuple(_decode_value(v) for v in value.array_value.values)  # type: ignore[return-value]
+    return getattr(value, kind) if kind is not None else ""
+
+
+def _decode_attributes(attributes: Iterable["KeyValue"]) -> dict[str, AttributeValue]:
+    return {attribute.key: _decode_value(attribute.value) for attribute in attributes}
+
+
+def _decode_context(trace_id: bytes, span_id: bytes, flags: int, trace_state: str = "") -> SpanContext:
+    from opentelemetry.proto.trace.v1.trace_pb2 import SpanFlags
+
+    return SpanContext(
+        int.from_bytes(trace_id, "big"),
+        int.from_bytes(span_id, "big"),
+        is_remote=bool(flags & SpanFlags.SPAN_FLAGS_CONTEXT_IS_REMOTE_MASK),
+        trace_flags=TraceFlags(TraceFlags.SAMPLED),
+        trace_state=TraceState.from_header([trace_state]) if trace_state else None,
+    )
+
+
+def decode_spans(payload: bytes) -> list[ReadableSpan]:
+    """The spans of an encoded OTLP ExportTraceServiceRequest, as the SDK hands them to exporters.
+
+    Spooled batches are kept in the OTLP wire format, which doesn't change between SDK versions,
+    and turned back into spans to be replayed through an exporter's public `export`.
+    """
+    from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+
+    spans = []
+    for resource_spans in ExportTraceServiceRequest.FromString(payload).resource_spans:
+        resource = Resource(_decode_attributes(resource_spans.resource.attributes), resource_spans.schema_url)
+        for scope_spans in resource_spans.scope_spans:
+            scope = InstrumentationScope(scope_spans.scope.name, scope_spans.scope.version, scope_spans.schema_url)
+            for span in scope_spans.spans:
+                parent = None
+                if span.parent_span_id:
+                    parent = _decode_context(span.trace_id, span.parent_span_id, span.flags)
+                spans.append(
+                    ReadableSpan(
+                        name=span.name,
+                        context=_decode_context(span.trace_id, span.span_id, 0, span.trace_state),
+                        parent=parent,
+                        resource=resource,
+                        attributes=_decode_attributes(span.attributes),
+                        events=[
+                            Event(event.name, _decode_attributes(event.attributes), event.time_unix_nano)
+                            for event in span.events
+                        ],
+                        links=[
+                            Link(
+                                _decode_context(link.trace_id, link.span_id, link.flags),
+                                _decode_attributes(link.attributes),
+                            )
+                            for link in span.links
+                        ],
+                        kind=SpanKind(span.kind - 1),
+                        status=Status(StatusCode(span.status.code), span.status.message or None),
+                        start_time=span.start_time_unix_nano,
+                        end_time=span.end_time_unix_nano,
+                        instrumentation_scope=scope,
+                    )
+                )
+    return spans
+
+
+class SpoolingSpanExporter(SpanExporter):
+    """Wraps a span exporter to write the batches it fails to export to a spool.
+
+    After a failed export, batches go straight to the spool until the spool's replay gets one
+    through, which switches back to exporting them. That way the span queue keeps draining while
+    the collector is down, and the backlog drains next to live exports once it is back. Only
+    this exporter's own failures send it to the spool, but its replay goes through the
+    backlog of every process sharing the spool's directory. The wrapped exporter should give up
+    on a batch quickly (see `DeadlineSpanExporter`), or the first failed batch waits out all of
+    its retries.
+    """
+
+    def __init__(self, exporter: SpanExporter, spool: Spool) -> None:
+        from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+
+        self.exporter = exporter
+        self.spool = spool
+        self._encode = encode_spans
+        self._down = False
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        if not self._down:
+            try:
+                if self.exporter.export(spans) == SpanExportResult.SUCCESS:
+                    return SpanExportResult.SUCCESS
+            except Exception as e:
+                logger.warning(f"Failed to export {len(spans)} spans, spooling them: {e!r}")
+            self._down = True
+        self.spool.append(self._encode(spans).SerializePartialToString())
+        return SpanExportResult.SUCCESS
+
+    def replay(self, payload: bytes, spooled: float) -> bool:
+        try:
+            delivered = self.exporter.export(decode_spans(payload)) == SpanExportResult.SUCCESS
+        except Exception:
+            return False
+        if delivered:
+            self._down = False
+        return delivered
+
+    def shutdown(self) -> None:
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
+
+
+def _call_weakly(method: Callable[[], None]) -> Callable[[], None]:
+    # For os.register_at_fork, whose hooks can't be removed, so they mustn't keep their object alive
+    reference = weakref.WeakMethod(method)
+
+    def call() -> None:
+        if (method := reference()) is not None:
+            method()
+
+    return call
+
+
+class _DequeuingSpanExporter(SpanExporter):
+    # Tells MinimalSpanProcessor which spans have left its queue, on their way to `exporter`
+    def __init__(self, exporter: SpanExporter, processor: "MinimalSpanProcessor") -> None:
+        self.exporter = exporter
+        self.processor = processor
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        self.processor._dequeued(len(spans))
+        return self.exporter.export(spans)
+
+    def shutdown(self) -> None:
+        self.exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
 
 
 class MinimalSpanProcessor(BatchSpanProcessor):
+    """A BatchSpanProcessor that skips ASGI events and reports its queue depth and drops.
+
+    The queue is tracked from the outside, counting spans as they are queued and as they are
+    handed to the exporter, so that only the public BatchSpanProcessor interface is relied on.
+    A span queued while `max_queue_size` spans are waiting pushes out the oldest one.
+    """
+
+    def __init__(
+        self,
+        span_exporter: SpanExporter,
+        service: str = "",
+        max_queue_size: int | None = None,
+        schedule_delay_millis: float | None = None,
+        max_export_batch_size: int | None = None,
+        export_timeout_millis: float | None = None,
+    ) -> None:
+        self._max_queue_size = max_queue_size or settings.otel_bsp_max_queue_size
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+        super().__init__(
+            _DequeuingSpanExporter(span_exporter, self),
+            max_queue_size=max_queue_size,
+            schedule_delay_millis=schedule_delay_millis,
+            max_export_batch_size=max_export_batch_size,
+            export_timeout_millis=export_timeout_millis,
+        )
+        self._queue_depth = SPAN_QUEUE_DEPTH.labels(service=service)
+        self._dropped = SPANS_DROPPED.labels(service=service)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_call_weakly(self._after_fork))
+
     def on_end(self, span: ReadableSpan) -> None:
-        if span.kind == SpanKind.INTERNAL and span.attributes is not None:
-            span_type = span.attributes.get("type", None)
-            if span_type in (
-                "http.request",
-                "http.response.start",
-                "http.response.body",
-            ):
-                return
+        if _is_asgi_event(span):
+            return
+        if span.context.trace_flags.sampled and not self._stopped:
+            with self._lock:
+                if self._queued >= self._max_queue_size:
+                    self._dropped.inc()
+                else:
+                    self._queued += 1
+                self._queue_depth.set(self._queued)
         super().on_end(span=span)
 
+    def _dequeued(self, count: int) -> None:
+        with self._lock:
+            self._queued = max(self._queued - count, 0)
+            self._queue_depth.set(self._queued)
+
+    def _after_fork(self) -> None:
+        # A forked child starts with an empty BatchSpanProcessor queue
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._queue_depth.set(0)
+
+    def shutdown(self) -> None:
+        self._stopped = True
+        super().shutdown()
+
+
+class _TraceBuffer:
+    __slots__ = ("spans", "deadline", "error", "slow")
+
+    def __init__(self, deadline: float) -> None:
+        self.spans: list[ReadableSpan] = []
+        self.deadline = deadline
+        self.error = False
+        self.slow = False
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """Holds finished spans per trace and only forwards the traces worth keeping.
+
+    A trace is decided once its local root span ends, once it has waited `decision_wait`
+    seconds, or when more than `max_spans` spans are buffered (oldest traces first). Traces
+    with an error or a span slower than `latency_threshold` seconds are always kept; of the
+    rest, `ratio` are kept using the same trace id test as `TraceIdRatioBased`, so every
+    service keeps the same traces. Spans arriving after their trace was decided follow it.
+    """
+
+    def __init__(
+        self,
+        processor: SpanProcessor,
+        service: str = "",
+        ratio: float = 0.1,
+        latency_threshold: float = 1.0,
+        decision_wait: float = 10.0,
+        max_spans: int = 20_000,
+        max_decisions: int = 10_000,
+    ) -> None:
+        self.processor = processor
+        self.bound = TraceIdRatioBased.get_bound_for_rate(ratio)
+        self.latency_threshold_ns = int(latency_threshold * 1e9)
+        self.decision_wait = decision_wait
+        self.max_spans = max_spans
+        self.max_decisions = max_decisions
+        self._traces: OrderedDict[int, _TraceBuffer] = OrderedDict()
+        self._decisions: OrderedDict[int, bool] = OrderedDict()
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._decided = {
+            decision: SAMPLED_TRACES.labels(service=service, decision=decision)
+            for decision in ("error", "latency", "ratio", "dropped")
+        }
+        self._buffered_spans = SAMPLING_BUFFERED_SPANS.labels(service=service)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=_call_weakly(self._after_fork))
+
+    def on_start(self, span: Span, parent_context: Context | None = None) -> None:
+        self.processor.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if _is_asgi_event(span) or not span.context.trace_flags.sampled:
+            return
+        trace_id = span.context.trace_id
+        decided: list[tuple[_TraceBuffer, bool]] = []
+        with self._lock:
+            keep = self._decisions.get(trace_id)
+            if keep is None:
+                buffer = self._traces.get(trace_id)
+                if buffer is None:
+                    buffer = self._traces[trace_id] = _TraceBuffer(time.monotonic() + self.decision_wait)
+                    self._ensure_thread()
+                buffer.spans.append(span)
+                self._buffered += 1
+                if span.status.status_code == StatusCode.ERROR:
+                    buffer.error = True
+                if span.end_time is not None and span.start_time is not None:
+                    if span.end_time - span.start_time > self.latency_threshold_ns:
+                        buffer.slow = True
+
+                if span.parent is None or span.parent.is_remote:
+                    decided.append(self._decide(trace_id))
+                while self._buffered > self.max_spans and self._traces:
+                    decided.append(self._decide(next(iter(self._traces))))
+                self._buffered_spans.set(self._buffered)
+        if keep:
+            self.processor.on_end(span)
+        self._forward(decided)
+
+    def _decide(self, trace_id: int) -> tuple[_TraceBuffer, bool]:
+        buffer = self._traces.pop(trace_id)
+        self._buffered -= len(buffer.spans)
+        if buffer.error:
+            decision = "error"
+        elif buffer.slow:
+            decision = "latency"
+        elif trace_id & TraceIdRatioBased.TRACE_ID_LIMIT < self.bound:
+            decision = "ratio"
+        else:
+            decision = "dropped"
+        self._decided[decision].inc()
+
+        keep = decision != "dropped"
+        self._decisions[trace_id] = keep
+        if len(self._decisions) > self.max_decisions:
+            self._decisions.popitem(last=False)
+        return buffer, keep
+
+    def _forward(self, decided: list[tuple[_TraceBuffer, bool]]) -> None:
+        for buffer, keep in decided:
+            if keep:
+                for span in buffer.spans:
+                    self.processor.on_end(span)
+
+    def _expire(self, everything: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            # Traces are stored oldest first, so the first one still waiting ends the sweep
+            expired = []
+            for trace_id, buffer in self._traces.items():
+                if not everything and buffer.deadline > now:
+                    break
+                expired.append(trace_id)
+            decided = [self._decide(trace_id) for trace_id in expired]
+            self._buffered_spans.set(self._buffered)
+        self._forward(decided)
+
+    def _after_fork(self) -> None:
+        # Traces buffered in the parent are the parent's to decide and forward
+        self._lock = threading.Lock()
+        self._traces.clear()
+        self._buffered = 0
+        self._thread = None
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="tail-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        interval = min(max(self.decision_wait / 4, 0.05), 1.0)
+        while not self._stop.wait(interval):
+            self._expire()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._expire(everything=True)
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        self._expire(everything=True)
+        return self.processor.force_flush(timeout_millis)
+
+
+def create_span_exporter(endpoint: str, timeout: float | None = None) -> SpanExporter:
+    # Exporters are imported here as grpc is slow to import and unused when nothing is exported
+    timeout = timeout or settings.otel_bsp_export_timeout / 1000
+    if settings.otel_exporter_otlp_protocol == "http/protobuf":
+        from opentelemetry.exporter.otlp.proto.http import Compression as HTTPCompression
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter as HTTPSpanExporter
+
+        # The base endpoint only has the signal path appended when read from the environment
+        if not endpoint.rstrip("/").endswith("/v1/traces"):
+            endpoint = endpoint.rstrip("/") + "/v1/traces"
+        return HTTPSpanExporter(
+            endpoint=endpoint,
+            timeout=timeout,
+            compression=HTTPCompression(settings.otel_exporter_otlp_compression),
+        )
+
+    from grpc import Compression as GRPCCompression
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter as GRPCSpanExporter
+
+    compression = {
+        "none": GRPCCompression.NoCompression,
+        "gzip": GRPCCompression.Gzip,
+        "deflate": GRPCCompression.Deflate,
+    }[settings.otel_exporter_otlp_compression]
+    return GRPCSpanExporter(endpoint=endpoint, timeout=timeout, compression=compression)
+
 
 @lru_cache
 def get_tracer(service: str) -> Tracer:
     resource = Resource.create(attributes={"service.name": service})
     tracer = TracerProvider(resource=resource)
     trace.set_tracer_provider(tracer)
-    if "OTEL_EXPORTER_OTLP_ENDPOINT" in os.environ:
-        exporter = OTLPSpanExporter(endpoint=os.environ["OTEL_EXPORTER_OTLP_ENDPOINT"])
-        tracer.add_span_processor(MinimalSpanProcessor(exporter))
+    if settings.otel_exporter_otlp_endpoint:
+        spool = get_spool("spans", service)
+        if spool is not None:
+            # Exporters whose retries are bounded by their timeout stop about when the deadline passes
+            timeout = settings.spool_export_timeout
+            exporter: SpanExporter = create_span_exporter(settings.otel_exporter_otlp_endpoint, timeout=timeout)
+            exporter = InstrumentedSpanExporter(DeadlineSpanExporter(exporter, timeout), service)
+            exporter = SpoolingSpanExporter(exporter, spool)
+            spool.start_replay(exporter.replay)
+        else:
+            exporter = create_span_exporter(settings.otel_exporter_otlp_endpoint)
+            exporter = InstrumentedSpanExporter(exporter, service)
+        processor: SpanProcessor = MinimalSpanProcessor(
+            exporter,
+            service=service,
+            max_queue_size=settings.otel_bsp_max_queue_size,
+            schedule_delay_millis=settings.otel_bsp_schedule_delay,
+            max_export_batch_size=settings.otel_bsp_max_export_batch_size,
+            export_timeout_millis=settings.otel_bsp_export_timeout,
+        )
+        if settings.trace_sampling:
+            processor = TailSamplingSpanProcessor(
+                processor,
+                service=service,
+                ratio=settings.trace_sampling_ratio,
+                latency_threshold=settings.trace_sampling_latency_threshold,
+                decision_wait=settings.trace_sampling_decision_wait,
+                max_spans=settings.trace_sampling_max_spans,
+            )
+        tracer.add_span_processor(processor)
     return trace.get_tracer(service)
@@ -0,0 +1,132 @@
+import asyncio
+import math
+import time
+from collections.abc import Awaitable, Callable
+from random import random, uniform
+
+import httpx
+from common.metrics import LABEL_OVERFLOW, OVERFLOW_LABEL, CardinalityLimiter, remove_series
+from common.settings import settings
+from loguru import logger
+from prometheus_client import Counter, Histogram
+
+POLL_TIME = Histogram(
+    "poll_time",
+    "Histogram of poll latency by target (in seconds)",
+    labelnames=["service", "target"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf")),
+)
+POLLS = Counter(
+    "polls",
+    "Total number of polls by target and result (success, failure, timeout or skipped)",
+    labelnames=["service", "target", "result"],
+)
+
+Poll = Callable[[httpx.AsyncClient, str], Awaitable[None]]
+
+
+class TargetMetrics:
+    """The poll metric children for one (service, target) pair, bound once and then reused."""
+
+    __slots__ = ("time", "success", "failure", "timeout", "skipped")
+
+    def __init__(self, service: str, target: str) -> None:
+        self.time = POLL_TIME.labels(service=service, target=target)
+        self.success = POLLS.labels(service=service, target=target, result="success")
+        self.failure = POLLS.labels(service=service, target=target, result="failure")
+        self.timeout = POLLS.labels(service=service, target=target, result="timeout")
+        self.skipped = POLLS.labels(service=service, target=target, result="skipped")
+
+
+_target_metrics: dict[tuple[str, ...], TargetMetrics] = {}
+
+
+def _evict_target(labels: tuple[str, ...]) -> None:
+    _target_metrics.pop(labels, None)
+    remove_series(labels, POLL_TIME, POLLS)
+
+
+target_limiter = CardinalityLimiter(settings.metric_label_limit, settings.metric_label_ttl, on_evict=_evict_target)
+
+
+def target_metrics(service: str, target: str) -> TargetMetrics:
+    # Targets come from configuration, which can list any number of them
+    if not target_limiter.admit((service, target)):
+        LABEL_OVERFLOW.labels(service=service, label="target").inc()
+        target = OVERFLOW_LABEL
+    metrics = _target_metrics.get((service, target))
+    if metrics is None:
+        metrics = _target_metrics[(service, target)] = TargetMetrics(service, target)
+    return metrics
+
+
+class Poller:
+    """Polls every target on its own fixed schedule through one pooled client.
+
+    Each target's polls are due on a grid `interval` seconds apart, so a slow poll does not
+    push the following ones back, and each poll is shifted by up to `jitter` of the interval
+    to keep targets from firing in lockstep. At most `concurrency` polls run at once.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        targets: list[str],
+        poll: Poll,
+        interval: float = 10.0,
+        jitter: float = 0.1,
+        timeout: float = 10.0,
+        concurrency: int = 50,
+    ) -> None:
+        self.service = service
+        self.targets = targets
+        self.poll = poll
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+    async def run(self) -> None:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout) as client:
+            async with asyncio.TaskGroup() as group:
+                for target in self.targets:
+                    group.create_task(self._schedule(client, semaphore, target), name=f"poll {target}")
+
+    async def _schedule(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, target: str) -> None:
+        loop = asyncio.get_running_loop()
+        # Spread the first polls over one interval so that targets don't all start together
+        due = loop.time() + random() * self.interval
+        while True:
+            delay = due + uniform(-self.jitter, self.jitter) * self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Looked up for every poll, like the route metrics for every request, so that the
+            # limiter sees the target as in use
+            metrics = target_metrics(self.service, target)
+            async with semaphore:
+                await self._poll(client, target, metrics)
+
+            due += self.interval
+            behind = loop.time() - due
+            if behind > 0:
+                missed = math.ceil(behind / self.interval)
+                due += missed * self.interval
+                metrics.skipped.inc(missed)
+
+    async def _poll(self, client: httpx.AsyncClient, target: str, metrics: TargetMetrics) -> None:
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self.poll(client, target)
+            metrics.success.inc()
+        # httpx raises its own timeouts (connect, read, ...) from inside the poll
+        except (TimeoutError, httpx.TimeoutException):
+            logger.warning(f"Polling {target} timed out after {self.timeout}s.")
+            metrics.timeout.inc()
+        except Exception as e:
+            logger.error(f"Failed to poll {target}: {e!r}")
+            metrics.failure.inc()
+        finally:
+            metrics.time.observe(time.perf_counter() - start)
@@ -2,49 +2,48 @@ import asyncio
 from contextlib import asynccontextmanager
 from common.tracing import get_tracer
 from fastapi import FastAPI
-import os
 from common.log import configure_logging
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 import httpx
 from common.prom import PrometheusMiddleware, metrics
 from random import random
 from loguru import logger
+from poller.engine import Poller
+from poller.settings import settings
 
 service = "poller"
 tracer = get_tracer(service)
 configure_logging(service)
-endpoint = os.getenv("RECEIVER_ENDPOINT", "http://localhost:8000")
-logger.info(f"Polling {endpoint} for new random numbers.")
+logger.info(f"Polling {', '.join(settings.targets)} for new random numbers.")
 
 
-async def poll() -> None:
+async def poll(client: httpx.AsyncClient, endpoint: str) -> None:
     with tracer.start_as_current_span("polling_for_random_number"):
         logger.info("Polling for a new random number.")
-        async with httpx.AsyncClient(timeout=1) as client:
-            try:
-                tmp_endpoint = endpoint
-                if random() < 0.2:
-                    tmp_endpoint += "/slow"
-                response = await client.get(tmp_endpoint, timeout=10)
-                response.raise_for_status()
-                logger.info(f"Received random number: {response.json()['value']}")
-            except Exception as e:
-                logger.error(f"Failed to fetch random number: {e!r}")
+        if random() < 0.2:
+            endpoint += "/slow"
+        response = await client.get(endpoint)
+        response.raise_for_status()
+        logger.info(f"Received random number: {response.json()['value']}")
 
 
-async def poller():
-    logger.info("Poller is running!")
-    while True:
-        await poll()
-        await asyncio.sleep(10)
+poller = Poller(
+    service,
+    settings.targets,
+    poll,
+    interval=settings.poll_interval,
+    jitter=settings.poll_jitter,
+    timeout=settings.poll_timeout,
+    concurrency=settings.poll_concurrency,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    future = asyncio.gather(poller())
-    logger.info("Application started.")
+    task = asyncio.create_task(poller.run())
+    logger.info("Poller is running!")
     yield
-    future.cancel()
+    task.cancel()
 
 
 HTTPXClientInstrumentor().instrument()  # This ensures httpx requests are traced
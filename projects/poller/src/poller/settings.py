@@ -0,0 +1,25 @@
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+
+class PollerSettings(BaseSettings):
+    receiver_endpoint: str = Field(default="http://localhost:8000")
+    # Comma separated URLs to poll, falling back to the receiver endpoint when unset
+    poll_targets: str | None = Field(default=None)
+    # Each target is polled every poll_interval seconds, shifted by up to poll_jitter of the
+    # interval either way. Polls that would overlap are skipped rather than run back to back.
+    poll_interval: float = Field(default=10.0)
+    poll_jitter: float = Field(default=0.1)
+    # Seconds a single poll may take, including reading the response
+    poll_timeout: float = Field(default=10.0)
+    # Maximum number of polls in flight, which is also the size of the connection pool
+    poll_concurrency: int = Field(default=50)
+
+    @property
+    def targets(self) -> list[str]:
+        if not self.poll_targets:
+            return [self.receiver_endpoint]
+        return [target.strip() for target in self.poll_targets.split(",") if target.strip()]
+
+
+settings = PollerSettings()
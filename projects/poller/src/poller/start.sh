@@ -1,3 +1,7 @@
 #! /bin/bash
+# Metric files from a previous run would otherwise be merged into this one's
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
 uvicorn server:app --host 0.0.0.0 --port ${PORT:-8000} --log-level critical --workers 4
  
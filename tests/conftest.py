@@ -0,0 +1,57 @@
+import threading
+from collections.abc import Callable, Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class StandInGateway:
+    """Accepts pushes (or OTLP/HTTP exports) on a local port and keeps them in `pushes`."""
+
+    def __init__(self) -> None:
+        self.pushes: list[tuple[str, str, bytes]] = []
+        # While False, every request is refused with a 503
+        self.up = True
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _accept(self) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not gateway.up:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                gateway.pushes.append((self.command, self.path, body))
+                self.send_response(200)
+                self.end_headers()
+
+            do_PUT = do_POST = _accept
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(scope="session")
+def start_gateway() -> Iterator[Callable[[], StandInGateway]]:
+    gateways: list[StandInGateway] = []
+
+    def start() -> StandInGateway:
+        gateways.append(StandInGateway())
+        return gateways[-1]
+
+    yield start
+    for gateway in gateways:
+        gateway.close()
+
+
+@pytest.fixture
+def gateway(start_gateway: Callable[[], StandInGateway]) -> StandInGateway:
+    return start_gateway()
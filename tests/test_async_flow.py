@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+from opentelemetry import trace
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+
+from common.prefect_utils import data_flow, data_task
+from common.push import get_publisher
+from common.settings import settings
+from common.tracing import get_tracer
+
+TASK_TIME = 0.5
+
+
+@pytest.fixture(scope="module")
+def flow_gateway(start_gateway):
+    # Flows push their metrics, which must not go to a real gateway (or retry against a missing one)
+    gateway = start_gateway()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(settings, "push_gateway", gateway.url)
+        yield gateway
+        get_publisher(gateway.url, settings.service).flush(timeout=5)
+
+
+@pytest.fixture(scope="module")
+def exporter(flow_gateway):
+    from prefect.testing.utilities import prefect_test_harness
+
+    # data_task and data_flow trace through the global provider that get_tracer sets up
+    get_tracer(settings.service)
+    exporter = InMemorySpanExporter()
+    trace.get_tracer_provider().add_span_processor(SimpleSpanProcessor(exporter))
+    with prefect_test_harness():
+        yield exporter
+
+
+@data_task(name="wait", retries=0)
+async def wait(i: int) -> int:
+    await asyncio.sleep(TASK_TIME)
+    if i == 2:
+        raise ValueError("bad item")
+    return i
+
+
+@data_flow(name="gather")
+async def gather() -> list:
+    return await asyncio.gather(wait(0), wait(1), wait(2), return_exceptions=True)
+
+
+def test_async_tasks_run_concurrently_under_their_spans(exporter, flow_gateway):
+    results = asyncio.run(gather())
+    assert results[:2] == [0, 1]
+    assert isinstance(results[2], ValueError)
+
+    spans = exporter.get_finished_spans()
+    tasks = sorted((span for span in spans if span.name == "wait"), key=lambda span: span.start_time)
+    assert len(tasks) == 3
+    # Every task span covers its awaited sleep, and they all ran at the same time
+    for span in tasks:
+        assert TASK_TIME <= (span.end_time - span.start_time) / 1e9 < 2 * TASK_TIME
+    assert max(span.start_time for span in tasks) < min(span.end_time for span in tasks)
+
+    failed = [span for span in tasks if span.status.status_code == StatusCode.ERROR]
+    assert len(failed) == 1
+    assert failed[0].status.description == "ValueError: bad item"
+    assert [span.status.status_code for span in tasks].count(StatusCode.OK) == 2
+
+    (flow_span,) = [span for span in spans if span.name == "gather"]
+    assert (flow_span.end_time - flow_span.start_time) / 1e9 < 3 * TASK_TIME
+
+    assert get_publisher(flow_gateway.url, settings.service).flush(timeout=5)
+    assert flow_gateway.pushes
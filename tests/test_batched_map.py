@@ -0,0 +1,86 @@
+import json
+import sys
+
+import pytest
+from loguru import logger
+from opentelemetry import trace
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+
+from common.log import configure_logging, flush_logging
+from common.prefect_utils import batched_map
+from common.settings import settings
+from common.tracing import get_tracer
+
+
+@pytest.fixture
+def exporter():
+    # batched_map traces through the global provider that get_tracer sets up
+    get_tracer(settings.service)
+    exporter = InMemorySpanExporter()
+    trace.get_tracer_provider().add_span_processor(SimpleSpanProcessor(exporter))
+    return exporter
+
+
+def test_items_run_under_their_chunk_span(exporter):
+    tracer = trace.get_tracer("test")
+    # The log sink takes the trace id from the span that is current when it writes a record
+    trace_ids = []
+    handler = logger.add(
+        lambda message: trace_ids.append(trace.get_current_span().get_span_context().trace_id),
+        level="INFO",
+        filter=lambda record: record["message"].startswith("item "),
+    )
+
+    def square(item: int) -> int:
+        with tracer.start_as_current_span("item"):
+            logger.info("item {}", item)
+            if item == 3:
+                raise ValueError("bad item")
+            return item * item
+
+    try:
+        with tracer.start_as_current_span("caller") as caller:
+            result = batched_map(square, range(6), chunk_size=2, max_workers=2, executor="thread")
+    finally:
+        logger.remove(handler)
+
+    assert result.results == [0, 1, 4, None, 16, 25]
+    assert list(result.errors) == [3]
+
+    spans = exporter.get_finished_spans()
+    chunks = {span.context.span_id: span for span in spans if span.name == "square chunk"}
+    assert len(chunks) == 3
+    assert all(chunk.parent.span_id == caller.get_span_context().span_id for chunk in chunks.values())
+    items = [span for span in spans if span.name == "item"]
+    assert len(items) == 6
+    assert all(item.parent.span_id in chunks for item in items)
+    (failed,) = [chunk for chunk in chunks.values() if chunk.status.status_code == StatusCode.ERROR]
+    assert failed.attributes["map.failures"] == 1
+
+    assert trace_ids == [caller.get_span_context().trace_id] * 6
+
+
+def _log_item(item: int) -> int:
+    logger.info("item {}", item)
+    return item
+
+
+def test_process_workers_write_their_logs(tmp_path, exporter):
+    # Forked workers inherit the queued sink without its writer thread
+    path = tmp_path / "log.jsonl"
+    with open(path, "a") as file:
+        configure_logging(settings.service, queued=True, force=True, file=file)
+        try:
+            logger.info("before the pool")
+            result = batched_map(_log_item, range(6), chunk_size=2, max_workers=2, executor="process")
+            flush_logging()
+        finally:
+            configure_logging(settings.service, queued=False, force=True, file=sys.stderr)
+
+    assert result.results == list(range(6))
+    messages = [json.loads(line)["message"] for line in path.read_text().splitlines()]
+    assert sorted(message for message in messages if message.startswith("item ")) == [f"item {i}" for i in range(6)]
+    # The parent's queued lines are only written by the parent
+    assert messages.count("before the pool") == 1
@@ -0,0 +1,217 @@
+import pytest
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory, timestamp_pb2
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, Summary
+
+from common.exposition import generate_protobuf
+from common.histogram import NativeHistogram
+
+_OPTIONAL = descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+_REPEATED = descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED
+
+# io.prometheus.client's metrics.proto (prometheus/client_model), field by field: name,
+# number, type and whether it is repeated. Message types are named with a leading dot.
+_MESSAGES = {
+    "LabelPair": [("name", 1, "string", False), ("value", 2, "string", False)],
+    "Gauge": [("value", 1, "double", False)],
+    "Counter": [
+        ("value", 1, "double", False),
+        ("exemplar", 2, ".io.prometheus.client.Exemplar", False),
+        ("created_timestamp", 3, ".google.protobuf.Timestamp", False),
+    ],
+    "Quantile": [("quantile", 1, "double", False), ("value", 2, "double", False)],
+    "Summary": [
+        ("sample_count", 1, "uint64", False),
+        ("sample_sum", 2, "double", False),
+        ("quantile", 3, ".io.prometheus.client.Quantile", True),
+        ("created_timestamp", 4, ".google.protobuf.Timestamp", False),
+    ],
+    "Untyped": [("value", 1, "double", False)],
+    "Histogram": [
+        ("sample_count", 1, "uint64", False),
+        ("sample_count_float", 4, "double", False),
+        ("sample_sum", 2, "double", False),
+        ("bucket", 3, ".io.prometheus.client.Bucket", True),
+        ("created_timestamp", 15, ".google.protobuf.Timestamp", False),
+        ("schema", 5, "sint32", False),
+        ("zero_threshold", 6, "double", False),
+        ("zero_count", 7, "uint64", False),
+        ("zero_count_float", 8, "double", False),
+        ("negative_span", 9, ".io.prometheus.client.BucketSpan", True),
+        ("negative_delta", 10, "sint64", True),
+        ("negative_count", 11, "double", True),
+        ("positive_span", 12, ".io.prometheus.client.BucketSpan", True),
+        ("positive_delta", 13, "sint64", True),
+        ("positive_count", 14, "double", True),
+        ("exemplars", 16, ".io.prometheus.client.Exemplar", True),
+    ],
+    "Bucket": [
+        ("cumulative_count", 1, "uint64", False),
+        ("cumulative_count_float", 4, "double", False),
+        ("upper_bound", 2, "double", False),
+        ("exemplar", 3, ".io.prometheus.client.Exemplar", False),
+    ],
+    "BucketSpan": [("offset", 1, "sint32", False), ("length", 2, "uint32", False)],
+    "Exemplar": [
+        ("label", 1, ".io.prometheus.client.LabelPair", True),
+        ("value", 2, "double", False),
+        ("timestamp", 3, ".google.protobuf.Timestamp", False),
+    ],
+    "Metric": [
+        ("label", 1, ".io.prometheus.client.LabelPair", True),
+        ("gauge", 2, ".io.prometheus.client.Gauge", False),
+        ("counter", 3, ".io.prometheus.client.Counter", False),
+        ("summary", 4, ".io.prometheus.client.Summary", False),
+        ("untyped", 5, ".io.prometheus.client.Untyped", False),
+        ("histogram", 7, ".io.prometheus.client.Histogram", False),
+        ("timestamp_ms", 6, "int64", False),
+    ],
+    "MetricFamily": [
+        ("name", 1, "string", False),
+        ("help", 2, "string", False),
+        ("type", 3, ".io.prometheus.client.MetricType", False),
+        ("metric", 4, ".io.prometheus.client.Metric", True),
+        ("unit", 5, "string", False),
+    ],
+}
+_METRIC_TYPES = ["COUNTER", "GAUGE", "SUMMARY", "UNTYPED", "HISTOGRAM", "GAUGE_HISTOGRAM"]
+
+
+def _field_type(type_name: str) -> tuple[int, str | None]:
+    if type_name == ".io.prometheus.client.MetricType":
+        return descriptor_pb2.FieldDescriptorProto.TYPE_ENUM, type_name
+    if type_name.startswith("."):
+        return descriptor_pb2.FieldDescriptorProto.TYPE_MESSAGE, type_name
+    return descriptor_pb2.FieldDescriptorProto.Type.Value("TYPE_" + type_name.upper()), None
+
+
+@pytest.fixture(scope="module")
+def MetricFamily():
+    pool = descriptor_pool.DescriptorPool()
+    timestamp = descriptor_pb2.FileDescriptorProto()
+    timestamp_pb2.DESCRIPTOR.CopyToProto(timestamp)
+    pool.Add(timestamp)
+
+    file = descriptor_pb2.FileDescriptorProto(
+        name="io/prometheus/client/metrics.proto",
+        package="io.prometheus.client",
+        syntax="proto2",
+        dependency=["google/protobuf/timestamp.proto"],
+    )
+    enum = file.enum_type.add(name="MetricType")
+    for number, name in enumerate(_METRIC_TYPES):
+        enum.value.add(name=name, number=number)
+    for message_name, fields in _MESSAGES.items():
+        message = file.message_type.add(name=message_name)
+        for name, number, type_name, repeated in fields:
+            field_type, reference = _field_type(type_name)
+            field = message.field.add(
+                name=name, number=number, type=field_type, label=_REPEATED if repeated else _OPTIONAL
+            )
+            if reference is not None:
+                field.type_name = reference
+    pool.Add(file)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName("io.prometheus.client.MetricFamily"))
+
+
+def _decode(MetricFamily, payload: bytes) -> dict:
+    families = {}
+    offset = 0
+    while offset < len(payload):
+        length = shift = 0
+        while True:
+            byte = payload[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        family = MetricFamily()
+        family.ParseFromString(payload[offset : offset + length])
+        offset += length
+        families[family.name] = family
+    return families
+
+
+def _buckets(spans, deltas) -> dict[int, int]:
+    # Spans and deltas back to absolute counts by bucket key
+    buckets = {}
+    deltas = iter(deltas)
+    key = count = 0
+    for i, span in enumerate(spans):
+        key += span.offset if i == 0 else span.offset + 1
+        for j in range(span.length):
+            count += next(deltas)
+            buckets[key + j] = count
+        key += span.length - 1
+    return buckets
+
+
+def test_families_decode_with_the_metrics_proto(MetricFamily):
+    registry = CollectorRegistry()
+    Counter("jobs", "Jobs run.", ["queue"], registry=registry).labels(queue="fast").inc(3)
+    Gauge("workers", "Workers up.", registry=registry).set(2.5)
+    summary = Summary("latency_seconds", "Latency.", registry=registry)
+    summary.observe(0.2)
+    summary.observe(0.4)
+    classic = Histogram("size_bytes", "Sizes.", buckets=[10, 100], registry=registry)
+    for value in (5, 50, 500):
+        classic.observe(value)
+
+    families = _decode(MetricFamily, generate_protobuf(registry))
+
+    jobs = families["jobs_total"]
+    assert jobs.type == _METRIC_TYPES.index("COUNTER")
+    assert jobs.help == "Jobs run."
+    (series,) = jobs.metric
+    assert [(label.name, label.value) for label in series.label] == [("queue", "fast")]
+    assert series.counter.value == 3
+    assert series.counter.HasField("created_timestamp")
+
+    assert families["workers"].type == _METRIC_TYPES.index("GAUGE")
+    assert families["workers"].metric[0].gauge.value == 2.5
+
+    latency = families["latency_seconds"].metric[0].summary
+    assert latency.sample_count == 2
+    assert latency.sample_sum == pytest.approx(0.6)
+
+    sizes = families["size_bytes"]
+    assert sizes.type == _METRIC_TYPES.index("HISTOGRAM")
+    histogram = sizes.metric[0].histogram
+    assert histogram.sample_count == 3
+    assert histogram.sample_sum == 555
+    # +Inf is left out, it is the sample count
+    assert [(bucket.upper_bound, bucket.cumulative_count) for bucket in histogram.bucket] == [(10, 1), (100, 2)]
+    # A classic histogram carries no native fields
+    assert not histogram.positive_span
+    assert not histogram.HasField("schema")
+
+
+def test_native_buckets_decode_with_the_metrics_proto(MetricFamily):
+    registry = CollectorRegistry()
+    durations = NativeHistogram(
+        "duration_seconds", "Durations.", ["flow"], buckets=[1, 10], schema=0, registry=registry
+    )
+    # With schema 0, bucket k holds (2**(k - 1), 2**k]
+    for value in (0, 1, 3, 4, 1024, -1):
+        durations.labels(flow="etl").observe(value)
+    durations.labels(flow="idle")
+
+    families = _decode(MetricFamily, generate_protobuf(registry))
+
+    metrics = {metric.label[0].value: metric.histogram for metric in families["duration_seconds"].metric}
+    etl = metrics["etl"]
+    assert etl.sample_count == 6
+    assert etl.sample_sum == 1031
+    assert [(bucket.upper_bound, bucket.cumulative_count) for bucket in etl.bucket] == [(1, 3), (10, 5)]
+    assert etl.schema == 0
+    assert etl.zero_count == 1
+    assert 0 < etl.zero_threshold < 1e-30
+    assert _buckets(etl.positive_span, etl.positive_delta) == {0: 1, 2: 2, 10: 1}
+    assert _buckets(etl.negative_span, etl.negative_delta) == {0: 1}
+
+    # Nothing observed yet: no spans, but the zero threshold still marks it as native
+    idle = metrics["idle"]
+    assert idle.sample_count == 0
+    assert idle.HasField("schema")
+    assert idle.zero_threshold > 0
+    assert not idle.positive_span and not idle.positive_delta
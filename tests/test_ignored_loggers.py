@@ -0,0 +1,29 @@
+import io
+import json
+import logging
+import sys
+
+from common.log import LOGGERS_TO_IGNORE, InterceptHandler, configure_logging, flush_logging
+from common.settings import settings
+
+
+def test_loggers_added_to_the_ignore_list_are_dropped():
+    file = io.StringIO()
+    # pytest's own handlers on the root logger keep basicConfig from adding this one
+    handler = InterceptHandler()
+    logging.root.addHandler(handler)
+    configure_logging(settings.service, queued=False, force=True, file=file)
+    try:
+        logging.getLogger("noisy.child").warning("before")
+        LOGGERS_TO_IGNORE.append("noisy")
+        configure_logging(settings.service, queued=False, force=True, file=file)
+        logging.getLogger("noisy.child").warning("after")
+        flush_logging()
+    finally:
+        logging.root.removeHandler(handler)
+        LOGGERS_TO_IGNORE.remove("noisy")
+        configure_logging(settings.service, queued=False, force=True, file=sys.stderr)
+
+    messages = [json.loads(line)["message"] for line in file.getvalue().splitlines()]
+    assert "before" in messages
+    assert "after" not in messages
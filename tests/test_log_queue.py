@@ -0,0 +1,85 @@
+import io
+import threading
+
+from common.log import QueuedWriter
+
+
+class _SlowFile(io.StringIO):
+    # Holds every write until `release` is set, so lines pile up in the queue meanwhile
+    def __init__(self) -> None:
+        super().__init__()
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, text: str) -> int:
+        self.writing.set()
+        self.release.wait(5)
+        return super().write(text)
+
+
+def _stalled(overflow: str, maxsize: int = 3) -> tuple[QueuedWriter, _SlowFile]:
+    # A writer whose thread is stuck writing "stall\n", with an empty queue of `maxsize` lines
+    file = _SlowFile()
+    writer = QueuedWriter("test", file=file, maxsize=maxsize, overflow=overflow, batch_size=1, flush_interval=0.01)
+    writer.write("stall\n")
+    assert file.writing.wait(5)
+    return writer, file
+
+
+def test_lines_are_written_in_order_once_flushed():
+    file = io.StringIO()
+    writer = QueuedWriter("test", file=file, batch_size=100, flush_interval=10)
+    for i in range(10):
+        writer.write(f"line {i}\n")
+    assert writer.flush(timeout=5)
+    assert file.getvalue() == "".join(f"line {i}\n" for i in range(10))
+    writer.close()
+
+
+def test_drop_oldest_keeps_the_newest_lines():
+    writer, file = _stalled("drop_oldest")
+    for i in range(5):
+        writer.write(f"line {i}\n")
+    assert writer.dropped == 2
+    file.release.set()
+    assert writer.flush(timeout=5)
+    assert file.getvalue() == "stall\nline 2\nline 3\nline 4\n"
+    writer.close()
+
+
+def test_drop_newest_keeps_the_oldest_lines():
+    writer, file = _stalled("drop_newest")
+    for i in range(5):
+        writer.write(f"line {i}\n")
+    assert writer.dropped == 2
+    file.release.set()
+    assert writer.flush(timeout=5)
+    assert file.getvalue() == "stall\nline 0\nline 1\nline 2\n"
+    writer.close()
+
+
+def test_block_waits_for_room_without_dropping():
+    writer, file = _stalled("block", maxsize=1)
+    writer.write("line 0\n")
+    blocked = threading.Thread(target=writer.write, args=("line 1\n",))
+    blocked.start()
+    blocked.join(0.1)
+    assert blocked.is_alive()
+
+    file.release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    assert writer.flush(timeout=5)
+    assert file.getvalue() == "stall\nline 0\nline 1\n"
+    assert writer.dropped == 0
+    writer.close()
+
+
+def test_close_writes_what_is_queued_and_then_writes_directly():
+    file = io.StringIO()
+    writer = QueuedWriter("test", file=file, batch_size=100, flush_interval=10)
+    writer.write("queued\n")
+    writer.close()
+    assert file.getvalue() == "queued\n"
+    writer.write("after close\n")
+    assert file.getvalue() == "queued\nafter close\n"
@@ -0,0 +1,69 @@
+import pytest
+from loguru import logger
+from prometheus_client import REGISTRY
+
+from common.log import LogRateLimiter
+
+
+@pytest.fixture
+def limited():
+    # Without a refill to speak of, each call site gets its burst and nothing more
+    limiter = LogRateLimiter("limited", rate=1e-6, burst=3, max_keys=2, summary_interval=3600)
+    records = []
+    handler = logger.add(lambda message: records.append(message.record), level="INFO", filter=limiter)
+    yield limiter, records
+    logger.remove(handler)
+    limiter.close()
+
+
+def _suppressed() -> float:
+    return REGISTRY.get_sample_value("log_suppressed_total", {"service": "limited", "level": "INFO"}) or 0.0
+
+
+def _flood(count: int) -> None:
+    for i in range(count):
+        logger.info(f"flood {i}")
+
+
+def test_call_sites_get_their_burst_then_are_suppressed(limited):
+    _, records = limited
+    before = _suppressed()
+
+    _flood(10)
+    for i in range(2):
+        logger.info(f"other {i}")
+
+    # The other call site has a bucket of its own
+    assert [record["message"] for record in records] == ["flood 0", "flood 1", "flood 2", "other 0", "other 1"]
+    assert _suppressed() - before == 7
+
+
+def test_suppressed_lines_are_summarised_once(limited):
+    limiter, records = limited
+    _flood(10)
+    records.clear()
+
+    limiter.flush()
+    (summary,) = records
+    assert summary["extra"]["suppressed"] == 7
+    assert summary["message"] == "Suppressed 7 similar log lines, the last was: flood 9"
+    # Reported from the flooding call site rather than from the limiter
+    assert summary["function"] == "_flood"
+
+    # Nothing more was suppressed since
+    limiter.flush()
+    assert len(records) == 1
+
+
+def test_call_sites_pushed_out_are_summarised(limited):
+    _, records = limited
+    _flood(5)
+    logger.info("second")
+    records.clear()
+
+    # A third call site is over max_keys, so the least recently used one is summarised
+    logger.info("third")
+    assert [record["message"] for record in records] == [
+        "Suppressed 2 similar log lines, the last was: flood 4",
+        "third",
+    ]
@@ -0,0 +1,27 @@
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from common.prom import metrics
+
+
+@pytest.fixture(scope="module")
+def client():
+    return TestClient(Starlette(routes=[Route("/metrics", metrics)]))
+
+
+def test_metrics_are_gzipped_when_accepted(client):
+    response = client.get("/metrics", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert b"# HELP" in response.content
+
+
+@pytest.mark.parametrize("accept_encoding", ["gzip;q=0, identity", "identity", "*;q=1, gzip;q=0", ""])
+def test_metrics_are_not_gzipped_when_refused(client, accept_encoding):
+    # The raw body, without the client's own decoding
+    with client.stream("GET", "/metrics", headers={"Accept-Encoding": accept_encoding}) as response:
+        body = b"".join(response.iter_raw())
+    assert "content-encoding" not in response.headers
+    assert body.startswith(b"# HELP")
@@ -0,0 +1,73 @@
+from starlette.responses import PlainTextResponse
+from starlette.routing import Host, Mount, Route, Router
+
+from common.prom import RouteIndex
+
+
+def _endpoint(request):
+    return PlainTextResponse("")
+
+
+def _scope(path: str, method: str = "GET", host: str = "example.com") -> dict:
+    return {"type": "http", "method": method, "path": path, "root_path": "", "headers": [(b"host", host.encode())]}
+
+
+def test_routes_resolve_to_their_template_in_declaration_order():
+    index = RouteIndex(
+        [
+            Route("/", _endpoint),
+            Route("/items/{item_id}", _endpoint),
+            Route("/items/me", _endpoint),
+            Route("/users/{user_id}/orders/{order_id:int}", _endpoint),
+        ]
+    )
+    assert index.resolve(_scope("/")) == ("/", True)
+    assert index.resolve(_scope("/items/42")) == ("/items/{item_id}", True)
+    # Starlette takes the first route that matches, even when a later one is static
+    assert index.resolve(_scope("/items/me")) == ("/items/{item_id}", True)
+    assert index.resolve(_scope("/users/7/orders/3")) == ("/users/{user_id}/orders/{order_id:int}", True)
+
+
+def test_mounts_resolve_to_the_template_within_them():
+    async def static_files(scope, receive, send):
+        pass
+
+    index = RouteIndex(
+        [
+            Mount("/api", routes=[Route("/items/{item_id}", _endpoint), Mount("/v2", routes=[Route("/", _endpoint)])]),
+            Mount("/static", app=static_files),
+        ]
+    )
+    assert index.resolve(_scope("/api/items/1")) == ("/api/items/{item_id}", True)
+    assert index.resolve(_scope("/api/v2/")) == ("/api/v2/", True)
+    # An app without routes of its own is recorded under the mount
+    assert index.resolve(_scope("/static/css/site.css")) == ("/static", True)
+    # Within a mount, a path none of its routes match falls back to the mount itself
+    assert index.resolve(_scope("/api/missing")) == ("/api", True)
+
+
+def test_host_routes_resolve_by_the_request_host():
+    async def files(scope, receive, send):
+        pass
+
+    index = RouteIndex(
+        [
+            Host("api.example.com", app=Router([Route("/items/{item_id}", _endpoint)])),
+            Host("{bucket}.files.example.com", app=files),
+            Route("/items/{name}", _endpoint),
+        ]
+    )
+    # The same method and path resolve differently per host, so they are not cached together
+    assert index.resolve(_scope("/items/1", host="api.example.com")) == ("/items/{item_id}", True)
+    assert index.resolve(_scope("/items/1", host="www.example.com")) == ("/items/{name}", True)
+    assert index.resolve(_scope("/items/1", host="api.example.com")) == ("/items/{item_id}", True)
+    # An app without routes is recorded under its host pattern rather than every path it serves
+    assert index.resolve(_scope("/a/b.txt", host="logs.files.example.com")) == ("{bucket}.files.example.com", True)
+
+
+def test_unmatched_paths_and_methods_are_not_handled():
+    index = RouteIndex([Route("/items/{item_id}", _endpoint, methods=["GET"])])
+    # A 404, and a 405 that only partly matches, are left to the app under their own path
+    assert index.resolve(_scope("/nothing/here")) == ("/nothing/here", False)
+    assert index.resolve(_scope("/items/1", method="POST")) == ("/items/1", False)
+    assert index.resolve(_scope("/items/1")) == ("/items/{item_id}", True)
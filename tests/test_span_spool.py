@@ -0,0 +1,128 @@
+import socket
+import time
+
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, SpanExportResult
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import SpanKind, StatusCode
+
+from common.settings import settings
+from common.spool import Spool
+from common.tracing import DeadlineSpanExporter, SpoolingSpanExporter, create_span_exporter, decode_spans
+
+
+def _closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _spans(count: int) -> list:
+    memory = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(memory))
+    tracer = provider.get_tracer("test")
+    for i in range(count):
+        with tracer.start_as_current_span(f"span-{i}"):
+            pass
+    return list(memory.get_finished_spans())
+
+
+def test_down_grpc_endpoint_is_spooled_without_retries(tmp_path):
+    otlp_exporter = create_span_exporter(f"http://127.0.0.1:{_closed_port()}", timeout=0.5)
+    spool = Spool(str(tmp_path), "spans")
+    exporter = SpoolingSpanExporter(DeadlineSpanExporter(otlp_exporter, timeout=2.0), spool)
+    try:
+        start = time.monotonic()
+        assert exporter.export(_spans(3)) == SpanExportResult.SUCCESS
+        # The OTLP exporter on its own would back off and retry for about a minute
+        assert time.monotonic() - start < 5
+        assert len(spool) == 1
+
+        # Once down, batches go straight to the spool
+        assert exporter.export(_spans(2)) == SpanExportResult.SUCCESS
+        assert len(spool) == 2
+        assert spool.replay(exporter.replay) == 0
+    finally:
+        spool.close()
+        otlp_exporter.shutdown()
+
+
+def test_spooled_spans_are_replayed_once_the_http_endpoint_recovers(tmp_path, gateway, monkeypatch):
+    monkeypatch.setattr(settings, "otel_exporter_otlp_protocol", "http/protobuf")
+    otlp_exporter = create_span_exporter(gateway.url, timeout=0.5)
+    spool = Spool(str(tmp_path), "spans")
+    exporter = SpoolingSpanExporter(DeadlineSpanExporter(otlp_exporter, timeout=2.0), spool)
+    try:
+        gateway.up = False
+        for count in (1, 2, 3):
+            assert exporter.export(_spans(count)) == SpanExportResult.SUCCESS
+        assert len(spool) == 3
+        assert gateway.pushes == []
+
+        gateway.up = True
+        assert spool.replay(exporter.replay) == 3
+        assert len(spool) == 0
+        # Oldest first, each batch as the request it would have been
+        assert [(command, path) for command, path, _ in gateway.pushes] == [("POST", "/v1/traces")] * 3
+        batches = [ExportTraceServiceRequest.FromString(body) for _, _, body in gateway.pushes]
+        assert [len(batch.resource_spans[0].scope_spans[0].spans) for batch in batches] == [1, 2, 3]
+
+        # Back up, so batches are exported rather than spooled
+        assert exporter.export(_spans(1)) == SpanExportResult.SUCCESS
+        assert len(gateway.pushes) == 4
+        assert len(spool) == 0
+    finally:
+        spool.close()
+        otlp_exporter.shutdown()
+
+
+def test_one_replayed_batch_switches_back_to_exporting(tmp_path, gateway, monkeypatch):
+    monkeypatch.setattr(settings, "otel_exporter_otlp_protocol", "http/protobuf")
+    otlp_exporter = create_span_exporter(gateway.url, timeout=0.5)
+    spool = Spool(str(tmp_path), "spans")
+    exporter = SpoolingSpanExporter(DeadlineSpanExporter(otlp_exporter, timeout=2.0), spool)
+    try:
+        gateway.up = False
+        for _ in range(3):
+            exporter.export(_spans(1))
+        gateway.up = True
+        # New batches are exported while the rest of the backlog is still waiting
+        assert spool.replay(exporter.replay, limit=1) == 1
+        assert exporter.export(_spans(2)) == SpanExportResult.SUCCESS
+        assert len(spool) == 2
+        assert len(gateway.pushes) == 2
+
+        # Another process sharing the directory starts out exporting, whatever its backlog
+        other = SpoolingSpanExporter(DeadlineSpanExporter(otlp_exporter, timeout=2.0), spool)
+        assert other.export(_spans(1)) == SpanExportResult.SUCCESS
+        assert len(gateway.pushes) == 3
+        assert len(spool) == 2
+    finally:
+        spool.close()
+        otlp_exporter.shutdown()
+
+
+def test_spooled_spans_decode_to_what_was_exported():
+    from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+
+    provider = TracerProvider()
+    memory = InMemorySpanExporter()
+    provider.add_span_processor(SimpleSpanProcessor(memory))
+    tracer = provider.get_tracer("test", "1.0")
+    with tracer.start_as_current_span("parent", kind=SpanKind.SERVER, attributes={"route": "/a", "codes": (1, 2)}):
+        with tracer.start_as_current_span("child") as child:
+            child.add_event("retry", {"attempt": 2})
+            child.set_status(StatusCode.ERROR, "boom")
+    spans = memory.get_finished_spans()
+
+    payload = encode_spans(spans).SerializePartialToString()
+    decoded = decode_spans(payload)
+    assert encode_spans(decoded).SerializePartialToString() == payload
+    child, parent = decoded
+    assert child.parent.span_id == parent.context.span_id
+    assert parent.kind == SpanKind.SERVER
+    assert parent.attributes == {"route": "/a", "codes": (1, 2)}
+    assert child.status.status_code == StatusCode.ERROR
+    assert child.events[0].attributes == {"attempt": 2}
@@ -0,0 +1,193 @@
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter
+
+from common.push import PushPublisher, _decode_request
+from common.spool import Spool
+
+
+class _Receiver:
+    # A Sender that delivers into a list while `up`
+    def __init__(self) -> None:
+        self.up = True
+        self.payloads: list[bytes] = []
+
+    def __call__(self, payload: bytes, spooled: float) -> bool:
+        if self.up:
+            self.payloads.append(payload)
+        return self.up
+
+
+def test_replay_delivers_oldest_first_once_the_endpoint_recovers(tmp_path):
+    spool = Spool(str(tmp_path), "test", segment_bytes=64)
+    receiver = _Receiver()
+    for i in range(10):
+        spool.append(b"record %d" % i)
+    assert len(spool) == 10
+    assert len(os.listdir(tmp_path)) > 1
+    size = spool.size
+
+    receiver.up = False
+    assert spool.replay(receiver) == 0
+    assert len(spool) == 10
+    assert spool.size == size
+
+    receiver.up = True
+    assert spool.replay(receiver) == 10
+    assert receiver.payloads == [b"record %d" % i for i in range(10)]
+    assert len(spool) == 0
+    spool.close()
+    # The segment that was being written to goes once it is closed
+    assert spool.replay(receiver) == 0
+    assert spool.size == 0
+    assert os.listdir(tmp_path) == []
+
+
+def test_replay_keeps_writing_to_the_current_segment(tmp_path):
+    spool = Spool(str(tmp_path), "test")
+    receiver = _Receiver()
+    receiver.up = False
+    for i in range(5):
+        spool.append(b"record %d" % i)
+        # As replay is retried through an outage
+        spool.replay(receiver)
+    receiver.up = True
+    assert spool.replay(receiver) == 5
+    spool.append(b"record 5")
+    assert spool.replay(receiver) == 1
+    assert receiver.payloads == [b"record %d" % i for i in range(6)]
+    assert len([file for file in os.listdir(tmp_path) if file.endswith(".spool")]) == 1
+    spool.close()
+
+
+def test_partly_replayed_segment_carries_on_where_it_stopped(tmp_path):
+    first = Spool(str(tmp_path), "test")
+    for i in range(3):
+        first.append(b"record %d" % i)
+    receiver = _Receiver()
+    assert first.replay(receiver, limit=1) == 1
+    first.close()
+
+    # A later process only sends what was not delivered yet
+    second = Spool(str(tmp_path), "test")
+    assert len(second) == 2
+    assert second.replay(receiver) == 2
+    assert receiver.payloads == [b"record 0", b"record 1", b"record 2"]
+    second.close()
+
+
+def test_processes_replay_each_others_segments_but_not_the_ones_being_written(tmp_path):
+    finished, running, replayer = (Spool(str(tmp_path), "test") for _ in range(3))
+    finished.append(b"finished")
+    finished.close()
+    running.append(b"running")
+    receiver = _Receiver()
+
+    assert replayer.replay(receiver) == 1
+    assert receiver.payloads == [b"finished"]
+    assert len(replayer) == 1
+
+    running.close()
+    assert replayer.replay(receiver) == 1
+    assert receiver.payloads == [b"finished", b"running"]
+    replayer.close()
+
+
+def test_oldest_segments_are_evicted_past_max_bytes(tmp_path):
+    spool = Spool(str(tmp_path), "evicted", max_bytes=1024, segment_bytes=256)
+    for i in range(40):
+        spool.append(b"%03d" % i + b"x" * 61)
+    # Only whole segments are evicted and the one being written to is kept
+    assert spool.size <= 1024 + 256
+    evicted = REGISTRY.get_sample_value("spool_records_total", {"service": "", "spool": "evicted", "action": "evicted"})
+    assert evicted > 0
+    assert len(spool) == 40 - evicted
+
+    receiver = _Receiver()
+    spool.replay(receiver)
+    numbers = [int(payload[:3]) for payload in receiver.payloads]
+    assert numbers == list(range(40 - len(numbers), 40))
+    spool.close()
+
+
+def _publisher(url: str, spool: Spool) -> PushPublisher:
+    return PushPublisher(url, "job", window=0.0, timeout=2.0, retries=0, spool=spool)
+
+
+def _registry(value: int) -> CollectorRegistry:
+    registry = CollectorRegistry()
+    Counter("runs", "Runs", registry=registry).inc(value)
+    return registry
+
+
+def test_every_spooled_push_is_replayed_by_a_later_publisher(tmp_path, gateway):
+    # Each flow run is a process of its own with a publisher of its own
+    gateway.up = False
+    spool = Spool(str(tmp_path), "push")
+    publisher = _publisher(gateway.url, spool)
+    for i in range(20):
+        publisher.submit(_registry(i))
+        assert publisher.flush(timeout=5)
+    publisher.close(timeout=5)
+    spool.close()
+    assert len(spool) == 20
+    assert gateway.pushes == []
+
+    gateway.up = True
+    spool = Spool(str(tmp_path), "push")
+    publisher = _publisher(gateway.url, spool)
+    publisher.submit(_registry(20))
+    assert publisher.flush(timeout=5)
+    assert spool.replay(publisher.replay) == 20
+    spool.close()
+
+    assert len(gateway.pushes) == 21
+    runs = [
+        float(line.split()[1])
+        for _, _, body in gateway.pushes
+        for line in body.decode().splitlines()
+        if line.startswith("runs_total")
+    ]
+    assert sorted(runs) == [float(i) for i in range(21)]
+    # Replayed in the order they were spooled, after the live push
+    assert runs[1:] == [float(i) for i in range(20)]
+
+
+def test_spooled_pushes_keep_their_request(tmp_path, gateway):
+    gateway.up = False
+    spool = Spool(str(tmp_path), "push")
+    publisher = _publisher(gateway.url, spool)
+    publisher.submit(_registry(1))
+    assert publisher.flush(timeout=5)
+    records = []
+    spool.replay(lambda payload, spooled: records.append(payload) or False)
+    request, data = _decode_request(records[0])
+    assert request["method"] == "PUT"
+    assert request["url"].startswith(gateway.url)
+    assert b"runs_total 1.0" in data
+    spool.close()
+
+
+def test_pushes_carry_how_much_the_spool_counts_grew(tmp_path, gateway):
+    # The gateway adds up every push, so the pushed counts must sum to the process's totals
+    spool = Spool(str(tmp_path), "deltas", service="job")
+    publisher = _publisher(gateway.url, spool)
+    for appended in (3, 0, 2):
+        for _ in range(appended):
+            spool.append(b"record")
+        publisher.submit(_registry(1))
+        assert publisher.flush(timeout=5)
+    spool.close()
+
+    bodies = [body.decode() for _, _, body in gateway.pushes]
+    assert len(bodies) == 3
+    assert not any("spool_bytes" in body or "spool_replay_lag" in body for body in bodies)
+    spooled = [
+        sum(
+            float(line.split()[-1])
+            for line in body.splitlines()
+            if line.startswith("spool_records_total{") and 'spool="deltas"' in line and 'action="spooled"' in line
+        )
+        for body in bodies
+    ]
+    assert spooled == [3.0, 0.0, 2.0]
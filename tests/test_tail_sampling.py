@@ -0,0 +1,111 @@
+import time
+
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.id_generator import RandomIdGenerator
+from opentelemetry.trace import StatusCode, set_span_in_context
+
+from common.tracing import TailSamplingSpanProcessor
+
+# Trace ids whose lower 64 bits fall below, and above, the bound of a 0.5 ratio
+KEPT_TRACE_ID = 0x1
+DROPPED_TRACE_ID = 0xFFFF_FFFF_FFFF_FFFF
+
+
+class _TraceIds(RandomIdGenerator):
+    def __init__(self, *trace_ids: int) -> None:
+        self.trace_ids = list(trace_ids)
+
+    def generate_trace_id(self) -> int:
+        return self.trace_ids.pop(0)
+
+
+@pytest.fixture
+def exporter() -> InMemorySpanExporter:
+    return InMemorySpanExporter()
+
+
+def _tracer(exporter: InMemorySpanExporter, *trace_ids: int, **kwargs):
+    kwargs = {"ratio": 0.0, "latency_threshold": 1.0, "decision_wait": 60.0, **kwargs}
+    processor = TailSamplingSpanProcessor(SimpleSpanProcessor(exporter), service="test", **kwargs)
+    provider = TracerProvider(id_generator=_TraceIds(*trace_ids) if trace_ids else RandomIdGenerator())
+    provider.add_span_processor(processor)
+    return provider.get_tracer("test"), processor
+
+
+def _names(exporter: InMemorySpanExporter) -> list[str]:
+    return sorted(span.name for span in exporter.get_finished_spans())
+
+
+def test_ratio_keeps_traces_by_trace_id(exporter):
+    tracer, processor = _tracer(exporter, KEPT_TRACE_ID, DROPPED_TRACE_ID, ratio=0.5)
+    with tracer.start_as_current_span("kept"):
+        with tracer.start_as_current_span("kept-child"):
+            pass
+    with tracer.start_as_current_span("dropped"):
+        with tracer.start_as_current_span("dropped-child"):
+            pass
+    assert _names(exporter) == ["kept", "kept-child"]
+    processor.shutdown()
+
+
+def test_spans_after_the_decision_follow_it(exporter):
+    tracer, processor = _tracer(exporter, KEPT_TRACE_ID, ratio=0.5)
+    root = tracer.start_span("root")
+    with tracer.start_as_current_span("late", context=set_span_in_context(root)) as late:
+        root.end()
+        assert _names(exporter) == ["root"]
+    assert late.context.trace_id == KEPT_TRACE_ID
+    assert _names(exporter) == ["late", "root"]
+    processor.shutdown()
+
+
+def test_errors_are_kept(exporter):
+    tracer, processor = _tracer(exporter)
+    with tracer.start_as_current_span("failed"):
+        with tracer.start_as_current_span("failed-child") as child:
+            child.set_status(StatusCode.ERROR)
+    with tracer.start_as_current_span("ok"):
+        pass
+    assert _names(exporter) == ["failed", "failed-child"]
+    processor.shutdown()
+
+
+def test_slow_traces_are_kept(exporter):
+    tracer, processor = _tracer(exporter, latency_threshold=1.0)
+    with tracer.start_as_current_span("slow"):
+        child = tracer.start_span("slow-child", start_time=0)
+        child.end(end_time=2 * 10**9)
+    with tracer.start_as_current_span("fast"):
+        child = tracer.start_span("fast-child", start_time=0)
+        child.end(end_time=10**8)
+    assert _names(exporter) == ["slow", "slow-child"]
+    processor.shutdown()
+
+
+def test_traces_are_decided_after_decision_wait(exporter):
+    tracer, processor = _tracer(exporter, decision_wait=0.05)
+    root = tracer.start_span("root")
+    child = tracer.start_span("child", context=set_span_in_context(root))
+    child.set_status(StatusCode.ERROR)
+    child.end()
+    # The root span never ends, so only the timeout decides the trace
+    deadline = time.monotonic() + 5
+    while not exporter.get_finished_spans() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert _names(exporter) == ["child"]
+    processor.shutdown()
+
+
+def test_oldest_traces_are_decided_past_max_spans(exporter):
+    tracer, processor = _tracer(exporter, ratio=1.0, max_spans=2)
+    first = tracer.start_span("first")
+    second = tracer.start_span("second")
+    for name in ("first-a", "first-b"):
+        tracer.start_span(name, context=set_span_in_context(first)).end()
+    assert _names(exporter) == []
+    tracer.start_span("second-a", context=set_span_in_context(second)).end()
+    assert _names(exporter) == ["first-a", "first-b"]
+    processor.shutdown()